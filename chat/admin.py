@@ -16,9 +16,18 @@ class ChatSessionAdmin(admin.ModelAdmin):
 class ConversationAdmin(admin.ModelAdmin):
     list_display = ['id', 'session', 'prompt_preview', 'response_preview', 'created_at']
     list_filter = ['created_at', 'session']
-    search_fields = ['prompt', 'response']
+    # prompt/response are encrypted, so LIKE searches cannot match them;
+    # prompts are found by exact match through their blind index instead
+    search_fields = ['session__title']
     readonly_fields = ['created_at']
     
+    def get_search_results(self, request, queryset, search_term):
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            # Match within the incoming queryset to keep the changelist's filters
+            results |= queryset.match(prompt=search_term)
+        return results, may_have_duplicates
+    
     def prompt_preview(self, obj):
         return obj.prompt[:50] + "..." if len(obj.prompt) > 50 else obj.prompt
     prompt_preview.short_description = 'Prompt'
@@ -1,27 +1,79 @@
 import asyncio
+import threading
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from .modules.ai import Asklama
+from django.conf import settings
+from .modules.ai import AsklamaStreamAsync, cached_response, submit_prompt
+from .modules.inference import InferenceBusy
+from .modules.response_cache import replay_chunks
+from .modules.streaming import DEFAULT_FRAME_CHARS, DEFAULT_FRAME_INTERVAL, coalesce, iterate
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    Streams chat answers over a WebSocket.
+
+    Generation runs on the inference pool's workers; this consumer only
+    awaits their output, so one event loop can serve many sockets. Each
+    answer streams from a task of its own, which keeps receive() free to
+    see the disconnect and cancel the generation.
+    """
+
     async def connect(self):
+        self.generation = None
+        self.cancel_event = None
         await self.accept()
 
     async def disconnect(self, close_code):
-        pass
+        # The event stops the worker at its next token even before the
+        # task gets to handle its cancellation
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+        if self.generation is not None and not self.generation.done():
+            self.generation.cancel()
 
     async def receive(self, text_data):
         prompt = text_data.strip()
         if not prompt:
             await self.send(text_data="Error: Empty prompt received.")
             return
+        if self.generation is not None and not self.generation.done():
+            await self.send(text_data="Error: A response is already in progress.")
+            return
+        self.cancel_event = threading.Event()
+        self.generation = asyncio.ensure_future(self.stream_response(prompt, self.cancel_event))
 
+    def get_user_key(self):
+        user = self.scope.get('user')
+        if user is not None and user.is_authenticated:
+            return f"user:{user.id}"
+        return f"channel:{self.channel_name}"
+
+    async def stream_response(self, prompt, cancel_event):
+        # The semantic lookup embeds the prompt, so keep it off the loop
+        user_key = self.get_user_key()
+        cached = await sync_to_async(cached_response, thread_sensitive=False)(prompt, user_key)
+        if cached is not None:
+            chunks = iterate(replay_chunks(cached))
+        else:
+            try:
+                job = submit_prompt(prompt, 2000, user_key=user_key, cancel_event=cancel_event)
+            except InferenceBusy as e:
+                await self.send(text_data=f"Error: {e} Retry in {e.retry_after} seconds.")
+                return
+            chunks = AsklamaStreamAsync(prompt, 2000, job=job, cancel_event=cancel_event)
+
+        frames = coalesce(
+            chunks,
+            interval=getattr(settings, 'CHAT_WS_FRAME_INTERVAL', DEFAULT_FRAME_INTERVAL),
+            max_chars=getattr(settings, 'CHAT_WS_FRAME_CHARS', DEFAULT_FRAME_CHARS),
+        )
         try:
-            async for token in self.stream_response(prompt):
-                await self.send(text_data=token)
+            async for frame in frames:
+                await self.send(text_data=frame)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             await self.send(text_data=f"Error: {str(e)}")
-
-    async def stream_response(self, prompt):
-        for token in Asklama(prompt, 2000):
-            await asyncio.sleep(0)  # Allow other tasks to run
-            yield token
+        finally:
+            await frames.aclose()
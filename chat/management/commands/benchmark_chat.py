@@ -0,0 +1,295 @@
+"""
+End-to-end chatbot benchmark: replays a corpus of medical questions through
+AsklamaStream (or Asklama) at several levels of concurrency and reports
+time to first token, throughput, latency percentiles and peak memory.
+
+Each run uses one model configuration. Write the results with --output and
+run once per model file, quantization, n_ctx or thread count to compare
+them, or use --backend openai to measure a model server. --fake (no model
+file) or --model with a tiny GGUF keeps it usable in CI on a CPU-only box.
+"""
+import json
+import os
+import platform
+import queue
+import resource
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+DEFAULT_CORPUS = [
+    "What are the early symptoms of chronic kidney disease?",
+    "What is a normal blood pressure for an adult?",
+    "How should I manage a mild fever at home?",
+    "What are the side effects of metformin?",
+    "When should I see a doctor about a persistent cough?",
+    "How can I lower my cholesterol without medication?",
+    "What is the difference between type 1 and type 2 diabetes?",
+    "Is it safe to take ibuprofen and paracetamol together?",
+    "What are the warning signs of a stroke?",
+    "How much water should I drink each day?",
+    "What causes frequent headaches in the afternoon?",
+    "How long does a common cold usually last?",
+    "What should I eat after a bout of food poisoning?",
+    "What are the symptoms of iron deficiency anemia?",
+    "How can I improve my sleep if I wake up at night?",
+    "What vaccinations do adults over 50 need?",
+]
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list, or None if it is empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(values, scale=1.0, digits=1):
+    return {
+        name: round(value * scale, digits) if value is not None else None
+        for name, value in (
+            ('mean', sum(values) / len(values) if values else None),
+            ('p50', percentile(values, 0.5)),
+            ('p95', percentile(values, 0.95)),
+            ('p99', percentile(values, 0.99)),
+        )
+    }
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process and of its finished or waited-for children"""
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    unit = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    return {'self': own, 'children': children}
+
+
+class Command(BaseCommand):
+    help = "Replay medical prompts through the chatbot and report TTFT, tokens/s, latency percentiles and peak RSS"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', help='File with one prompt per line, or a JSON list of prompts')
+        parser.add_argument('--concurrency', default='1,4',
+                            help='Comma-separated numbers of concurrent clients')
+        parser.add_argument('--requests', type=int,
+                            help='Requests per concurrency level (default: one per corpus prompt)')
+        parser.add_argument('--max-tokens', type=int, default=128, help='max_tokens of every request')
+        parser.add_argument('--api', choices=['stream', 'complete'], default='stream',
+                            help='Call AsklamaStream (with TTFT) or Asklama')
+        parser.add_argument('--model', help='GGUF file to load instead of LLAMA_MODEL_PATH')
+        parser.add_argument('--n-ctx', type=int, help='Context size per sequence (LLAMA_N_CTX)')
+        parser.add_argument('--n-threads', type=int, help='CPU threads per model (LLAMA_N_THREADS)')
+        parser.add_argument('--backend', choices=['llama', 'openai', 'fake'],
+                            help='Chat model backend (CHAT_BACKEND)')
+        parser.add_argument('--mode', choices=['thread', 'process', 'batch'],
+                            help='Inference pool mode of the llama backend (INFERENCE_MODE)')
+        parser.add_argument('--workers', type=int, help='Inference workers (INFERENCE_WORKERS)')
+        parser.add_argument('--fake', action='store_true',
+                            help='Same as --backend fake, e.g. in CI')
+        parser.add_argument('--fake-token-seconds', type=float,
+                            help='Delay per token of the fake backend (INFERENCE_FAKE_TOKEN_SECONDS)')
+        parser.add_argument('--label', help='Name of this run in the results (default: model file name)')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        prompts = self.load_corpus(options['corpus'])
+        levels = [int(n) for n in options['concurrency'].split(',')]
+        self.configure(options, max(levels))
+
+        from chat.modules.ai import model_status
+        from chat.modules.inference import get_inference_pool
+
+        started = time.perf_counter()
+        pool = get_inference_pool().start()
+        if not pool.wait_ready(timeout=600):
+            raise CommandError("The inference workers did not become ready within 10 minutes; see the log")
+        load_seconds = time.perf_counter() - started
+
+        status = model_status()
+        if status['model_path']:
+            default_label = Path(status['model_path']).name
+        elif pool.mode == 'http':
+            default_label = getattr(settings, 'CHAT_OPENAI_MODEL', 'local')
+        else:
+            default_label = pool.mode
+        label = options['label'] or default_label
+        self.stdout.write(
+            f"{label}: {pool.mode} mode, {len(pool.slots)} worker(s), loaded in {load_seconds:.1f}s, "
+            f"{options['api']} API, max_tokens {options['max_tokens']}"
+        )
+
+        results = []
+        for concurrency in levels:
+            result = self.run_level(pool, prompts, concurrency, options)
+            results.append(result)
+            self.report(result)
+
+        output = {
+            'label': label,
+            'finished_at': datetime.now(timezone.utc).isoformat(),
+            'config': self.describe(pool, status, options, len(prompts)),
+            'load_seconds': round(load_seconds, 3),
+            'levels': results,
+            'peak_rss_bytes': peak_rss_bytes(),
+        }
+        rss = output['peak_rss_bytes']
+        self.stdout.write(f"  peak RSS {rss['self'] // 2**20} MB (worker processes {rss['children'] // 2**20} MB)")
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(output, indent=2))
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def load_corpus(self, path):
+        if not path:
+            return DEFAULT_CORPUS
+        text = Path(path).read_text()
+        if path.endswith('.json'):
+            prompts = [str(prompt) for prompt in json.loads(text)]
+        else:
+            prompts = [line.strip() for line in text.splitlines() if line.strip()]
+        if not prompts:
+            raise CommandError(f"No prompts in {path}")
+        return prompts
+
+    def configure(self, options, most):
+        """Point the inference pool, created on first use, at this run's model and settings"""
+        overrides = {
+            # Repeated prompts must be generated, not replayed
+            'CHAT_RESPONSE_CACHE': False,
+            'CHAT_MODEL_PRELOAD': False,
+            'INFERENCE_QUEUE_SIZE': max(most, getattr(settings, 'INFERENCE_QUEUE_SIZE', 16)),
+            'INFERENCE_MAX_PER_USER': 1,
+        }
+        if options['fake']:
+            overrides['CHAT_BACKEND'] = 'fake'
+        for option, setting in (('backend', 'CHAT_BACKEND'), ('model', 'LLAMA_MODEL_PATH'),
+                                ('n_ctx', 'LLAMA_N_CTX'), ('n_threads', 'LLAMA_N_THREADS'),
+                                ('mode', 'INFERENCE_MODE'), ('workers', 'INFERENCE_WORKERS'),
+                                ('fake_token_seconds', 'INFERENCE_FAKE_TOKEN_SECONDS')):
+            if options[option] is not None:
+                overrides[setting] = options[option]
+        if overrides.get('CHAT_BACKEND', getattr(settings, 'CHAT_BACKEND', 'llama')) == 'openai':
+            # Concurrent requests to the model server
+            overrides['CHAT_OPENAI_CONNECTIONS'] = options['workers'] or max(
+                most, getattr(settings, 'CHAT_OPENAI_CONNECTIONS', 4))
+        if overrides.get('INFERENCE_MODE', getattr(settings, 'INFERENCE_MODE', 'thread')) == 'batch':
+            overrides['INFERENCE_BATCH_SEQUENCES'] = max(most, getattr(settings, 'INFERENCE_BATCH_SEQUENCES', 8))
+        for name, value in overrides.items():
+            setattr(settings, name, value)
+
+    def run_level(self, pool, prompts, concurrency, options):
+        """Send the corpus from `concurrency` clients at once and collect per-request samples"""
+        count = options['requests'] or len(prompts)
+        work = queue.Queue()
+        for i in range(count):
+            work.put(prompts[i % len(prompts)])
+        samples = []
+        generated_before = pool.metrics()['generated_tokens']
+
+        def client(index):
+            while True:
+                try:
+                    prompt = work.get_nowait()
+                except queue.Empty:
+                    return
+                samples.append(self.request(prompt, options, f"benchmark:{index}"))
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        # Jobs are accounted just after their stream ends
+        while pool.metrics()['running']:
+            time.sleep(0.01)
+        generated = pool.metrics()['generated_tokens'] - generated_before
+        ok = [sample for sample in samples if not sample['error']]
+        ttfts = [sample['ttft'] for sample in ok if sample['ttft'] is not None]
+        rates = [sample['tokens'] / (sample['latency'] - sample['ttft']) for sample in ok
+                 if sample['tokens'] and sample['ttft'] is not None and sample['latency'] > sample['ttft']]
+        return {
+            'concurrency': concurrency,
+            'requests': len(samples),
+            'errors': len(samples) - len(ok),
+            'elapsed_seconds': round(elapsed, 3),
+            'generated_tokens': generated,
+            'tokens_per_second': round(generated / elapsed, 2) if elapsed else None,
+            'requests_per_second': round(len(samples) / elapsed, 3) if elapsed else None,
+            'ttft_ms': summarize(ttfts, 1000),
+            'latency_ms': summarize([sample['latency'] for sample in ok], 1000),
+            'tokens_per_second_per_request': summarize(rates, digits=2),
+            'peak_rss_bytes': peak_rss_bytes(),
+        }
+
+    def request(self, prompt, options, user_key):
+        from chat.modules.ai import Asklama, AsklamaStream, TECHNICAL_DIFFICULTIES, submit_prompt
+
+        max_tokens = options['max_tokens']
+        started = time.perf_counter()
+        if options['api'] == 'complete':
+            answer = Asklama(prompt, max_tokens, user_key=user_key)
+            return {'ttft': None, 'latency': time.perf_counter() - started, 'tokens': None,
+                    'chars': len(answer), 'error': answer.startswith("I apologize")}
+
+        job = submit_prompt(prompt, max_tokens, user_key=user_key)
+        first = None
+        chars = 0
+        error = False
+        for chunk in AsklamaStream(prompt, max_tokens, job=job):
+            if first is None:
+                first = time.perf_counter() - started
+            error = chunk == TECHNICAL_DIFFICULTIES
+            chars += len(chunk)
+        return {'ttft': first, 'latency': time.perf_counter() - started, 'tokens': job.tokens,
+                'chars': chars, 'error': error or job.error is not None}
+
+    def describe(self, pool, status, options, corpus_size):
+        """Everything that distinguishes this run from another one"""
+        from chat.modules import ai
+
+        metadata = getattr(ai._llama_model, 'metadata', None) or {}
+        try:
+            import llama_cpp
+            llama_cpp_version = llama_cpp.__version__
+        except ImportError:
+            llama_cpp_version = None
+        return {
+            'backend': getattr(settings, 'CHAT_BACKEND', 'llama'),
+            'mode': pool.mode,
+            'workers': len(pool.slots),
+            'capacity': pool.capacity,
+            'api': options['api'],
+            'max_tokens': options['max_tokens'],
+            'corpus_size': corpus_size,
+            'model_path': status['model_path'],
+            'model_file_bytes': status['model_file_bytes'],
+            'model_name': metadata.get('general.name'),
+            # llama.cpp's quantization id, e.g. 15 = Q4_K_M, 17 = Q5_K_M
+            'model_file_type': metadata.get('general.file_type'),
+            'n_ctx': getattr(settings, 'LLAMA_N_CTX', None),
+            'n_threads': getattr(settings, 'LLAMA_N_THREADS', None),
+            'gpu_layers': status['n_gpu_layers'],
+            'llama_cpp_version': llama_cpp_version,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+        }
+
+    def report(self, result):
+        ttft, latency = result['ttft_ms'], result['latency_ms']
+        self.stdout.write(
+            f"  {result['concurrency']:>3} client(s): {result['requests']} requests "
+            f"({result['errors']} failed) in {result['elapsed_seconds']:.2f}s, "
+            f"{result['tokens_per_second']} tok/s aggregate"
+        )
+        if ttft['p50'] is not None:
+            self.stdout.write(f"      TTFT ms     p50 {ttft['p50']}  p95 {ttft['p95']}  p99 {ttft['p99']}")
+        self.stdout.write(f"      latency ms  p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}")
@@ -0,0 +1,96 @@
+"""
+Aggregate generation throughput of the inference pool at several levels of
+concurrency, e.g. one model instance serving clients one after another
+(thread mode) against continuous batching (batch mode), with and without
+the prefix cache for the shared medical preamble.
+"""
+import threading
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.modules.ai import build_prompt, generation_params
+from chat.modules.inference import InferencePool
+
+SAMPLE_QUESTIONS = [
+    "What are the early symptoms of chronic kidney disease?",
+    "What is a normal blood pressure for an adult?",
+    "How should I manage a mild fever at home?",
+    "What are the side effects of metformin?",
+]
+
+
+class Command(BaseCommand):
+    help = "Measure tokens/second of the inference pool at 1, 4 and 16 concurrent clients"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', default='1,4,16',
+                            help='Comma-separated numbers of concurrent clients')
+        parser.add_argument('--tokens', type=int, default=64,
+                            help='Tokens to generate per client')
+        parser.add_argument('--modes', default='thread,batch',
+                            help='Comma-separated pool modes to compare')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Model instances (thread) or batch contexts (batch)')
+        parser.add_argument('--prefix-cache', choices=['on', 'off', 'both'], default='both',
+                            help='Run with the preamble KV cache, without it, or both to compare TTFT')
+
+    def handle(self, *args, **options):
+        clients = [int(n) for n in options['clients'].split(',')]
+        prefix_cache = {'on': [True], 'off': [False], 'both': [False, True]}[options['prefix_cache']]
+
+        for mode in options['modes'].split(','):
+            for cached in prefix_cache:
+                self.run_mode(mode, cached, clients, options)
+
+    def run_mode(self, mode, prefix_cache, clients, options):
+        most = max(clients)
+        pool = InferencePool(
+            workers=options['workers'], mode=mode, queue_size=most, max_per_user=most,
+            batch_config={
+                'sequences': most,
+                'n_ctx': max(getattr(settings, 'INFERENCE_BATCH_CTX', 8192), most * 256),
+                'n_ctx_seq': getattr(settings, 'LLAMA_N_CTX', 2048),
+            },
+            prefix_cache=prefix_cache,
+        )
+        pool.start().wait_ready()
+        self.stdout.write(
+            f"{mode} mode ({options['workers']} worker(s), prefix cache {'on' if prefix_cache else 'off'}):"
+        )
+        for count in clients:
+            tokens, elapsed, first_token = self.run_clients(pool, count, options['tokens'])
+            self.stdout.write(
+                f"  {count:>3} client(s): {tokens:>6} tokens in {elapsed:6.2f}s  "
+                f"{tokens / elapsed:8.1f} tok/s aggregate  "
+                f"{tokens / elapsed / count:7.1f} tok/s per client  "
+                f"first token after {first_token * 1000:.0f} ms (mean)"
+            )
+        metrics = pool.metrics()
+        if metrics['prompt_tokens']:
+            self.stdout.write(
+                f"  prompt tokens from the prefix cache: {metrics['cached_prompt_tokens']} "
+                f"of {metrics['prompt_tokens']}"
+            )
+
+    def run_clients(self, pool, count, max_tokens):
+        """Start `count` generations at once and wait for all of them"""
+        # No stop strings, so every client generates the full budget unless the model ends
+        params = dict(generation_params(max_tokens), stop=[])
+        first_tokens = []
+
+        def client(job):
+            for index, _ in enumerate(job.stream()):
+                if index == 0:
+                    first_tokens.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        jobs = [pool.submit(build_prompt(SAMPLE_QUESTIONS[i % len(SAMPLE_QUESTIONS)]), params, user_key=i)
+                for i in range(count)]
+        threads = [threading.Thread(target=client, args=(job,)) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        mean_first = sum(first_tokens) / len(first_tokens) if first_tokens else 0.0
+        return sum(job.tokens for job in jobs), elapsed, mean_first
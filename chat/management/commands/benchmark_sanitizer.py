@@ -0,0 +1,69 @@
+"""
+Per-token cost of cleaning a streamed answer with StreamSanitizer, against
+cleaning the finished answer once with sanitize(), on long responses split
+into token-sized chunks.
+"""
+import re
+import time
+from django.core.management.base import BaseCommand
+from chat.modules.sanitizer import StreamSanitizer, sanitize
+
+SAMPLE_ANSWER = (
+    "Medical assistant: Chronic kidney disease often has **no symptoms** in its early stages. "
+    "As it progresses you may notice <b>fatigue</b>, swelling in the *ankles* or feet, and changes "
+    "in how often you urinate. See [the NHS guide](https://www.nhs.uk/conditions/kidney-disease/) "
+    "for more.\n\n\n"
+    "* Keep your blood pressure below 130/80\n"
+    "* Limit salt to about 5 g a day\n\n"
+    "Please consult a healthcare professional if you notice any of these signs. "
+)
+# Roughly the size of llama tokens: a few characters with their leading space
+TOKEN_CHUNKS = re.compile(r'\s?[^\s]{1,4}|\s')
+
+
+class Command(BaseCommand):
+    help = "Measure the per-token overhead of the streaming output sanitizer"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chars', type=int, default=8000,
+                            help='Length of the synthetic answer in characters')
+        parser.add_argument('--runs', type=int, default=20,
+                            help='Times to clean the answer')
+
+    def handle(self, *args, **options):
+        text = (SAMPLE_ANSWER * (options['chars'] // len(SAMPLE_ANSWER) + 1))[:options['chars']]
+        chunks = TOKEN_CHUNKS.findall(text)
+        runs = options['runs']
+
+        per_token = []
+        streamed = None
+        started = time.perf_counter()
+        for _ in range(runs):
+            sanitizer = StreamSanitizer()
+            parts = []
+            for chunk in chunks:
+                fed = time.perf_counter()
+                parts.append(sanitizer.feed(chunk))
+                per_token.append(time.perf_counter() - fed)
+            parts.append(sanitizer.close())
+            streamed = ''.join(parts)
+        stream_seconds = (time.perf_counter() - started) / runs
+
+        started = time.perf_counter()
+        for _ in range(runs):
+            whole = sanitize(text)
+        batch_seconds = (time.perf_counter() - started) / runs
+
+        per_token.sort()
+        self.stdout.write(f"{len(text)} characters in {len(chunks)} chunks, {runs} run(s)")
+        self.stdout.write(
+            f"  stream: {stream_seconds * 1000:8.2f} ms per answer  "
+            f"{stream_seconds / len(chunks) * 1e6:6.1f} us per token (mean)  "
+            f"{per_token[len(per_token) // 2] * 1e6:6.1f} us p50  "
+            f"{per_token[int(len(per_token) * 0.99)] * 1e6:6.1f} us p99"
+        )
+        self.stdout.write(f"  batch:  {batch_seconds * 1000:8.2f} ms per answer")
+        if streamed == whole:
+            self.stdout.write(self.style.SUCCESS("  streamed output matches sanitize()"))
+        else:
+            self.stdout.write(self.style.ERROR("  streamed output differs from sanitize()"))
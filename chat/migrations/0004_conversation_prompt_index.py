@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-17 11:40
+
+import main.fields
+from django.db import migrations
+
+
+def populate_prompt_index(apps, schema_editor):
+    """Compute blind indexes for conversations saved before the column existed"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    field = Conversation._meta.get_field('prompt_index')
+    batch = []
+    for conversation in Conversation.objects.iterator(chunk_size=500):
+        conversation.prompt_index = field.compute_index(conversation.prompt)
+        batch.append(conversation)
+        if len(batch) >= 500:
+            Conversation.objects.bulk_update(batch, ['prompt_index'])
+            batch = []
+    if batch:
+        Conversation.objects.bulk_update(batch, ['prompt_index'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_alter_conversation_options_conversation_created_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='prompt_index',
+            field=main.fields.BlindIndexField(source='prompt'),
+        ),
+        migrations.RunPython(populate_prompt_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_conversation_token_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='inference_trace',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -1,7 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
-from main.fields import EncryptedTextField
+from main.fields import EncryptedTextField, EncryptedQuerySet, BlindIndexField
 import uuid
 
 class ChatSession(models.Model):
@@ -28,9 +28,17 @@ class Conversation(models.Model):
     session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='conversations')
     # Encrypted fields for HIPAA compliance - chat may contain PHI
     prompt = EncryptedTextField(help_text="Encrypted user prompt")
+    prompt_index = BlindIndexField(source='prompt')
     response = EncryptedTextField(help_text="Encrypted AI response")
+    # Token counts for the chat history window, filled in on first use
+    prompt_tokens = models.PositiveIntegerField(null=True, blank=True)
+    response_tokens = models.PositiveIntegerField(null=True, blank=True)
+    # Timings and token counts of the generation (CHAT_INFERENCE_TRACE), never text
+    inference_trace = models.JSONField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    objects = EncryptedQuerySet.as_manager()
+    
     class Meta:
         ordering = ['created_at']
         verbose_name = 'Conversation'
@@ -1,228 +1,344 @@
+import asyncio
+import logging
 import os
+import subprocess
+import threading
+import time
 from pathlib import Path
+from django.conf import settings
+from .context import TURN_TEMPLATE
+from .inference import InferenceBusy
+from .response_cache import get_response_cache
+from .sanitizer import StreamSanitizer, sanitize
 
-# Initialize Llama model (lazy loading)
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+DEFAULT_MODEL_PATHS = [
+    BASE_DIR / "models" / "llama-2-7b.Q5_K_M.gguf",
+    BASE_DIR / "models" / "llamaModel.gguf",
+    Path("models/llama-2-7b.Q5_K_M.gguf"),
+    Path("models/llamaModel.gguf"),
+]
+
+# Model lifecycle: loaded once per process, either by the startup warm-up
+# (medconnect.wsgi / medconnect.asgi) or by the first chat request
 _llama_model = None
+_model_pid = None  # process that loaded _llama_model
+_model_lock = threading.Lock()
+_model_status = {
+    'state': 'unloaded',  # unloaded -> loading -> ready | failed
+    'model_path': None,
+    'gpu': None,
+    'n_gpu_layers': None,
+    'load_seconds': None,
+    'warmup_seconds': None,
+    'model_file_bytes': None,
+    'rss_delta_bytes': None,
+    'error': None,
+}
+_gpu_probe = None
 
-def get_llama_model():
+
+def probe_gpu():
     """
-    Get or initialize the local Llama model.
-    Uses lazy loading to avoid loading the model on import.
+    Whether GPU offload is available. Probed once per process: llama-cpp's
+    own build flag when it has one, nvidia-smi otherwise.
     """
-    global _llama_model
-    
-    if _llama_model is None:
+    global _gpu_probe
+    if _gpu_probe is not None:
+        return _gpu_probe
+
+    available = False
+    try:
+        import llama_cpp
+        if hasattr(llama_cpp, 'llama_supports_gpu_offload'):
+            available = bool(llama_cpp.llama_supports_gpu_offload())
+        else:
+            result = subprocess.run(['nvidia-smi'], capture_output=True, text=True, timeout=5)
+            available = result.returncode == 0
+    except Exception:
+        available = False
+    _gpu_probe = available
+    logger.info("GPU offload %s", "available" if available else "not available, using CPU")
+    return available
+
+
+def find_model_path():
+    configured = getattr(settings, 'LLAMA_MODEL_PATH', None)
+    candidates = [Path(configured)] if configured else DEFAULT_MODEL_PATHS
+    for path in candidates:
+        if path.exists():
+            return str(path)
+    raise FileNotFoundError(
+        "Llama model file not found. Please ensure the model file exists in the 'models' directory."
+    )
+
+
+def _rss_bytes():
+    """Resident set size of this process, or None where it cannot be read"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _create_llama(model_path, n_gpu_layers):
+    from llama_cpp import Llama
+
+    return Llama(
+        model_path=model_path,
+        verbose=False,
+        n_gpu_layers=n_gpu_layers,  # -1 = all layers on GPU, 0 = CPU only
+        n_ctx=getattr(settings, 'LLAMA_N_CTX', 2048),
+        n_threads=getattr(settings, 'LLAMA_N_THREADS', None),  # None = all available CPU threads
+    )
+
+
+def load_model(warm_up=True):
+    """
+    Load the model (once per process) and optionally run a one-token
+    generation so the first real request does not pay for lazy allocations.
+
+    Returns:
+        The Llama instance
+    """
+    global _llama_model, _model_pid
+
+    # A forked child loads its own: the parent's contexts may have been
+    # mid-decode in a thread that did not survive the fork
+    if _llama_model is not None and _model_pid == os.getpid():
+        return _llama_model
+
+    with _model_lock:
+        if _llama_model is not None and _model_pid == os.getpid():
+            return _llama_model
+        _model_status.update(state='loading', error=None)
         try:
-            from llama_cpp import Llama
-            
-            # Get model path - check multiple locations
-            base_dir = Path(__file__).resolve().parent.parent.parent
-            model_paths = [
-                base_dir / "models" / "llama-2-7b.Q5_K_M.gguf",
-                base_dir / "models" / "llamaModel.gguf",
-                Path("models/llama-2-7b.Q5_K_M.gguf"),
-                Path("models/llamaModel.gguf"),
-            ]
-            
-            # Try to find the model file
-            model_path = None
-            for path in model_paths:
-                if path.exists():
-                    model_path = str(path)
-                    break
-            
-            if not model_path:
-                raise FileNotFoundError(
-                    "Llama model file not found. Please ensure the model file exists in the 'models' directory."
-                )
-            
-            # Initialize Llama model with GPU support
-            # n_gpu_layers: Set to -1 to use all available GPU layers, or 0 for CPU-only
-            # For GPU: Set to -1 (all layers) or a specific number (e.g., 30)
-            
-            # Check for CUDA/GPU availability
             try:
-                import subprocess
-                result = subprocess.run(['nvidia-smi'], capture_output=True, text=True, timeout=5)
-                if result.returncode == 0:
-                    print("✓ NVIDIA GPU detected via nvidia-smi")
-                    gpu_available = True
-                else:
-                    gpu_available = False
-                    print("⚠ nvidia-smi not available - GPU may not be accessible")
-            except (FileNotFoundError, subprocess.TimeoutExpired, Exception):
-                gpu_available = False
-                print("⚠ Could not verify GPU via nvidia-smi - will attempt GPU loading anyway")
-            
-            try:
-                # Try GPU first (n_gpu_layers=-1 means use all GPU layers)
-                # If GPU is not available, it will fall back to CPU
-                print("🔄 Initializing Llama model with GPU support (n_gpu_layers=-1)...")
-                _llama_model = Llama(
-                    model_path=model_path,
-                    verbose=False,  # Set to True for debugging
-                    n_gpu_layers=-1,  # Use all available GPU layers (-1 = all, 0 = CPU only)
-                    n_ctx=2048,  # Context window size
-                    n_threads=None,  # Use all available CPU threads (for CPU fallback)
+                import llama_cpp  # noqa: F401
+            except ImportError:
+                raise ImportError(
+                    "llama-cpp-python is not installed.\n"
+                    "To install on Windows, you need to:\n"
+                    "1. Install Visual Studio Build Tools: https://visualstudio.microsoft.com/downloads/\n"
+                    "   (Select 'Desktop development with C++' workload)\n"
+                    "2. Then run: pip install llama-cpp-python\n"
+                    "\n"
+                    "Alternatively, you can try installing a pre-built wheel if available."
                 )
-                
-                # Verify GPU usage by checking model metadata
-                # The model object should have GPU layers loaded if GPU is working
-                print(f"✓ Local Llama model loaded successfully from: {model_path}")
-                print(f"  GPU layers: All available (n_gpu_layers=-1)")
-                
-                # Additional verification - check if we can get GPU info
-                try:
-                    # Try to access internal GPU state (if available)
-                    if hasattr(_llama_model, '_ctx') and _llama_model._ctx:
-                        print("  ✓ Model context initialized - GPU acceleration enabled")
-                    else:
-                        print("  ⚠ Could not verify GPU context - may be using CPU")
-                    
-                    # Check if CUDA is actually being used
-                    try:
-                        import llama_cpp
-                        # Check for CUDA support in the library
-                        if hasattr(llama_cpp, 'llama_cpp_has_cuda'):
-                            cuda_available = llama_cpp.llama_cpp_has_cuda()
-                            if cuda_available:
-                                print("  ✓ CUDA support confirmed in llama-cpp-python")
-                            else:
-                                print("  ⚠ CUDA not available in llama-cpp-python - using CPU")
-                                print("     To enable GPU, reinstall with: pip install llama-cpp-python --extra-index-url https://abetlen.github.io/llama-cpp-python/whl/cu121")
-                        else:
-                            # Try alternative check
-                            if hasattr(_llama_model, 'n_gpu_layers'):
-                                gpu_layers = _llama_model.n_gpu_layers
-                                if gpu_layers > 0:
-                                    print(f"  ✓ GPU layers active: {gpu_layers} layers on GPU")
-                                else:
-                                    print("  ⚠ No GPU layers detected - running on CPU")
-                    except Exception as e:
-                        print(f"  ℹ Could not verify GPU status: {e}")
-                except:
-                    pass
-                    
+
+            model_path = find_model_path()
+            gpu = probe_gpu()
+            n_gpu_layers = getattr(settings, 'LLAMA_N_GPU_LAYERS', -1) if gpu else 0
+
+            rss_before = _rss_bytes()
+            started = time.perf_counter()
+            try:
+                model = _create_llama(model_path, n_gpu_layers)
             except Exception as e:
                 error_msg = str(e)
-                if "CUDA" in error_msg or "GPU" in error_msg or "cublas" in error_msg.lower():
-                    print(f"⚠ GPU initialization failed: {error_msg}")
-                    print("  Attempting to load with CPU fallback...")
-                    # Fallback to CPU
-                    _llama_model = Llama(
-                        model_path=model_path,
-                        verbose=False,
-                        n_gpu_layers=0,  # Force CPU
-                        n_ctx=2048,
-                        n_threads=None,
-                    )
-                    print("  ✓ Model loaded in CPU mode")
+                if n_gpu_layers and ("CUDA" in error_msg or "GPU" in error_msg or "cublas" in error_msg.lower()):
+                    logger.warning("GPU initialization failed (%s), falling back to CPU", error_msg)
+                    n_gpu_layers = 0
+                    model = _create_llama(model_path, n_gpu_layers)
                 else:
                     raise Exception(f"Failed to load Llama model: {e}")
-                
-        except ImportError:
-            raise ImportError(
-                "llama-cpp-python is not installed.\n"
-                "To install on Windows, you need to:\n"
-                "1. Install Visual Studio Build Tools: https://visualstudio.microsoft.com/downloads/\n"
-                "   (Select 'Desktop development with C++' workload)\n"
-                "2. Then run: pip install llama-cpp-python\n"
-                "\n"
-                "Alternatively, you can try installing a pre-built wheel if available."
+            load_seconds = time.perf_counter() - started
+
+            warmup_seconds = None
+            if warm_up:
+                started = time.perf_counter()
+                model("Hello", max_tokens=1, temperature=0.0)
+                warmup_seconds = time.perf_counter() - started
+
+            rss_after = _rss_bytes()
+            _model_status.update(
+                state='ready',
+                model_path=model_path,
+                gpu=bool(n_gpu_layers),
+                n_gpu_layers=n_gpu_layers,
+                load_seconds=round(load_seconds, 3),
+                warmup_seconds=round(warmup_seconds, 3) if warmup_seconds is not None else None,
+                model_file_bytes=os.path.getsize(model_path),
+                rss_delta_bytes=rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+            )
+            logger.info(
+                "Loaded %s in %.1fs (warm-up %s, %s GPU layers, RSS +%s MB)",
+                model_path, load_seconds,
+                f"{warmup_seconds:.2f}s" if warmup_seconds is not None else "skipped",
+                n_gpu_layers,
+                (_model_status['rss_delta_bytes'] or 0) // (1024 * 1024),
             )
-    
+            _llama_model = model
+            _model_pid = os.getpid()
+        except Exception as e:
+            _model_status.update(state='failed', error=str(e))
+            raise
     return _llama_model
 
-def Asklama(prompt, tokens):
+
+def load_extra_model():
+    """
+    Another instance of the loaded model for an additional inference worker.
+    Weights are mmapped, so this mostly costs the instance's KV cache.
+    """
+    load_model()
+    return _create_llama(_model_status['model_path'], _model_status['n_gpu_layers'])
+
+
+def get_llama_model():
+    """
+    Get the local Llama model, loading it on first use if the startup
+    warm-up has not already done so.
     """
-    Sends a prompt to the local Llama model with enforced medical context.
+    return load_model()
+
+
+def model_status():
+    """Snapshot of the model lifecycle state, load time, memory use and queue"""
+    from .inference import get_inference_pool
+
+    cache = get_response_cache()
+    return dict(
+        _model_status, backend=getattr(settings, 'CHAT_BACKEND', 'llama'), gpu_probe=_gpu_probe,
+        inference=get_inference_pool().metrics(),
+        response_cache=cache.metrics() if cache is not None else None,
+    )
+
+
+def is_model_ready():
+    """True once at least one inference worker has its model loaded"""
+    from .inference import get_inference_pool
+
+    return get_inference_pool().is_ready()
+
+
+def should_preload():
+    """
+    Whether to load the model at startup. Only the WSGI and ASGI entry points
+    ask, so management commands, the shell and tests never load it.
+    """
+    return getattr(settings, 'CHAT_MODEL_PRELOAD', False)
+
+
+def start_model_warmup():
+    """
+    Start the inference workers, which load and warm up their models in
+    background threads (or processes) so the worker can serve other pages
+    meanwhile. Readiness is reported by is_model_ready() and the
+    chat:model_ready endpoint.
+    """
+    from .inference import get_inference_pool
+
+    return get_inference_pool().start()
+
+
+MEDICAL_CONTEXT = (
+    "You are a professional medical assistant. Provide helpful, clear, and accurate medical information. "
+    "Give practical advice and always remind users to consult healthcare professionals for serious concerns. "
+    "Keep responses concise but informative. Do not use HTML tags, markdown, or special formatting. "
+    "Write in plain text only.\n\n"
+)
+# Shared by every prompt; the inference workers evaluate it once and reuse its KV cache
+PROMPT_PREFIX = MEDICAL_CONTEXT + "Patient question: "
+RESPONSE_STOP = ["Patient question:", "User question:", "Q:", "A:", "Medical assistant response:", "Medical assistant:", "<details>", "</details>", "<summary>", "</summary>", "<b>", "</b>", "\n\n\n"]
+STREAM_STOP = ["Patient question:", "User question:", "Q:", "A:", "<details>", "</details>", "<summary>", "</summary>", "<b>", "</b>", "\n\n\n"]
+
+
+def clean_question(prompt):
+    # Clean the prompt - remove any Q: A: formatting that might confuse the model
+    return prompt.replace("Q:", "").replace("A:", "").strip()
+
+
+def build_prompt(prompt, history=()):
+    """
+    Wrap a user question in the enforced medical context, after the earlier
+    turns of its conversation (see context.build_history)
+    """
+    turns = "".join(
+        TURN_TEMPLATE.format(prompt=clean_question(question), response=answer) for question, answer in history
+    )
+    return PROMPT_PREFIX + turns + clean_question(prompt) + "\n\nMedical assistant response:"
+
+
+def generation_params(tokens, stop=STREAM_STOP):
+    """Sampling parameters for a chat answer of at most `tokens` tokens"""
+    return dict(
+        max_tokens=min(tokens, 2000),  # Cap at 2000 tokens
+        temperature=0.7,   # Sampling temperature for randomness
+        top_p=0.9,         # Nucleus sampling
+        top_k=40,          # Top-k sampling
+        repeat_penalty=1.1,  # Repetition penalty
+        stop=stop,
+        echo=False,  # Don't echo the prompt in the output
+    )
+
+
+def _cache_owner(user_key):
+    # Addresses are shared behind NAT and proxies, so they match exactly only
+    if user_key is None or str(user_key).startswith('ip:'):
+        return None
+    return user_key
+
+
+def cached_response(prompt, user_key=None):
+    """A cached answer to this question, or None (also when the cache is off)"""
+    cache = get_response_cache()
+    return cache.get(prompt, owner=_cache_owner(user_key)) if cache is not None else None
+
+
+def cache_response(prompt, response, generation_seconds, user_key=None):
+    cache = get_response_cache()
+    if cache is not None:
+        cache.put(prompt, response, generation_seconds, owner=_cache_owner(user_key))
+
+
+def submit_prompt(prompt, tokens, user_key=None, stop=STREAM_STOP, cancel_event=None, history=(), context_key=None):
+    """
+    Queue a generation on the inference pool. The worker stops at the next
+    token once cancel_event is set. `history` holds the conversation's
+    earlier turns; jobs with the same context_key (a chat session) may reuse
+    each other's KV cache.
+
+    Raises:
+        InferenceBusy: the pool is saturated; tell the client to retry
+    """
+    from .inference import get_inference_pool
+
+    params = generation_params(tokens, stop)
+    return get_inference_pool().submit(
+        build_prompt(prompt, history), params, user_key=user_key, cancel_event=cancel_event, context_key=context_key,
+    )
+
+
+def Asklama(prompt, tokens, user_key=None):
+    """
+    Sends a prompt to the chat model (CHAT_BACKEND) with enforced medical context.
 
     Args:
         prompt (str): The input prompt for the model.
         tokens (int): The maximum number of tokens to generate.
+        user_key: Identifies the requester for per-user queue fairness.
 
     Returns:
         str: The generated text from the model.
+
+    Raises:
+        InferenceBusy: the inference queue is full.
     """
     response = ""
+    full_prompt = build_prompt(prompt)
 
-    # Enforce a medical context in the prompt
-    # Format: Clear instruction + user question
-    medical_context = (
-        "You are a professional medical assistant. Provide helpful, clear, and accurate medical information. "
-        "Give practical advice and always remind users to consult healthcare professionals for serious concerns. "
-        "Keep responses concise but informative. Do not use HTML tags, markdown, or special formatting. "
-        "Write in plain text only.\n\n"
-    )
-    # Clean the prompt - remove any Q: A: formatting that might confuse the model
-    clean_prompt = prompt.replace("Q:", "").replace("A:", "").strip()
-    full_prompt = medical_context + "Patient question: " + clean_prompt + "\n\nMedical assistant response:"
+    cached = cached_response(prompt, user_key)
+    if cached is not None:
+        return cached
 
     try:
-        # Get the local Llama model
-        llama = get_llama_model()
-        
-        if llama is None:
-            raise Exception("Llama model is not available")
-        
-        print(f"Generating response for prompt: {prompt[:50]}...")
-        
-        # Generate response using local model with streaming
-        # Use stream=True to get real-time output
-        response_text = ""
-        try:
-            for output in llama(
-                full_prompt,
-                max_tokens=min(tokens, 2000),  # Cap at 2000 tokens
-                temperature=0.7,   # Sampling temperature for randomness
-                top_p=0.9,         # Nucleus sampling
-                top_k=40,          # Top-k sampling
-                repeat_penalty=1.1,  # Repetition penalty
-                stop=["Patient question:", "User question:", "Q:", "A:", "Medical assistant response:", "Medical assistant:", "<details>", "</details>", "<summary>", "</summary>", "<b>", "</b>", "\n\n\n"],  # Stop sequences
-                echo=False,  # Don't echo the prompt in the output
-                stream=True,  # Stream the output
-            ):
-                # Extract text from streaming output
-                if "choices" in output and len(output["choices"]) > 0:
-                    text = output["choices"][0].get("text", "")
-                    if text:
-                        response_text += text
-        except Exception as stream_error:
-            print(f"Streaming failed: {stream_error}, trying non-streaming...")
-            response_text = ""  # Reset to try non-streaming
-        
-        # If streaming didn't work, try non-streaming
-        if not response_text:
-            print("Streaming returned empty, trying non-streaming mode...")
-            try:
-                output = llama(
-                    full_prompt,
-                    max_tokens=min(tokens, 2000),
-                    temperature=0.7,
-                    top_p=0.9,
-                    top_k=40,
-                    repeat_penalty=1.1,
-                    stop=["Patient question:", "User question:", "Q:", "A:", "Medical assistant response:", "Medical assistant:", "<details>", "</details>", "<summary>", "</summary>", "<b>", "</b>", "\n\n\n"],
-                    echo=False,
-                    stream=False,
-                )
-                
-                # Extract the generated text
-                if "choices" in output and len(output["choices"]) > 0:
-                    response_text = output["choices"][0].get("text", "").strip()
-                elif "text" in output:
-                    response_text = output["text"].strip()
-                else:
-                    print(f"Unexpected output format: {type(output)}")
-                    print(f"Output keys: {output.keys() if isinstance(output, dict) else 'Not a dict'}")
-                    # Try to get text from the output structure
-                    if isinstance(output, dict):
-                        response_text = str(output).strip()
-                    else:
-                        response_text = str(output).strip()
-            except Exception as non_stream_error:
-                print(f"Non-streaming also failed: {non_stream_error}")
-                response_text = ""
+        # Queue the generation on the inference pool and collect the output
+        job = submit_prompt(prompt, tokens, user_key=user_key, stop=RESPONSE_STOP)
+        response_text = "".join(job.stream())
         
         response = response_text.strip() if response_text else ""
         
@@ -230,67 +346,32 @@ def Asklama(prompt, tokens):
         if response:
             # Remove any remaining prompt artifacts (but be careful not to remove too much)
             if full_prompt in response:
-                response = response.replace(full_prompt, "").strip()
-            
-            # Remove HTML tags and special formatting
-            import re
-            # Remove HTML tags
-            response = re.sub(r'<[^>]+>', '', response)
-            # Remove markdown-style formatting
-            response = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', response)  # Remove markdown links
-            response = re.sub(r'\*\*([^\*]+)\*\*', r'\1', response)  # Remove bold
-            response = re.sub(r'\*([^\*]+)\*', r'\1', response)  # Remove italic
-            
-            # Remove HTML tags and special formatting
-            import re
-            # Remove HTML tags
-            response = re.sub(r'<[^>]+>', '', response)
-            # Remove markdown-style formatting
-            response = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', response)  # Remove markdown links
-            response = re.sub(r'\*\*([^\*]+)\*\*', r'\1', response)  # Remove bold
-            response = re.sub(r'\*([^\*]+)\*', r'\1', response)  # Remove italic
+                response = response.replace(full_prompt, "")
+            # Remove HTML tags, markdown, prompt labels and trailing stop sequences
+            response = sanitize(response)
             
-            # Remove prompt prefixes that might appear in the response
-            response = re.sub(r'^Medical assistant response:\s*', '', response, flags=re.IGNORECASE)
-            response = re.sub(r'^Medical assistant:\s*', '', response, flags=re.IGNORECASE)
-            response = re.sub(r'^Assistant response:\s*', '', response, flags=re.IGNORECASE)
-            response = re.sub(r'^Assistant:\s*', '', response, flags=re.IGNORECASE)
-            response = re.sub(r'^Response:\s*', '', response, flags=re.IGNORECASE)
-            # Remove from anywhere in the text (not just beginning)
-            response = re.sub(r'Medical assistant response:\s*', '', response, flags=re.IGNORECASE)
-            response = re.sub(r'Medical assistant:\s*', '', response, flags=re.IGNORECASE)
-            
-            # Remove stop sequences if they appear at the end
-            for stop_seq in ["Patient question:", "User question:", "Q:", "A:", "Medical assistant response:", "Medical assistant:", "<details>", "</details>", "<summary>", "</summary>", "\n\n\n", "\n\n"]:
-                if response.endswith(stop_seq):
-                    response = response[:-len(stop_seq)].strip()
-            
-            # Remove leading/trailing whitespace and normalize
-            response = response.strip()
-            # Remove multiple consecutive newlines
-            response = re.sub(r'\n{3,}', '\n\n', response)
-            
-            print(f"Generated response length: {len(response)} characters")
-            print(f"Response preview: {response[:100]}...")
+            logger.debug("Job %d response: %d characters", job.id, len(response))
             
             # If response is still empty after cleaning, provide a default
             if not response:
                 response = "I apologize, but I couldn't generate a meaningful response. Please try rephrasing your question."
+            elif not job.cancelled.is_set():
+                cache_response(prompt, response, time.monotonic() - job.created, user_key)
         else:
-            print("Warning: Empty response generated from model")
+            logger.warning("Empty response generated by job %d", job.id)
             response = "I apologize, but I couldn't generate a response. Please try rephrasing your question or try again."
         
+    except InferenceBusy:
+        raise
     except FileNotFoundError as e:
-        error_msg = str(e)
-        print(f"Error: {error_msg}")
+        logger.error("Chat model not available: %s", e)
         response = (
             "I apologize, but the AI model file is not found. "
             "Please contact the system administrator. "
             "For urgent medical concerns, please contact a healthcare professional immediately."
         )
     except ImportError as e:
-        error_msg = str(e)
-        print(f"Error: {error_msg}")
+        logger.error("Chat model not available: %s", e)
         response = (
             "I apologize, but the AI system is not properly configured. "
             "Please contact the system administrator. "
@@ -298,10 +379,7 @@ def Asklama(prompt, tokens):
         )
     except Exception as e:
         # Handle and log any other exceptions
-        error_msg = str(e)
-        print(f"Error during AI processing: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error during AI processing: %s", e)
         response = (
             "I apologize, but I'm experiencing technical difficulties. "
             "Please try again in a moment. "
@@ -310,97 +388,121 @@ def Asklama(prompt, tokens):
 
     return response
 
-def AsklamaStream(prompt, tokens):
+def _finish_stream(prompt, job, streamed_text, history):
+    """Log the length of a completed stream and cache what was sent"""
+    logger.debug("Job %d streamed response: %d characters", job.id, len(streamed_text))
+
+    # Cache exactly what the client was sent, for replay to the next asker;
+    # an answer to a follow-up question depends on its conversation
+    if streamed_text and not history and not job.cancelled.is_set():
+        cache_response(prompt, streamed_text, time.monotonic() - job.created, job.user_key)
+
+
+def _aborted(job, cancel_event):
+    """Propagate the caller's cancel_event to the job; True once either is set"""
+    if cancel_event is not None and cancel_event.is_set():
+        job.cancel()
+    return job.cancelled.is_set()
+
+
+TECHNICAL_DIFFICULTIES = "I apologize, but I'm experiencing technical difficulties. Please try again in a moment. For urgent medical concerns, please contact a healthcare professional immediately."
+
+
+def AsklamaStream(prompt, tokens, job=None, user_key=None, cancel_event=None, history=()):
     """
-    Streams responses from the local Llama model with enforced medical context.
+    Streams responses from the chat model (CHAT_BACKEND) with enforced medical context.
     Yields chunks of text as they are generated.
 
     Args:
         prompt (str): The input prompt for the model.
         tokens (int): The maximum number of tokens to generate.
+        job: An InferenceJob already queued with submit_prompt(), so callers
+            can turn InferenceBusy into a 503 before streaming starts.
+        user_key: Identifies the requester for per-user queue fairness.
+        cancel_event: threading.Event the caller sets when the client has
+            gone away; generation stops at the next token and the partial
+            answer is discarded.
+        history: Earlier (prompt, response) turns of the conversation, as
+            given to submit_prompt(); answers to follow-ups are not cached.
 
     Yields:
         str: Chunks of generated text.
+
+    Raises:
+        InferenceBusy: no job was given and the inference queue is full.
     """
-    # Enforce a medical context in the prompt
-    medical_context = (
-        "You are a professional medical assistant. Provide helpful, clear, and accurate medical information. "
-        "Give practical advice and always remind users to consult healthcare professionals for serious concerns. "
-        "Keep responses concise but informative. Do not use HTML tags, markdown, or special formatting. "
-        "Write in plain text only.\n\n"
-    )
-    # Clean the prompt - remove any Q: A: formatting that might confuse the model
-    clean_prompt = prompt.replace("Q:", "").replace("A:", "").strip()
-    full_prompt = medical_context + "Patient question: " + clean_prompt + "\n\nMedical assistant response:"
+    if job is None:
+        job = submit_prompt(prompt, tokens, user_key=user_key, cancel_event=cancel_event, history=history)
 
     try:
-        # Get the local Llama model
-        llama = get_llama_model()
-        
-        if llama is None:
-            raise Exception("Llama model is not available")
-        
-        print(f"Streaming response for prompt: {prompt[:50]}...")
-        
-        # Stream response using local model
-        import re
-        accumulated_text = ""
-        
-        for output in llama(
-            full_prompt,
-            max_tokens=min(tokens, 2000),
-            temperature=0.7,
-            top_p=0.9,
-            top_k=40,
-            repeat_penalty=1.1,
-            stop=["Patient question:", "User question:", "Q:", "A:", "<details>", "</details>", "<summary>", "</summary>", "<b>", "</b>", "\n\n\n"],
-            echo=False,
-            stream=True,
-        ):
-            # Extract text from streaming output
-            if "choices" in output and len(output["choices"]) > 0:
-                text = output["choices"][0].get("text", "")
-                if text:
-                    accumulated_text += text
-                    # Clean HTML tags and prompt prefixes on the fly
-                    cleaned_text = re.sub(r'<[^>]+>', '', text)
-                    # Remove prompt prefixes as they appear
-                    cleaned_text = re.sub(r'Medical assistant response:\s*', '', cleaned_text, flags=re.IGNORECASE)
-                    cleaned_text = re.sub(r'Medical assistant:\s*', '', cleaned_text, flags=re.IGNORECASE)
-                    if cleaned_text:
-                        yield cleaned_text
+        # Stream response from the inference worker
+        sanitizer = StreamSanitizer()
+        streamed_text = ""
         
-        # Final cleanup of accumulated text
-        if accumulated_text:
-            # Remove any remaining HTML tags
-            final_response = re.sub(r'<[^>]+>', '', accumulated_text)
-            # Remove markdown formatting
-            final_response = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', final_response)
-            final_response = re.sub(r'\*\*([^\*]+)\*\*', r'\1', final_response)
-            final_response = re.sub(r'\*([^\*]+)\*', r'\1', final_response)
-            
-            # Remove prompt prefixes that might appear in the response
-            final_response = re.sub(r'^Medical assistant response:\s*', '', final_response, flags=re.IGNORECASE)
-            final_response = re.sub(r'^Medical assistant:\s*', '', final_response, flags=re.IGNORECASE)
-            final_response = re.sub(r'^Assistant response:\s*', '', final_response, flags=re.IGNORECASE)
-            final_response = re.sub(r'^Assistant:\s*', '', final_response, flags=re.IGNORECASE)
-            final_response = re.sub(r'^Response:\s*', '', final_response, flags=re.IGNORECASE)
-            # Remove from anywhere in the text (not just beginning)
-            final_response = re.sub(r'Medical assistant response:\s*', '', final_response, flags=re.IGNORECASE)
-            final_response = re.sub(r'Medical assistant:\s*', '', final_response, flags=re.IGNORECASE)
-            
-            # Remove stop sequences
-            for stop_seq in ["Patient question:", "User question:", "Q:", "A:", "Medical assistant response:", "Medical assistant:", "<details>", "</details>", "<summary>", "</summary>", "<b>", "</b>", "\n\n\n", "\n\n"]:
-                if final_response.endswith(stop_seq):
-                    final_response = final_response[:-len(stop_seq)].strip()
-            
-            # Normalize whitespace
-            final_response = re.sub(r'\n{3,}', '\n\n', final_response).strip()
-            
-            print(f"Streamed response complete: {len(final_response)} characters")
+        for text in job.stream():
+            if _aborted(job, cancel_event):
+                break
+            cleaned_text = sanitizer.feed(text)
+            if cleaned_text:
+                streamed_text += cleaned_text
+                yield cleaned_text
+
+        if _aborted(job, cancel_event):
+            logger.info("Streaming cancelled after %d tokens", job.tokens)
+            return
+        cleaned_text = sanitizer.close()
+        if cleaned_text:
+            streamed_text += cleaned_text
+            yield cleaned_text
+        _finish_stream(prompt, job, streamed_text, history)
         
+    except GeneratorExit:
+        # Client went away; free the worker instead of generating for nobody
+        job.cancel()
+        raise
+    except Exception as e:
+        logger.exception("Error during AI streaming: %s", e)
+        yield TECHNICAL_DIFFICULTIES
+
+
+async def AsklamaStreamAsync(prompt, tokens, job=None, user_key=None, cancel_event=None, history=()):
+    """
+    AsklamaStream for the event loop: the same chunks, awaited from the
+    inference worker without holding a thread while waiting.
+
+    Cancelling the consuming task, closing the generator or setting
+    cancel_event cancels the job.
+
+    Raises:
+        InferenceBusy: no job was given and the inference queue is full.
+    """
+    if job is None:
+        job = submit_prompt(prompt, tokens, user_key=user_key, cancel_event=cancel_event, history=history)
+
+    try:
+        sanitizer = StreamSanitizer()
+        streamed_text = ""
+
+        async for text in job.astream():
+            if _aborted(job, cancel_event):
+                break
+            cleaned_text = sanitizer.feed(text)
+            if cleaned_text:
+                streamed_text += cleaned_text
+                yield cleaned_text
+
+        if _aborted(job, cancel_event):
+            logger.info("Streaming cancelled after %d tokens", job.tokens)
+            return
+        cleaned_text = sanitizer.close()
+        if cleaned_text:
+            streamed_text += cleaned_text
+            yield cleaned_text
+        _finish_stream(prompt, job, streamed_text, history)
+
+    except (GeneratorExit, asyncio.CancelledError):
+        job.cancel()
+        raise
     except Exception as e:
-        print(f"Error during AI streaming: {e}")
-        import traceback
-        traceback.print_exc()
-        yield "I apologize, but I'm experiencing technical difficulties. Please try again in a moment. For urgent medical concerns, please contact a healthcare professional immediately."
+        logger.exception("Error during AI streaming: %s", e)
+        yield TECHNICAL_DIFFICULTIES
@@ -0,0 +1,418 @@
+"""
+Continuous batching for the local Llama model.
+
+A BatchSlot serves many InferenceJobs from one llama.cpp context with
+several sequences (n_seq_max). Every step of its loop builds a single batch
+holding the next token of each generating sequence plus a chunk of any newly
+admitted prompt, evaluates it with one llama_decode call, samples each
+sequence from its own logits row and pushes the decoded text into that job's
+stream. Jobs join and leave between steps, so a new question does not wait
+for the longest answer in flight, and the cost of streaming the weights
+through the CPU is shared by every sequence in the step.
+
+Every chat prompt starts with the same medical preamble. With prefix_cache
+it is evaluated once at load into a reserved sequence, and each new job
+starts from a copy of that sequence (llama_memory_seq_cp shares the KV
+cells rather than duplicating them), so only the user's question is
+prefilled.
+
+Follow-up questions repeat their conversation's history (see context.py),
+so each prompt of a chat session starts with the previous prompt and most
+of its answer. When a job with a context_key finishes, its sequence is
+parked instead of cleared: the KV cells stay, and the session's next job
+continues from the longest common prefix of its tokens. Parked sequences
+only use idle sequence ids and spare cells; they are dropped, oldest
+first, whenever a new job needs either.
+
+The KV cache is unified: all sequences share INFERENCE_BATCH_CTX cells and
+each one is limited to LLAMA_N_CTX positions. New jobs are only admitted
+while there is room for their prompt; if the cache still runs out, the
+longest running answer is ended early, as if it had hit max_tokens.
+"""
+import codecs
+import ctypes
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Repetition penalty window, as llama_cpp.Llama's last_n_tokens_size
+LAST_N_TOKENS = 64
+
+
+class Sequence:
+    """One job's state inside the shared batch"""
+
+    def __init__(self, seq_id, job, tokens, sampler, n_cached=0, n_shared=None):
+        self.seq_id = seq_id
+        self.job = job
+        self.tokens = tokens  # prompt and sampled tokens, evaluated up to n_past
+        self.pending = tokens[n_cached:]  # prompt tokens not evaluated yet
+        self.n_past = n_cached  # positions already in the KV cache
+        self.n_cached = n_cached  # of which were there on admission
+        self.n_shared = n_cached if n_shared is None else n_shared  # cells shared with the prefix sequence
+        self.next_token = None  # sampled token to evaluate in the next step
+        self.in_batch = 0
+        self.logits_index = None
+        self.generated = 0
+        self.max_tokens = job.params.get('max_tokens') or 16
+        self.stop = [stop for stop in job.params.get('stop') or [] if stop]
+        self.sampler = sampler
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self._text = ''  # decoded text held back while it could start a stop string
+
+    def feed(self, piece):
+        """
+        Add a token's bytes.
+
+        Returns:
+            (text safe to emit, whether a stop string was reached)
+        """
+        self._text += self._decoder.decode(piece)
+        found = [index for index in (self._text.find(stop) for stop in self.stop) if index >= 0]
+        if found:
+            text, self._text = self._text[:min(found)], ''
+            return text, True
+        keep = len(self._text) - self._holdback()
+        text, self._text = self._text[:keep], self._text[keep:]
+        return text, False
+
+    def _holdback(self):
+        """Length of the longest suffix that could still grow into a stop string"""
+        longest = 0
+        for stop in self.stop:
+            for length in range(min(len(stop) - 1, len(self._text)), longest, -1):
+                if self._text.endswith(stop[:length]):
+                    longest = length
+                    break
+        return longest
+
+    def flush(self):
+        text, self._text = self._text + self._decoder.decode(b'', final=True), ''
+        return text
+
+
+class BatchSlot:
+    """
+    One llama.cpp context decoding up to `sequences` jobs together. Unlike
+    the other slots it has no run(): it pulls jobs from the pool itself
+    (serve()).
+    """
+
+    def __init__(self, index, sequences, n_ctx, n_ctx_seq, prefix_cache=True):
+        self.index = index
+        self.sequences = sequences
+        self.n_ctx = n_ctx
+        self.n_ctx_seq = n_ctx_seq
+        self.prefix_cache = prefix_cache
+        # Sequence id holding the evaluated preamble, after the job sequences
+        self.prefix_seq = sequences
+        self.prefix_tokens = []
+        # context_key -> (seq_id, evaluated tokens, cells shared with the prefix), oldest first
+        self.parked = OrderedDict()
+        self.llama = None
+
+    def load(self):
+        import llama_cpp
+        from llama_cpp._internals import LlamaBatch, LlamaContext
+        from .ai import PROMPT_PREFIX, load_model, load_extra_model
+
+        # The weights come from the lifecycle model; the multi-sequence
+        # context is separate from the model's own single-sequence one
+        self.llama = load_model() if self.index == 0 else load_extra_model()
+        model = self.llama._model
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = self.n_ctx
+        params.n_batch = params.n_ubatch = max(512, self.sequences)
+        params.n_seq_max = self.sequences + 1
+        params.kv_unified = True
+        params.n_threads = self.llama.context_params.n_threads
+        params.n_threads_batch = self.llama.context_params.n_threads_batch
+        self.ctx = LlamaContext(model=model, params=params, verbose=False)
+        self.batch = LlamaBatch(n_tokens=params.n_batch, embd=0, n_seq_max=1, verbose=False)
+        self.n_batch = params.n_batch
+        self.n_vocab = model.n_vocab()
+        self._model = model
+        self._piece = ctypes.create_string_buffer(64)
+        if self.prefix_cache:
+            self.prefix_tokens = model.tokenize(PROMPT_PREFIX.encode('utf-8'), add_bos=True, special=True)
+            self._evaluate_prefix()
+
+    def _evaluate_prefix(self):
+        """Prefill the shared preamble into the prefix sequence"""
+        for start in range(0, len(self.prefix_tokens), self.n_batch):
+            self.batch.set_batch(self.prefix_tokens[start:start + self.n_batch], start, False)
+            for i in range(self.batch.batch.n_tokens):
+                self.batch.batch.seq_id[i][0] = self.prefix_seq
+            self.ctx.decode(self.batch)
+
+    def serve(self, pool):
+        """
+        Scheduler loop: admit, decode one step for everyone, fan out, repeat.
+
+        A step that raises fails the jobs in flight and starts over from an
+        empty KV cache. If even that fails, the jobs are failed and the error
+        ends the loop, leaving the pool to fail queued jobs.
+        """
+        active = {}
+        free = list(range(self.sequences - 1, -1, -1))
+        try:
+            while True:
+                try:
+                    self._step(pool, active, free)
+                except Exception as e:
+                    logger.exception("Batch step failed; failing %d jobs in flight", len(active))
+                    self._reset(pool, active, free, e)
+        except BaseException as e:
+            for seq in list(active.values()):
+                pool.complete(seq.job, e)
+            raise
+
+    def _step(self, pool, active, free):
+        import llama_cpp
+
+        self._admit(pool, active, free)
+        for seq in [seq for seq in active.values() if seq.job.cancelled.is_set()]:
+            self._release(pool, active, free, seq)
+        if not active:
+            return
+
+        self._fill_batch(active)
+        code = llama_cpp.llama_decode(self.ctx.ctx, self.batch.batch)
+        if code == 1 and (self.parked or len(active) > 1):
+            # Out of KV cells: drop a parked conversation, or end the
+            # longest answer, and retry the rest
+            if self.parked:
+                self._unpark(free)
+            else:
+                longest = max(active.values(), key=lambda seq: seq.n_past)
+                logger.warning("Batch KV cache full, ending job %d after %d tokens",
+                               longest.job.id, longest.generated)
+                self._release(pool, active, free, longest, park=False)
+            for seq in active.values():
+                self.ctx.kv_cache_seq_rm(seq.seq_id, seq.n_past, -1)
+            return
+        if code != 0:
+            raise RuntimeError(f"llama_decode returned {code}")
+
+        for seq in list(active.values()):
+            try:
+                self._advance(pool, active, free, seq)
+            except Exception as e:
+                self._release(pool, active, free, seq, e)
+
+    def _reset(self, pool, active, free, error):
+        """Fail every job in flight and start again from an empty KV cache"""
+        for seq in list(active.values()):
+            del active[seq.seq_id]
+            seq.sampler.close()
+            pool.complete(seq.job, error)
+        self.parked.clear()
+        free[:] = range(self.sequences - 1, -1, -1)
+        self.ctx.kv_cache_clear()
+        if self.prefix_tokens:
+            self._evaluate_prefix()
+
+    def _admit(self, pool, active, free):
+        """Move queued jobs into free sequences while the KV cache has room"""
+        while free or self.parked:
+            used = len(self.prefix_tokens) + sum(
+                seq.n_past - seq.n_shared + len(seq.pending) for seq in active.values()
+            ) + sum(len(tokens) - n_shared for _, tokens, n_shared in self.parked.values())
+            if used + self.n_batch > self.n_ctx:
+                if self.parked:
+                    self._unpark(free)
+                    continue
+                if active:
+                    return
+            # Block while idle, otherwise only take what is already waiting
+            job = pool.take(timeout=None if not active else 0)
+            if job is None:
+                return
+            if job.cancelled.is_set():
+                pool.complete(job)
+                continue
+            try:
+                tokens = self._model.tokenize(job.prompt.encode('utf-8'), add_bos=True, special=True)
+                if len(tokens) >= self.n_ctx_seq:
+                    raise ValueError(
+                        f"Requested tokens ({len(tokens)}) exceed context window of {self.n_ctx_seq}"
+                    )
+                sampler = self._sampler(job.params, tokens)
+            except Exception as e:
+                pool.complete(job, e)
+                continue
+            seq_id, n_cached, n_shared = self._claim(job, tokens, free)
+            job.prompt_tokens, job.cached_tokens = len(tokens), n_cached
+            active[seq_id] = Sequence(seq_id, job, tokens, sampler, n_cached, n_shared)
+
+    def _claim(self, job, tokens, free):
+        """
+        Sequence id for a job, with its prompt's start already in the KV
+        cache: the job's parked conversation if that covers more than the
+        preamble, otherwise a copy of the prefix sequence.
+
+        Returns:
+            (seq_id, tokens already evaluated, of which shared with the prefix sequence)
+        """
+        n_prefix = self._shared_prefix(tokens)
+        parked = self.parked.pop(job.context_key, None) if job.context_key is not None else None
+        if parked is not None:
+            seq_id, parked_tokens, n_shared = parked
+            n_reused = _common_prefix(parked_tokens, tokens)
+            if n_reused > n_prefix:
+                self.ctx.kv_cache_seq_rm(seq_id, n_reused, -1)
+                return seq_id, n_reused, min(n_shared, n_reused)
+            self.ctx.kv_cache_seq_rm(seq_id, -1, -1)
+            free.append(seq_id)
+
+        if not free:
+            self._unpark(free)
+        seq_id = free.pop()
+        if n_prefix:
+            self.ctx.kv_cache_seq_cp(self.prefix_seq, seq_id, 0, n_prefix)
+        return seq_id, n_prefix, n_prefix
+
+    def _shared_prefix(self, tokens):
+        """
+        Number of leading prompt tokens already evaluated in the prefix
+        sequence. Compared token by token, since the tokenizer may merge the
+        preamble's last token with the question.
+        """
+        return _common_prefix(self.prefix_tokens, tokens)
+
+    def _unpark(self, free):
+        """Drop the least recently parked conversation's KV cache"""
+        _, (seq_id, _, _) = self.parked.popitem(last=False)
+        self.ctx.kv_cache_seq_rm(seq_id, -1, -1)
+        free.append(seq_id)
+
+    def _sampler(self, params, prompt_tokens):
+        """Per-sequence sampler chain matching llama_cpp.Llama's defaults"""
+        import llama_cpp
+        from llama_cpp._internals import LlamaSampler
+
+        sampler = LlamaSampler()
+        sampler.add_penalties(
+            self.n_vocab, LAST_N_TOKENS, params.get('repeat_penalty', 1.0),
+            params.get('frequency_penalty', 0.0), params.get('presence_penalty', 0.0),
+        )
+        temperature = params.get('temperature', 0.8)
+        if temperature <= 0:
+            sampler.add_greedy()
+        else:
+            sampler.add_top_k(params.get('top_k', 40))
+            sampler.add_top_p(params.get('top_p', 0.95), 1)
+            sampler.add_min_p(params.get('min_p', 0.05), 1)
+            sampler.add_temp(temperature)
+            sampler.add_dist(params.get('seed', llama_cpp.LLAMA_DEFAULT_SEED))
+        for token in prompt_tokens[-LAST_N_TOKENS:]:
+            sampler.accept(token)
+        return sampler
+
+    def _fill_batch(self, active):
+        """One token per generating sequence first, then prompt chunks in the space left"""
+        batch = self.batch.batch
+        batch.n_tokens = 0
+
+        def add(token, pos, seq_id, logits):
+            i = batch.n_tokens
+            batch.token[i] = token
+            batch.pos[i] = pos
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = seq_id
+            batch.logits[i] = logits
+            batch.n_tokens += 1
+            return i
+
+        for seq in active.values():
+            seq.in_batch, seq.logits_index = 0, None
+            if seq.next_token is not None:
+                seq.logits_index = add(seq.next_token, seq.n_past, seq.seq_id, True)
+                seq.in_batch = 1
+        for seq in active.values():
+            room = self.n_batch - batch.n_tokens
+            if not seq.pending or room <= 0:
+                continue
+            chunk = seq.pending[:room]
+            last = len(chunk) == len(seq.pending)
+            for offset, token in enumerate(chunk):
+                index = add(token, seq.n_past + offset, seq.seq_id, last and offset == len(chunk) - 1)
+            if last:
+                seq.logits_index = index
+            seq.in_batch = len(chunk)
+
+    def _advance(self, pool, active, free, seq):
+        """Account for the evaluated tokens and sample the sequence's next token"""
+        import llama_cpp
+
+        if not seq.in_batch:
+            return
+        seq.n_past += seq.in_batch
+        if seq.pending:
+            del seq.pending[:seq.in_batch]
+        seq.next_token = None
+        if seq.logits_index is None:
+            return
+
+        token = seq.sampler.sample(self.ctx, seq.logits_index)
+        seq.generated += 1
+        seq.job.tokens += 1
+        if llama_cpp.llama_vocab_is_eog(self._model.vocab, token):
+            self._release(pool, active, free, seq)
+            return
+
+        text, stopped = seq.feed(self._token_bytes(token))
+        if text:
+            seq.job.put(text)
+        if stopped or seq.generated >= seq.max_tokens or seq.n_past + 1 >= self.n_ctx_seq:
+            self._release(pool, active, free, seq)
+        else:
+            seq.next_token = token
+            seq.tokens.append(token)
+
+    def _token_bytes(self, token):
+        import llama_cpp
+
+        n = llama_cpp.llama_token_to_piece(self._model.vocab, token, self._piece, len(self._piece), 0, False)
+        if n < 0:
+            self._piece = ctypes.create_string_buffer(-n)
+            n = llama_cpp.llama_token_to_piece(self._model.vocab, token, self._piece, len(self._piece), 0, False)
+        return self._piece.raw[:n]
+
+    def _release(self, pool, active, free, seq, error=None, park=True):
+        """
+        Finish a job and give its sequence id and KV cells back, or park
+        them for the next question of the same conversation
+        """
+        finished = error is None and not seq.job.cancelled.is_set()
+        if finished:
+            text = seq.flush()
+            if text:
+                seq.job.put(text)
+        seq.sampler.close()
+        del active[seq.seq_id]
+        key = seq.job.context_key
+        if finished and park and key is not None:
+            if key in self.parked:
+                # Another answer of the conversation finished meanwhile
+                self.parked.move_to_end(key, last=False)
+                self._unpark(free)
+            self.parked[key] = (seq.seq_id, seq.tokens[:seq.n_past], seq.n_shared)
+        else:
+            self.ctx.kv_cache_seq_rm(seq.seq_id, -1, -1)
+            free.append(seq.seq_id)
+        pool.complete(seq.job, error)
+
+
+def _common_prefix(evaluated, tokens):
+    """
+    Length of the common start of evaluated tokens and a prompt, short of
+    the prompt's last token, which is always evaluated so the job gets logits
+    """
+    limit = min(len(evaluated), len(tokens) - 1)
+    n = 0
+    while n < limit and tokens[n] == evaluated[n]:
+        n += 1
+    return n
@@ -0,0 +1,109 @@
+"""
+Conversation history for follow-up questions.
+
+A chat prompt carries the most recent turns of its session that fit in
+CHAT_HISTORY_TOKENS tokens, counted with the chat model's own tokenizer
+(estimated from the text length when CHAT_BACKEND is not the local model).
+Counts are stored on each Conversation row the first time it is needed, so
+building the window costs one query and no tokenization for known turns.
+
+Turns are kept oldest first and the newest are dropped last, so a session's
+prompt grows by one turn per question until the budget is reached. The
+batch inference workers keep a finished session's KV cache and reuse it for
+the unchanged start of its next prompt (see batching.py).
+"""
+import logging
+import threading
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_TOKENS = 1024
+DEFAULT_HISTORY_TURNS = 10
+CHARS_PER_TOKEN = 4
+# Text around each turn in the prompt, see ai.build_prompt()
+TURN_TEMPLATE = "{prompt}\n\nMedical assistant response: {response}\n\nPatient question: "
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+_turn_overhead = None
+
+
+def get_tokenizer():
+    """The chat model's vocabulary only, loaded once per process"""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                from llama_cpp import Llama
+                from .ai import find_model_path
+
+                _tokenizer = Llama(model_path=find_model_path(), vocab_only=True, verbose=False)
+    return _tokenizer
+
+
+def count_tokens(text):
+    if getattr(settings, 'CHAT_BACKEND', 'llama') != 'llama':
+        # No local vocabulary; English text averages about four characters a token
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(get_tokenizer().tokenize(text.encode('utf-8'), add_bos=False, special=True))
+
+
+def turn_overhead():
+    """Tokens TURN_TEMPLATE adds to a turn's prompt and response"""
+    global _turn_overhead
+    if _turn_overhead is None:
+        _turn_overhead = count_tokens(TURN_TEMPLATE.format(prompt='', response=''))
+    return _turn_overhead
+
+
+def ensure_token_counts(conversations):
+    """Count and store the tokens of conversations saved without them"""
+    missing = [c for c in conversations if c.prompt_tokens is None or c.response_tokens is None]
+    for conversation in missing:
+        conversation.prompt_tokens = count_tokens(conversation.prompt)
+        conversation.response_tokens = count_tokens(conversation.response)
+    if missing:
+        type(missing[0]).objects.bulk_update(missing, ['prompt_tokens', 'response_tokens'])
+
+
+def build_history(session, budget=None, max_turns=None):
+    """
+    Recent turns of a chat session for the next prompt.
+
+    Args:
+        session: ChatSession, or None for a new conversation.
+        budget: Token budget for the turns (CHAT_HISTORY_TOKENS).
+        max_turns: Most turns to consider (CHAT_HISTORY_TURNS).
+
+    Returns:
+        list: (prompt, response) pairs, oldest first; empty if the history
+        cannot be tokenized.
+    """
+    if budget is None:
+        budget = getattr(settings, 'CHAT_HISTORY_TOKENS', DEFAULT_HISTORY_TOKENS)
+    if max_turns is None:
+        max_turns = getattr(settings, 'CHAT_HISTORY_TURNS', DEFAULT_HISTORY_TURNS)
+    if session is None or budget <= 0 or max_turns <= 0:
+        return []
+
+    recent = list(session.conversations.order_by('-created_at')[:max_turns])
+    if not recent:
+        return []
+    try:
+        ensure_token_counts(recent)
+        overhead = turn_overhead()
+    except Exception:
+        logger.exception("Could not count chat history tokens, answering without history")
+        return []
+
+    turns = []
+    used = 0
+    for conversation in recent:
+        cost = conversation.prompt_tokens + conversation.response_tokens + overhead
+        if used + cost > budget:
+            break
+        turns.append((conversation.prompt, conversation.response))
+        used += cost
+    turns.reverse()
+    return turns
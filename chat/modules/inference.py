@@ -0,0 +1,645 @@
+"""
+Inference service for the chat model.
+
+llama.cpp contexts are not safe for concurrent use, so generations no longer
+run on the request thread against a shared model. Requests are queued as
+InferenceJobs and served by a fixed pool of workers, each owning its own
+model instance:
+
+    thread mode   N model instances in this process (weights are mmapped,
+                  so extra instances mostly cost their KV cache; llama.cpp
+                  releases the GIL while evaluating)
+    process mode  N worker processes, each loading its own model
+    batch mode    N multi-sequence contexts, each decoding up to
+                  INFERENCE_BATCH_SEQUENCES jobs per step (see batching.py)
+    http mode     N concurrent streams from an OpenAI-compatible server
+                  instead of a local model (see remote.py)
+    fake mode     N workers streaming a fixed answer at a fixed pace, for
+                  benchmarks and CI without a model file
+
+CHAT_BACKEND picks the backend: 'llama' runs the local model in
+INFERENCE_MODE, 'openai' uses http mode and 'fake' fake mode. They all
+stream through the same InferenceJob, so callers never see the difference.
+
+The queue is bounded and served round-robin across users, so one user with
+several tabs open cannot starve everyone else. When it is full, submit()
+raises InferenceBusy with a retry estimate instead of blocking the request.
+"""
+import asyncio
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .batching import BatchSlot
+from .metrics import get_inference_metrics
+from .remote import DEFAULT_TIMEOUT as DEFAULT_HTTP_TIMEOUT, HttpSlot
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 1
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_MAX_PER_USER = 2
+# Seconds a reader waits for the next chunk, queueing included
+DEFAULT_STREAM_TIMEOUT = 300
+# CHAT_BACKEND -> pool mode (None: INFERENCE_MODE)
+BACKEND_MODES = {'llama': None, 'openai': 'http', 'fake': 'fake'}
+FAKE_ANSWER = (
+    "Thank you for your question. Common causes include infections, dehydration and changes in diet. "
+    "Rest, drink plenty of fluids and monitor your symptoms over the next few days. "
+    "Seek medical care promptly if you develop a high fever, severe pain, difficulty breathing or confusion. "
+    "Please consult a healthcare professional for advice about your specific situation. "
+) * 8
+
+_DONE = object()
+
+
+class InferenceBusy(Exception):
+    """The inference queue is saturated; retry after `retry_after` seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class InferenceTimeout(Exception):
+    """A job produced no output within the stream timeout and was cancelled"""
+
+
+class InferenceJob:
+    """
+    One generation request. Workers push text chunks into it; the request
+    thread reads them with stream(), an event loop with astream().
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, prompt, params, user_key=None, cancel_event=None, context_key=None):
+        self.id = next(self._ids)
+        self.prompt = prompt
+        self.params = params
+        self.user_key = user_key
+        # Conversation whose earlier prompts this one extends, see batching.py
+        self.context_key = context_key
+        self.created = time.monotonic()
+        self.started = None
+        self.first_token = None
+        self.finished = None
+        self.mode = None  # pool mode that served it
+        self.outcome = None  # completed, failed or cancelled
+        # The caller may pass its own event, e.g. one its disconnect handler sets
+        self.cancelled = cancel_event if cancel_event is not None else threading.Event()
+        self.error = None
+        self.tokens = 0
+        self.prompt_tokens = None
+        self.cached_tokens = 0  # prompt tokens served from the prefix or conversation cache
+        self._chunks = queue.Queue()
+        self._waiters = []  # (loop, asyncio.Event) of astream() readers
+
+    def put(self, text):
+        if self.first_token is None:
+            self.first_token = time.monotonic()
+        self._chunks.put(text)
+        self._wake()
+
+    def finish(self, error=None):
+        self.error = error
+        self.finished = time.monotonic()
+        self._chunks.put(_DONE)
+        self._wake()
+
+    def _wake(self):
+        for loop, event in list(self._waiters):
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # loop already closed
+
+    def cancel(self):
+        """Stop generating; the worker checks this between tokens"""
+        self.cancelled.set()
+
+    def _timed_out(self, timeout):
+        self.cancel()
+        return InferenceTimeout(f"Inference job {self.id} produced no output for {timeout} seconds")
+
+    def stream(self, timeout=None):
+        """
+        Yield text chunks until the job finishes; re-raise worker errors.
+        Raises InferenceTimeout and cancels the job when no chunk arrives for
+        timeout seconds (INFERENCE_STREAM_TIMEOUT unless given).
+        """
+        if timeout is None:
+            timeout = stream_timeout()
+        while True:
+            try:
+                chunk = self._chunks.get(timeout=timeout)
+            except queue.Empty:
+                raise self._timed_out(timeout) from None
+            if chunk is _DONE:
+                break
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+    async def astream(self, timeout=None):
+        """
+        stream() for async code. Waits on an asyncio.Event the worker sets
+        from its thread, so a waiting reader holds no thread at all.
+        """
+        if timeout is None:
+            timeout = stream_timeout()
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        self._waiters.append(waiter)
+        try:
+            while True:
+                # Clear before checking: a put() after this re-sets the event
+                waiter[1].clear()
+                try:
+                    chunk = self._chunks.get_nowait()
+                except queue.Empty:
+                    try:
+                        await asyncio.wait_for(waiter[1].wait(), timeout)
+                    except asyncio.TimeoutError:
+                        raise self._timed_out(timeout) from None
+                    continue
+                if chunk is _DONE:
+                    break
+                yield chunk
+        finally:
+            self._waiters.remove(waiter)
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def wait_seconds(self):
+        return (self.started or time.monotonic()) - self.created
+
+
+def stream_timeout():
+    return getattr(settings, 'INFERENCE_STREAM_TIMEOUT', DEFAULT_STREAM_TIMEOUT)
+
+
+def run_generation(model, job):
+    """Stream raw completion text for a job from a llama_cpp.Llama instance"""
+    for output in model(job.prompt, stream=True, **job.params):
+        if job.cancelled.is_set():
+            break
+        if "choices" in output and len(output["choices"]) > 0:
+            text = output["choices"][0].get("text", "")
+            if text:
+                yield text
+
+
+class FairQueue:
+    """
+    Bounded queue with one FIFO per user, served round-robin. At most
+    `per_user` jobs of one user may be queued or running at a time.
+    """
+
+    def __init__(self, maxsize, per_user):
+        self.maxsize = maxsize
+        self.per_user = per_user
+        self._users = OrderedDict()
+        self._active = {}  # user_key -> queued + running jobs
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def put(self, job):
+        with self._condition:
+            if self._size >= self.maxsize:
+                raise InferenceBusy("The assistant is busy. Please try again shortly.", None)
+            if job.user_key is not None and self._active.get(job.user_key, 0) >= self.per_user:
+                raise InferenceBusy("You already have a response in progress. Please wait for it to finish.", None)
+            self._users.setdefault(job.user_key, deque()).append(job)
+            self._active[job.user_key] = self._active.get(job.user_key, 0) + 1
+            self._size += 1
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._size > 0, timeout):
+                return None
+            user_key, jobs = next(iter(self._users.items()))
+            job = jobs.popleft()
+            if jobs:
+                self._users.move_to_end(user_key)
+            else:
+                del self._users[user_key]
+            self._size -= 1
+            return job
+
+    def done(self, job):
+        """Release the user's slot once a job is no longer queued or running"""
+        with self._condition:
+            remaining = self._active.get(job.user_key, 0) - 1
+            if remaining > 0:
+                self._active[job.user_key] = remaining
+            else:
+                self._active.pop(job.user_key, None)
+
+    def __len__(self):
+        return self._size
+
+
+def prime_prefix(model, prefix):
+    """
+    Evaluate the shared prompt prefix so it sits in the model's KV cache.
+    Llama reuses the longest common prefix of its previous input, so the
+    next prompt starting with it only evaluates the rest.
+    """
+    model.reset()
+    model.eval(model.tokenize(prefix.encode('utf-8'), special=True))
+
+
+class ThreadSlot:
+    """A model instance in this process"""
+
+    def __init__(self, index, prefix_cache=True):
+        self.index = index
+        self.prefix_cache = prefix_cache
+        self.model = None
+
+    def load(self):
+        from .ai import PROMPT_PREFIX, load_model, load_extra_model
+
+        # Slot 0 shares the warmed-up lifecycle model, others get their own
+        self.model = load_model() if self.index == 0 else load_extra_model()
+        if self.prefix_cache:
+            prime_prefix(self.model, PROMPT_PREFIX)
+
+    def run(self, job):
+        for text in run_generation(self.model, job):
+            job.tokens += 1
+            job.put(text)
+
+
+class FakeSlot:
+    """Streams FAKE_ANSWER word by word, token_seconds apart, without loading a model"""
+
+    def __init__(self, index, token_seconds=0.0):
+        self.index = index
+        self.token_seconds = token_seconds
+
+    def load(self):
+        pass
+
+    def run(self, job):
+        words = FAKE_ANSWER.split(' ')
+        job.prompt_tokens = len(job.prompt.split())
+        for i in range(min(job.params.get('max_tokens') or 16, len(words))):
+            if job.cancelled.is_set():
+                break
+            if self.token_seconds:
+                time.sleep(self.token_seconds)
+            job.tokens += 1
+            job.put(words[i] if i == 0 else ' ' + words[i])
+
+
+def _process_worker(config, tasks, results, cancel):
+    """Entry point of a worker process: load a model and serve jobs"""
+    from llama_cpp import Llama
+
+    started = time.perf_counter()
+    model = Llama(
+        model_path=config['model_path'], verbose=False,
+        n_gpu_layers=config['n_gpu_layers'], n_ctx=config['n_ctx'], n_threads=config.get('n_threads'),
+    )
+    model("Hello", max_tokens=1, temperature=0.0)
+    if config.get('prompt_prefix'):
+        prime_prefix(model, config['prompt_prefix'])
+    results.put(('ready', None, time.perf_counter() - started))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job_id, prompt, params = task
+        cancel.clear()
+        try:
+            for output in model(prompt, stream=True, **params):
+                if cancel.is_set():
+                    break
+                text = output["choices"][0].get("text", "") if output.get("choices") else ""
+                if text:
+                    results.put(('chunk', job_id, text))
+            results.put(('done', job_id, None))
+        except Exception as e:
+            results.put(('error', job_id, str(e)))
+
+
+class ProcessSlot:
+    """A model instance in a dedicated worker process"""
+
+    def __init__(self, index, config):
+        self.index = index
+        self.config = config
+        self.process = None
+
+    def load(self):
+        context = multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.cancel = context.Event()
+        self.process = context.Process(
+            target=_process_worker, args=(self.config, self.tasks, self.results, self.cancel),
+            name=f'llama-worker-{self.index}', daemon=True,
+        )
+        self.process.start()
+        kind, _, load_seconds = self._receive()
+        logger.info("Inference worker %d ready in %.1fs", self.index, load_seconds)
+
+    def _receive(self):
+        while True:
+            try:
+                return self.results.get(timeout=1.0)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError(f"Inference worker {self.index} exited with code {self.process.exitcode}")
+
+    def run(self, job):
+        self.tasks.put((job.id, job.prompt, job.params))
+        while True:
+            try:
+                kind, job_id, payload = self.results.get(timeout=0.1)
+            except queue.Empty:
+                if job.cancelled.is_set():
+                    self.cancel.set()
+                if not self.process.is_alive():
+                    # Restart the worker for the next job and fail this one
+                    self.load()
+                    raise RuntimeError(f"Inference worker {self.index} died")
+                continue
+            if job_id != job.id:
+                continue
+            if job.cancelled.is_set():
+                self.cancel.set()
+            if kind == 'chunk':
+                job.tokens += 1
+                job.put(payload)
+            elif kind == 'error':
+                raise RuntimeError(payload)
+            else:
+                return
+
+
+class InferencePool:
+    """Fixed set of worker slots fed from a FairQueue"""
+
+    def __init__(self, workers=DEFAULT_WORKERS, mode='thread', queue_size=DEFAULT_QUEUE_SIZE,
+                 max_per_user=DEFAULT_MAX_PER_USER, model_config=None, batch_config=None, prefix_cache=True,
+                 fake_token_seconds=0.0, http_config=None):
+        self.mode = mode
+        self.pid = os.getpid()
+        self.queue = FairQueue(queue_size, max_per_user)
+        if mode == 'process':
+            self.slots = [ProcessSlot(i, model_config) for i in range(workers)]
+        elif mode == 'batch':
+            self.slots = [BatchSlot(i, prefix_cache=prefix_cache, **batch_config) for i in range(workers)]
+        elif mode == 'http':
+            self.slots = [HttpSlot(i, **http_config) for i in range(workers)]
+        elif mode == 'fake':
+            self.slots = [FakeSlot(i, fake_token_seconds) for i in range(workers)]
+        else:
+            self.slots = [ThreadSlot(i, prefix_cache) for i in range(workers)]
+        # Jobs that can run at once
+        self.capacity = sum(getattr(slot, 'sequences', 1) for slot in self.slots)
+        self._threads = []
+        self._ready = threading.Event()
+        self._ready_slots = set()
+        self._lock = threading.Lock()
+        self._stats = {
+            'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'cancelled': 0,
+            'running': 0, 'max_wait_seconds': 0.0, 'prompt_tokens': 0, 'cached_prompt_tokens': 0,
+            'generated_tokens': 0,
+            # Unused max_tokens budget of cancelled jobs: generation a
+            # departed client would otherwise have cost
+            'tokens_saved_by_cancel': 0,
+        }
+        # Exponentially weighted averages used for the Retry-After estimate
+        self._avg_wait = 0.0
+        self._avg_service = None
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return self
+            for slot in self.slots:
+                thread = threading.Thread(target=self._worker, args=(slot,),
+                                          name=f'inference-{slot.index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def started(self):
+        return bool(self._threads)
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def _mark_ready(self, slot, ready):
+        """Record whether a slot serves jobs; the pool is ready while any does"""
+        with self._lock:
+            if ready:
+                self._ready_slots.add(slot.index)
+            else:
+                self._ready_slots.discard(slot.index)
+            if self._ready_slots:
+                self._ready.set()
+            else:
+                self._ready.clear()
+            return bool(self._ready_slots)
+
+    def retry_after(self):
+        """Seconds until a slot is likely to free up, for Retry-After"""
+        service = self._avg_service or 10.0
+        rounds = math.ceil((len(self.queue) + 1) / self.capacity)
+        return max(1, min(60, int(math.ceil(service * rounds))))
+
+    def submit(self, prompt, params, user_key=None, cancel_event=None, context_key=None):
+        """
+        Queue a generation. Setting cancel_event (or calling job.cancel())
+        stops it at the next token. Jobs of one conversation share a
+        context_key so batch workers can reuse its KV cache.
+
+        Raises:
+            InferenceBusy: the queue is full or the user has too many jobs
+        """
+        self.start()
+        job = InferenceJob(prompt, params, user_key, cancel_event, context_key)
+        job.mode = self.mode
+        try:
+            self.queue.put(job)
+        except InferenceBusy as e:
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise InferenceBusy(str(e), self.retry_after()) from None
+        with self._lock:
+            self._stats['submitted'] += 1
+        return job
+
+    def metrics(self):
+        with self._lock:
+            return dict(
+                self._stats,
+                mode=self.mode,
+                workers=len(self.slots),
+                capacity=self.capacity,
+                ready=self.is_ready(),
+                queue_depth=len(self.queue),
+                queue_capacity=self.queue.maxsize,
+                avg_wait_seconds=round(self._avg_wait, 3),
+                avg_service_seconds=round(self._avg_service, 3) if self._avg_service is not None else None,
+                retry_after=self.retry_after(),
+            )
+
+    def _record(self, job, outcome):
+        with self._lock:
+            self._stats['running'] -= 1
+            self._stats[outcome] += 1
+            self._stats['prompt_tokens'] += job.prompt_tokens or 0
+            self._stats['cached_prompt_tokens'] += job.cached_tokens
+            self._stats['generated_tokens'] += job.tokens
+            if outcome == 'cancelled':
+                self._stats['tokens_saved_by_cancel'] += max(0, (job.params.get('max_tokens') or 0) - job.tokens)
+            wait = job.started - job.created
+            self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], round(wait, 3))
+            self._avg_wait = 0.8 * self._avg_wait + 0.2 * wait
+            if outcome == 'completed':
+                service = job.finished - job.started
+                self._avg_service = service if self._avg_service is None else 0.8 * self._avg_service + 0.2 * service
+        get_inference_metrics().record(job)
+
+    def take(self, timeout=None):
+        """Next job for a slot, marked as running; None if none arrived in time"""
+        job = self.queue.get(timeout)
+        if job is not None:
+            job.started = time.monotonic()
+            with self._lock:
+                self._stats['running'] += 1
+        return job
+
+    def complete(self, job, error=None):
+        """End a job taken with take() and release its queue slot"""
+        if error is not None:
+            outcome = 'failed'
+        else:
+            outcome = 'cancelled' if job.cancelled.is_set() else 'completed'
+        job.outcome = outcome
+        job.finish(error)
+        self.queue.done(job)
+        self._record(job, outcome)
+
+    def _worker(self, slot):
+        try:
+            slot.load()
+        except Exception as e:
+            logger.exception("Inference worker %d failed to load", slot.index)
+            failure = e
+        else:
+            failure = None
+            self._mark_ready(slot, True)
+            if hasattr(slot, 'serve'):
+                # Schedules its own jobs; never handed one through run()
+                try:
+                    slot.serve(self)
+                    failure = RuntimeError(f"Inference worker {slot.index} stopped")
+                except Exception as e:
+                    logger.exception("Inference worker %d stopped", slot.index)
+                    failure = e
+                if self._mark_ready(slot, False):
+                    # Other slots keep serving the queue
+                    return
+
+        # Jobs of a slot that failed to load or stopped are failed here without run()
+        while True:
+            job = self.take()
+            if job is None:
+                continue
+            if failure is not None or job.cancelled.is_set():
+                self.complete(job, failure)
+                continue
+            try:
+                slot.run(job)
+            except Exception as e:
+                self.complete(job, e)
+            else:
+                self.complete(job)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _create_pool():
+    """Inference pool for CHAT_BACKEND, configured from settings"""
+    backend = getattr(settings, 'CHAT_BACKEND', 'llama')
+    if backend not in BACKEND_MODES:
+        raise ImproperlyConfigured(
+            f"CHAT_BACKEND must be one of {', '.join(BACKEND_MODES)}, not {backend!r}"
+        )
+    mode = BACKEND_MODES[backend] or getattr(settings, 'INFERENCE_MODE', 'thread')
+    workers = getattr(settings, 'INFERENCE_WORKERS', DEFAULT_WORKERS)
+    model_config = batch_config = http_config = None
+    prefix_cache = getattr(settings, 'INFERENCE_PREFIX_CACHE', True)
+    if mode == 'batch':
+        batch_config = {
+            'sequences': getattr(settings, 'INFERENCE_BATCH_SEQUENCES', 8),
+            'n_ctx': getattr(settings, 'INFERENCE_BATCH_CTX', 8192),
+            'n_ctx_seq': getattr(settings, 'LLAMA_N_CTX', 2048),
+        }
+    elif mode == 'process':
+        from .ai import PROMPT_PREFIX, find_model_path, probe_gpu
+        model_config = {
+            'model_path': find_model_path(),
+            'n_ctx': getattr(settings, 'LLAMA_N_CTX', 2048),
+            'n_gpu_layers': getattr(settings, 'LLAMA_N_GPU_LAYERS', -1) if probe_gpu() else 0,
+            'n_threads': getattr(settings, 'LLAMA_N_THREADS', None),
+            'prompt_prefix': PROMPT_PREFIX if prefix_cache else None,
+        }
+    elif mode == 'http':
+        workers = getattr(settings, 'CHAT_OPENAI_CONNECTIONS', workers)
+        http_config = {
+            'base_url': settings.CHAT_OPENAI_BASE_URL,
+            'model': getattr(settings, 'CHAT_OPENAI_MODEL', 'local'),
+            'api_key': getattr(settings, 'CHAT_OPENAI_API_KEY', None),
+            'timeout': getattr(settings, 'CHAT_OPENAI_TIMEOUT', DEFAULT_HTTP_TIMEOUT),
+        }
+    return InferencePool(
+        workers=workers,
+        mode=mode,
+        queue_size=getattr(settings, 'INFERENCE_QUEUE_SIZE', DEFAULT_QUEUE_SIZE),
+        max_per_user=getattr(settings, 'INFERENCE_MAX_PER_USER', DEFAULT_MAX_PER_USER),
+        model_config=model_config,
+        batch_config=batch_config,
+        prefix_cache=prefix_cache,
+        fake_token_seconds=getattr(settings, 'INFERENCE_FAKE_TOKEN_SECONDS', 0.0),
+        http_config=http_config,
+    )
+
+
+def get_inference_pool():
+    """
+    Process-wide pool configured from settings (INFERENCE_*). A forked child
+    gets its own pool since the parent's worker threads do not survive the
+    fork; it is started at once if the parent's pool was.
+    """
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            inherited = _pool
+            _pool = _create_pool()
+            if inherited is not None and inherited.started():
+                _pool.start()
+        return _pool
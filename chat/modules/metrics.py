@@ -0,0 +1,203 @@
+"""
+Instrumentation for chat inference.
+
+Every job the inference pool finishes becomes one record of timings and
+token counts: queue wait, time to first token, generation time, prompt
+tokens (and how many came from a KV cache), generated tokens and decode
+speed. Prompts and answers are PHI, so a record never holds any text.
+
+Records are logged as one line on this module's logger, with the record as
+the `inference` attribute for structured handlers. They are also folded
+into rolling histograms covering the last CHAT_METRICS_WINDOW seconds,
+which /chat/metrics/ exports as JSON or in the Prometheus text format. With
+CHAT_INFERENCE_TRACE, a chat answer's record is also stored in its
+Conversation row (inference_trace).
+"""
+import logging
+import threading
+import time
+from collections import deque
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 15 * 60
+MAX_SAMPLES = 10000
+RECENT_RECORDS = 50
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+# record field -> histogram bucket bounds
+HISTOGRAMS = {
+    'queue_wait_seconds': SECONDS_BUCKETS,
+    'time_to_first_token_seconds': SECONDS_BUCKETS,
+    'generation_seconds': SECONDS_BUCKETS,
+    'prompt_tokens': TOKEN_BUCKETS,
+    'cached_prompt_tokens': TOKEN_BUCKETS,
+    'generated_tokens': TOKEN_BUCKETS,
+    'tokens_per_second': RATE_BUCKETS,
+}
+
+
+def _seconds(start, end):
+    return round(end - start, 3) if start is not None and end is not None else None
+
+
+def job_record(job):
+    """Timings and token counts of a finished InferenceJob, without its prompt or output"""
+    decode_seconds = job.finished - job.first_token if job.first_token and job.finished else None
+    return {
+        'job_id': job.id,
+        'mode': job.mode,
+        'outcome': job.outcome,
+        'queue_wait_seconds': _seconds(job.created, job.started),
+        'time_to_first_token_seconds': _seconds(job.created, job.first_token),
+        'generation_seconds': _seconds(job.started, job.finished),
+        'prompt_tokens': job.prompt_tokens,
+        'cached_prompt_tokens': job.cached_tokens,
+        'generated_tokens': job.tokens,
+        'max_tokens': job.params.get('max_tokens'),
+        # Decode speed after the first token, which also pays for the prompt
+        'tokens_per_second': round((job.tokens - 1) / decode_seconds, 2)
+        if decode_seconds and job.tokens > 1 else None,
+    }
+
+
+def request_trace(job):
+    """
+    What to store in Conversation.inference_trace for an answer: its job's
+    record, a marker for a replayed cached answer (no job), or None when
+    CHAT_INFERENCE_TRACE is off
+    """
+    if not getattr(settings, 'CHAT_INFERENCE_TRACE', False):
+        return None
+    if job is None:
+        return {'cached_response': True}
+    return job_record(job)
+
+
+class RollingHistogram:
+    """Samples of the last `window` seconds, summarised as percentiles and cumulative buckets"""
+
+    def __init__(self, bounds, window=DEFAULT_WINDOW, max_samples=MAX_SAMPLES):
+        self.bounds = bounds
+        self.window = window
+        self._samples = deque(maxlen=max_samples)  # (monotonic time, value)
+
+    def add(self, value, now=None):
+        self._samples.append((time.monotonic() if now is None else now, value))
+
+    def _prune(self, now):
+        while self._samples and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+
+    def snapshot(self, now=None):
+        self._prune(time.monotonic() if now is None else now)
+        values = sorted(value for _, value in self._samples)
+        count = len(values)
+
+        def percentile(q):
+            return values[min(count - 1, int(q * count))] if count else None
+
+        buckets = []
+        index = 0
+        for bound in self.bounds:
+            while index < count and values[index] <= bound:
+                index += 1
+            buckets.append((bound, index))
+        return {
+            'count': count,
+            'sum': round(sum(values), 3),
+            'mean': round(sum(values) / count, 3) if count else None,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': values[-1] if count else None,
+            'buckets': buckets,
+        }
+
+
+class InferenceMetrics:
+    """Lifetime counters, rolling histograms and the latest records of inference jobs"""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self.histograms = {name: RollingHistogram(bounds, window) for name, bounds in HISTOGRAMS.items()}
+        self.recent = deque(maxlen=RECENT_RECORDS)
+        self.outcomes = {'completed': 0, 'failed': 0, 'cancelled': 0}
+        self.totals = {'prompt_tokens': 0, 'cached_prompt_tokens': 0, 'generated_tokens': 0}
+        self._lock = threading.Lock()
+
+    def record(self, job):
+        record = job_record(job)
+        logger.info(
+            "inference job=%s mode=%s outcome=%s wait=%ss ttft=%ss generation=%ss "
+            "prompt_tokens=%s cached=%s generated=%s tok/s=%s",
+            record['job_id'], record['mode'], record['outcome'], record['queue_wait_seconds'],
+            record['time_to_first_token_seconds'], record['generation_seconds'], record['prompt_tokens'],
+            record['cached_prompt_tokens'], record['generated_tokens'], record['tokens_per_second'],
+            extra={'inference': record},
+        )
+        now = time.monotonic()
+        with self._lock:
+            self.recent.append(record)
+            self.outcomes[record['outcome']] = self.outcomes.get(record['outcome'], 0) + 1
+            for name in self.totals:
+                self.totals[name] += record[name] or 0
+            for name, histogram in self.histograms.items():
+                if record[name] is not None:
+                    histogram.add(record[name], now)
+        return record
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'window_seconds': self.window,
+                'outcomes': dict(self.outcomes),
+                'totals': dict(self.totals),
+                'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+                'recent': list(self.recent),
+            }
+
+    def prometheus(self, gauges=None):
+        """
+        The snapshot in the Prometheus text exposition format. Histograms
+        cover the rolling window rather than the process lifetime.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP medconnect_inference_jobs_total Finished inference jobs by outcome',
+            '# TYPE medconnect_inference_jobs_total counter',
+        ]
+        lines += [f'medconnect_inference_jobs_total{{outcome="{outcome}"}} {count}'
+                  for outcome, count in snapshot['outcomes'].items()]
+        for name, total in snapshot['totals'].items():
+            lines += [f'# TYPE medconnect_inference_{name}_total counter',
+                      f'medconnect_inference_{name}_total {total}']
+        for name, value in (gauges or {}).items():
+            lines += [f'# TYPE medconnect_inference_{name} gauge',
+                      f'medconnect_inference_{name} {value}']
+        for name, histogram in snapshot['histograms'].items():
+            metric = f'medconnect_inference_{name}'
+            lines.append(f'# TYPE {metric} histogram')
+            lines += [f'{metric}_bucket{{le="{bound}"}} {count}' for bound, count in histogram['buckets']]
+            lines += [f'{metric}_bucket{{le="+Inf"}} {histogram["count"]}',
+                      f'{metric}_sum {histogram["sum"]}',
+                      f'{metric}_count {histogram["count"]}']
+        return '\n'.join(lines) + '\n'
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_inference_metrics():
+    """Process-wide metrics, rolling over CHAT_METRICS_WINDOW seconds"""
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = InferenceMetrics(getattr(settings, 'CHAT_METRICS_WINDOW', DEFAULT_WINDOW))
+    return _metrics
@@ -0,0 +1,83 @@
+"""
+Inference on a separate server speaking the OpenAI completions API, such as
+llama.cpp's llama-server, vLLM or a hosted provider like Together.
+
+Each HttpSlot is one concurrent streaming request, so the pool's fair queue,
+per-user limits, cancellation and metrics apply unchanged. Prompts are sent
+fully built (medical preamble, history and stop strings included) to the
+plain /completions endpoint, and the server-sent events are fed into the
+job as they arrive. A cancelled job closes its connection, which stops
+generation on servers that watch for it.
+"""
+import json
+import logging
+import urllib.error
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 60
+# generation_params() keys the OpenAI completions API accepts
+REQUEST_PARAMS = ('max_tokens', 'temperature', 'top_p', 'stop', 'echo', 'frequency_penalty', 'presence_penalty', 'seed')
+
+
+class HttpSlot:
+    """One streaming connection to an OpenAI-compatible completions server"""
+
+    def __init__(self, index, base_url, model, api_key=None, timeout=DEFAULT_TIMEOUT):
+        self.index = index
+        self.url = base_url.rstrip('/') + '/completions'
+        self.model = model
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def load(self):
+        # Nothing to load; an unreachable server fails requests, not startup
+        pass
+
+    def _request(self, job):
+        body = {name: job.params[name] for name in REQUEST_PARAMS if job.params.get(name) is not None}
+        # Ask for token counts in the final event; chunks are not always one token each
+        body.update(model=self.model, prompt=job.prompt, stream=True, stream_options={'include_usage': True})
+        headers = {'Content-Type': 'application/json', 'Accept': 'text/event-stream'}
+        if self.api_key:
+            headers['Authorization'] = f"Bearer {self.api_key}"
+        return urllib.request.Request(self.url, data=json.dumps(body).encode('utf-8'), headers=headers)
+
+    def run(self, job):
+        try:
+            response = urllib.request.urlopen(self._request(job), timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            # The error body may quote the prompt, so only the status is kept
+            raise RuntimeError(f"Inference server returned HTTP {e.code}") from None
+        except urllib.error.URLError as e:
+            raise RuntimeError(f"Inference server unreachable: {e.reason}") from None
+
+        chunks = 0
+        usage = {}
+        with response:
+            for line in response:
+                if job.cancelled.is_set():
+                    break
+                line = line.strip()
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    break
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    raise RuntimeError("Inference server sent a malformed event") from None
+                if event.get('error'):
+                    raise RuntimeError(f"Inference server error: {event['error'].get('type', 'unknown')}")
+                usage = event.get('usage') or usage
+                choices = event.get('choices') or []
+                text = choices[0].get('text', '') if choices else ''
+                if text:
+                    chunks += 1
+                    # Running estimate until the server reports its count
+                    job.tokens = chunks
+                    job.put(text)
+        job.prompt_tokens = usage.get('prompt_tokens') or job.prompt_tokens
+        job.tokens = usage.get('completion_tokens') or chunks
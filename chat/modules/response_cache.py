@@ -0,0 +1,261 @@
+"""
+Response cache for repeated chatbot questions.
+
+Patients ask the same general questions over and over ("symptoms of CKD",
+"what is a normal blood pressure"). With CHAT_RESPONSE_CACHE on, a finished
+answer is kept in process memory under its normalized prompt and replayed
+for the next identical question instead of queueing a new generation. With
+CHAT_RESPONSE_CACHE_EMBEDDINGS, questions that are worded differently but
+close in meaning also hit: prompts are embedded with the chat model's own
+GGUF file in embedding mode and compared by cosine similarity. Similar
+questions only match answers given to the same user, since a paraphrase
+can carry details the exact-match filter below does not catch; lookups
+without an owner use exact matches only.
+
+Entries expire after CHAT_RESPONSE_CACHE_TTL seconds and the least recently
+used ones are evicted beyond CHAT_RESPONSE_CACHE_SIZE entries or
+CHAT_RESPONSE_CACHE_MAX_BYTES of response text. Prompts that look personal
+(digits, e-mail addresses, long descriptions) are never cached, so one
+patient's details cannot be replayed to another.
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 256
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_SIMILARITY = 0.92
+MAX_PROMPT_CHARS = 200
+
+_PUNCTUATION = re.compile(r'[^\w\s]+')
+_WHITESPACE = re.compile(r'\s+')
+_PERSONAL = re.compile(r'\d|@')
+_CHUNKS = re.compile(r'\s*\S+\s*')
+
+
+def normalize_prompt(prompt):
+    """Case, punctuation and whitespace insensitive form of a question"""
+    text = prompt.replace("Q:", " ").replace("A:", " ").casefold()
+    text = _PUNCTUATION.sub(' ', text)
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+def is_cacheable(prompt):
+    """Only short, general questions are shared between users"""
+    return 0 < len(prompt) <= MAX_PROMPT_CHARS and not _PERSONAL.search(prompt)
+
+
+def replay_chunks(response):
+    """Split a cached answer into word-sized chunks for streaming"""
+    return _CHUNKS.findall(response)
+
+
+class CacheEntry:
+    __slots__ = ('response', 'created', 'generation_seconds', 'vector', 'owner')
+
+    def __init__(self, response, generation_seconds, vector=None, owner=None):
+        self.response = response
+        self.created = time.monotonic()
+        self.generation_seconds = generation_seconds
+        self.vector = vector
+        self.owner = owner
+
+
+class ResponseCache:
+    """In-memory LRU cache of finished answers with TTL and an optional semantic lookup"""
+
+    def __init__(self, max_entries=DEFAULT_SIZE, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES,
+                 embeddings=False, similarity=DEFAULT_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.embeddings = embeddings
+        self.similarity = similarity
+        self._entries = OrderedDict()  # sha256 of the normalized prompt -> CacheEntry
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._embedder = None
+        self._embed_lock = threading.Lock()
+        # Vectors computed by misses, reused when their answer is stored
+        self._recent_vectors = OrderedDict()
+        self._stats = {
+            'hits': 0, 'similar_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expired': 0,
+            'latency_saved_seconds': 0.0, 'lookup_seconds': 0.0,
+        }
+
+    @staticmethod
+    def key_for(prompt):
+        return hashlib.sha256(normalize_prompt(prompt).encode('utf-8')).hexdigest()
+
+    def get(self, prompt, owner=None):
+        """
+        Cached answer for a prompt, or None.
+
+        Tries the exact normalized prompt first and, with embeddings on and
+        an owner given, the most similar question the same owner asked
+        above the similarity threshold.
+        """
+        if not is_cacheable(prompt):
+            return None
+        started = time.perf_counter()
+        key = self.key_for(prompt)
+        with self._lock:
+            entry = self._live_entry(key)
+            similar = False
+        if entry is None and self.embeddings and owner is not None:
+            entry = self._similar_entry(key, prompt, owner)
+            similar = entry is not None
+
+        with self._lock:
+            lookup = time.perf_counter() - started
+            self._stats['lookup_seconds'] += lookup
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['similar_hits' if similar else 'hits'] += 1
+            self._stats['latency_saved_seconds'] += max(0.0, entry.generation_seconds - lookup)
+            return entry.response
+
+    def put(self, prompt, response, generation_seconds, owner=None):
+        """
+        Store a finished answer; ignored for personal-looking prompts and
+        empty answers. owner identifies the asker for similar matches.
+        """
+        if not response or not is_cacheable(prompt):
+            return False
+        key = self.key_for(prompt)
+        vector = None
+        if self.embeddings and owner is not None:
+            with self._lock:
+                vector = self._recent_vectors.pop(key, None)
+            if vector is None:
+                vector = self._embed(prompt)
+
+        size = len(response.encode('utf-8'))
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous.response.encode('utf-8'))
+            self._entries[key] = CacheEntry(response, generation_seconds, vector, owner)
+            self._bytes += size
+            self._stats['stores'] += 1
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.response.encode('utf-8'))
+                self._stats['evictions'] += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._recent_vectors.clear()
+            self._bytes = 0
+
+    def metrics(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['similar_hits'] + self._stats['misses']
+            hits = self._stats['hits'] + self._stats['similar_hits']
+            return dict(
+                self._stats,
+                latency_saved_seconds=round(self._stats['latency_saved_seconds'], 3),
+                lookup_seconds=round(self._stats['lookup_seconds'], 3),
+                hit_rate=round(hits / lookups, 3) if lookups else None,
+                avg_lookup_ms=round(self._stats['lookup_seconds'] * 1000 / lookups, 3) if lookups else None,
+                entries=len(self._entries),
+                bytes=self._bytes,
+                embeddings=self.embeddings,
+            )
+
+    def _live_entry(self, key):
+        """Entry for a key unless it expired; refreshes its LRU position (lock held)"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created > self.ttl:
+            self._drop(key)
+            self._stats['expired'] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.response.encode('utf-8'))
+
+    def _similar_entry(self, key, prompt, owner):
+        import numpy as np
+
+        try:
+            vector = self._embed(prompt)
+        except Exception:
+            logger.exception("Prompt embedding failed, semantic cache lookup skipped")
+            return None
+        with self._lock:
+            self._recent_vectors[key] = vector
+            while len(self._recent_vectors) > 64:
+                self._recent_vectors.popitem(last=False)
+            candidates = [(k, e) for k, e in self._entries.items() if e.vector is not None and e.owner == owner]
+            if not candidates:
+                return None
+            scores = np.stack([e.vector for _, e in candidates]) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity:
+                return None
+            return self._live_entry(candidates[best][0])
+
+    def _embed(self, prompt):
+        """Unit-length embedding of the normalized prompt"""
+        import numpy as np
+
+        with self._embed_lock:
+            if self._embedder is None:
+                self._embedder = load_embedding_model()
+            vector = np.asarray(self._embedder.embed(normalize_prompt(prompt)), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+def load_embedding_model():
+    """The chat model's GGUF file opened in embedding mode, mean-pooled"""
+    import llama_cpp
+    from .ai import find_model_path
+
+    return llama_cpp.Llama(
+        model_path=find_model_path(),
+        embedding=True,
+        pooling_type=llama_cpp.LLAMA_POOLING_TYPE_MEAN,
+        n_ctx=512,
+        n_gpu_layers=0,
+        verbose=False,
+    )
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Process-wide cache configured from settings, or None when CHAT_RESPONSE_CACHE is off"""
+    global _cache
+    if not getattr(settings, 'CHAT_RESPONSE_CACHE', False):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(
+                    max_entries=getattr(settings, 'CHAT_RESPONSE_CACHE_SIZE', DEFAULT_SIZE),
+                    ttl=getattr(settings, 'CHAT_RESPONSE_CACHE_TTL', DEFAULT_TTL),
+                    max_bytes=getattr(settings, 'CHAT_RESPONSE_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES),
+                    embeddings=getattr(settings, 'CHAT_RESPONSE_CACHE_EMBEDDINGS', False),
+                    similarity=getattr(settings, 'CHAT_RESPONSE_CACHE_SIMILARITY', DEFAULT_SIMILARITY),
+                )
+    return _cache
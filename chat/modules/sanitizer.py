@@ -0,0 +1,161 @@
+"""
+Output sanitizer for chatbot answers.
+
+The model is told to answer in plain text but still emits HTML tags,
+markdown emphasis and links, echoes of the prompt's "Medical assistant:"
+label and the start of a next turn ("Q:", "Patient question:"). These are
+removed in one left-to-right pass with precompiled patterns:
+
+    <tag>                   dropped
+    [text](url)             text
+    **text**, *text*        text
+    Medical assistant:      dropped anywhere, with the whitespace after it
+    Assistant:, Response:   dropped at the start of the answer
+    Q:, A:, ...             dropped at the end of the answer
+    three or more newlines  two newlines, surrounding whitespace stripped
+
+StreamSanitizer applies the same pass to tokens as they arrive. It emits
+everything it can already decide on and holds back only text that may
+still turn into one of the patterns above, such as "Medical assis" at the
+end of a token, an unclosed "<" or trailing whitespace. sanitize() is the
+stream run over a whole answer, so both produce the same output for any
+split of the text into chunks.
+
+Tags, links and emphasis must not span lines or exceed MAX_SPAN
+characters, which bounds how much a stray "<" or "*" can hold back.
+"""
+import re
+
+MAX_SPAN = 200
+
+# Patterns by the character that starts them: (complete, possibly incomplete, group kept)
+_RULES = {
+    '<': [
+        (re.compile(r'<[^<>\n]{1,%d}>' % MAX_SPAN), re.compile(r'<[^<>\n]{0,%d}\Z' % MAX_SPAN), None),
+    ],
+    '[': [
+        (re.compile(r'\[([^\[\]\n]{1,%d})\]\([^()\s]{1,%d}\)' % (MAX_SPAN, MAX_SPAN)),
+         re.compile(r'\[[^\[\]\n]{0,%d}(?:\](?:\([^()\s]{0,%d})?)?\Z' % (MAX_SPAN, MAX_SPAN)), 1),
+    ],
+    '*': [
+        (re.compile(r'\*\*([^*\n]{1,%d})\*\*' % MAX_SPAN), re.compile(r'\*\*[^*\n]{0,%d}\*?\Z' % MAX_SPAN), 1),
+        (re.compile(r'\*([^*\n]{1,%d})\*' % MAX_SPAN), re.compile(r'\*[^*\n]{0,%d}\Z' % MAX_SPAN), 1),
+    ],
+}
+_SPECIAL = re.compile(r'[<\[*]|(?P<marker>medical assistant(?: response)?:\s*)', re.IGNORECASE)
+_MARKERS = ("medical assistant response:", "medical assistant:")
+
+_LEADING = re.compile(r'(?:assistant response|assistant|response):\s*', re.IGNORECASE)
+_LABELS = ("assistant response:", "assistant:", "response:")
+
+_STOPS = ("Patient question:", "User question:", "Q:", "A:")
+_TRAILING = re.compile(r'(?:\s|%s)*\Z' % '|'.join(re.escape(stop) for stop in _STOPS))
+_BLANK_LINES = re.compile(r'\n{3,}')
+
+
+def _partial_suffix(text, start, words, fold=False):
+    """
+    Index of the longest suffix of text[start:] that is a proper start of
+    one of `words`, or len(text) if there is none.
+    """
+    longest = max(len(word) for word in words)
+    for i in range(max(start, len(text) - longest + 1), len(text)):
+        tail = text[i:].lower() if fold else text[i:]
+        if any(word.startswith(tail) for word in words):
+            return i
+    return len(text)
+
+
+def _scan(text, final):
+    """
+    Remove tags, links, emphasis and prompt labels from text.
+
+    Returns:
+        (cleaned text, index where undecided input starts); with final the
+        whole text is decided.
+    """
+    out = []
+    pos = 0
+    while True:
+        match = _SPECIAL.search(text, pos)
+        if match is None:
+            hold = len(text) if final else _partial_suffix(text, pos, _MARKERS, fold=True)
+            out.append(text[pos:hold])
+            return ''.join(out), hold
+
+        start = match.start()
+        out.append(text[pos:start])
+        if match.group('marker') is not None:
+            # The label's trailing whitespace may continue in the next chunk
+            if match.end() == len(text) and not final:
+                return ''.join(out), start
+            pos = match.end()
+            continue
+
+        for complete, incomplete, group in _RULES[text[start]]:
+            found = complete.match(text, start)
+            if found:
+                out.append(_scan(found.group(group), True)[0] if group else '')
+                pos = found.end()
+                break
+            if not final and incomplete.match(text, start):
+                return ''.join(out), start
+        else:
+            out.append(text[start])
+            pos = start + 1
+
+
+class StreamSanitizer:
+    """
+    Incremental sanitize(): feed() each chunk and yield what it returns,
+    then yield close() once the answer is complete.
+    """
+
+    def __init__(self):
+        self._raw = ''  # input not scanned yet
+        self._clean = ''  # scanned text held back by the start and end rules
+        self._started = False
+
+    def feed(self, text):
+        return self._process(text, final=False)
+
+    def close(self):
+        return self._process('', final=True)
+
+    def _process(self, text, final):
+        cleaned, hold = _scan(self._raw + text, final)
+        self._raw = (self._raw + text)[hold:]
+        self._clean += cleaned
+
+        if not self._started and not self._strip_leading(final):
+            return ''
+        clean = self._clean
+        if final:
+            end = _TRAILING.search(clean).start()
+            self._clean = ''
+        else:
+            # Trailing whitespace and stop strings are only dropped at the
+            # end of the answer, so hold them until more text follows
+            end = _TRAILING.search(clean, 0, _partial_suffix(clean, 0, _STOPS)).start()
+            self._clean = clean[end:]
+        return _BLANK_LINES.sub('\n\n', clean[:end])
+
+    def _strip_leading(self, final):
+        """Drop leading whitespace and labels; False while the start is undecided"""
+        while True:
+            clean = self._clean.lstrip()
+            label = _LEADING.match(clean)
+            if label and (label.end() < len(clean) or final):
+                self._clean = clean[label.end():]
+                continue
+            if not final and (label or not clean or _partial_suffix(clean, 0, _LABELS, fold=True) == 0):
+                self._clean = clean
+                return False
+            self._clean = clean
+            self._started = True
+            return True
+
+
+def sanitize(text):
+    """Clean a complete answer; the same output StreamSanitizer gives for it"""
+    return StreamSanitizer()._process(text, final=True)
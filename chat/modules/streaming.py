@@ -0,0 +1,59 @@
+"""
+Helpers for streaming generated text to clients from async code.
+"""
+import asyncio
+
+DEFAULT_FRAME_INTERVAL = 0.05
+DEFAULT_FRAME_CHARS = 512
+
+
+async def iterate(items):
+    """An async iterator over an already available sequence, e.g. a cached answer"""
+    for item in items:
+        yield item
+
+
+async def coalesce(chunks, interval=DEFAULT_FRAME_INTERVAL, max_chars=DEFAULT_FRAME_CHARS):
+    """
+    Merge the chunks of an async iterator into frames.
+
+    A frame is emitted `interval` seconds after its first chunk arrived, or
+    as soon as it holds `max_chars` characters, so a fast generator does not
+    send one tiny frame per token and a slow one is not held back.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    pending = []
+    size = 0
+    deadline = None
+    next_chunk = asyncio.ensure_future(iterator.__anext__())
+    try:
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+            if done:
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+                pending.append(chunk)
+                size += len(chunk)
+                if deadline is None:
+                    deadline = loop.time() + interval
+                if size < max_chars and loop.time() < deadline:
+                    continue
+            if pending:
+                yield ''.join(pending)
+                pending, size, deadline = [], 0, None
+        if pending:
+            yield ''.join(pending)
+    finally:
+        if not next_chunk.done():
+            next_chunk.cancel()
+            try:
+                await next_chunk
+            except (asyncio.CancelledError, Exception):
+                pass
+        if hasattr(iterator, 'aclose'):
+            await iterator.aclose()
@@ -1,2 +1,299 @@
-from django.test import TestCase
+import json
+import os
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
 
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from chat.models import ChatSession
+from chat.modules.batching import BatchSlot, Sequence
+from chat.modules.inference import InferenceJob, InferencePool, InferenceTimeout, get_inference_pool
+from chat.modules.remote import HttpSlot
+from chat.modules.response_cache import ResponseCache
+from chat.modules.sanitizer import StreamSanitizer, sanitize
+from chat.views import find_chat_session, model_ready
+
+
+class FindChatSessionTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='x')
+        self.owned = ChatSession.objects.create(user=self.owner)
+        self.anonymous = ChatSession.objects.create(user=None)
+
+    def test_user_continues_own_session(self):
+        self.assertEqual(find_chat_session(str(self.owned.id), self.owner), self.owned)
+
+    def test_user_cannot_continue_other_sessions(self):
+        other = User.objects.create_user('other', password='x')
+        self.assertIsNone(find_chat_session(str(self.owned.id), other))
+        self.assertIsNone(find_chat_session(str(self.anonymous.id), other))
+
+    def test_anonymous_continues_only_the_session_it_holds(self):
+        session_id = str(self.anonymous.id)
+        self.assertEqual(find_chat_session(session_id, AnonymousUser(), session_id), self.anonymous)
+        self.assertIsNone(find_chat_session(session_id, AnonymousUser()))
+        self.assertIsNone(find_chat_session(session_id, AnonymousUser(), str(self.owned.id)))
+
+    def test_anonymous_cannot_continue_user_session(self):
+        session_id = str(self.owned.id)
+        self.assertIsNone(find_chat_session(session_id, AnonymousUser(), session_id))
+
+    def test_unknown_or_malformed_id(self):
+        self.assertIsNone(find_chat_session('', self.owner))
+        self.assertIsNone(find_chat_session('not-a-uuid', self.owner))
+
+
+@override_settings(CHAT_METRICS_TOKEN='scrape-token')
+class ModelReadyTests(TestCase):
+    def probe(self, **headers):
+        request = RequestFactory().get('/chat/ready/', headers=headers)
+        request.user = AnonymousUser()
+        return model_ready(request)
+
+    @mock.patch('chat.views.is_model_ready', return_value=False)
+    def test_probe_does_not_start_the_model(self, ready):
+        with mock.patch('chat.modules.inference.InferencePool.start') as start:
+            response = self.probe()
+        start.assert_not_called()
+        self.assertEqual(response.status_code, 503)
+
+    @mock.patch('chat.views.is_model_ready', return_value=True)
+    def test_details_only_for_metrics_readers(self, ready):
+        with mock.patch('chat.views.model_status', return_value={'state': 'ready'}):
+            self.assertEqual(json.loads(self.probe().content), {'ready': True})
+            response = self.probe(authorization='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {'ready': True, 'state': 'ready'})
+
+
+class BatchSlotTests(SimpleTestCase):
+    @mock.patch.object(BatchSlot, 'load', side_effect=RuntimeError('model file missing'))
+    def test_jobs_fail_when_the_slot_cannot_load(self, load):
+        pool = InferencePool(workers=1, mode='batch', batch_config={'sequences': 2, 'n_ctx': 512, 'n_ctx_seq': 256})
+        with self.assertLogs('chat.modules.inference', 'ERROR'):
+            job = pool.submit('What is a fever?', {'max_tokens': 4})
+            with self.assertRaisesMessage(RuntimeError, 'model file missing'):
+                list(job.stream(timeout=5))
+        self.assertFalse(pool.is_ready())
+
+    def start_pool(self, step):
+        """Batch pool whose slot runs `step(slot, pool, active, free)` for each scheduler step"""
+        pool = InferencePool(workers=1, mode='batch', batch_config={'sequences': 2, 'n_ctx': 512, 'n_ctx_seq': 256})
+        slot = pool.slots[0]
+        slot.ctx = mock.Mock()
+
+        def admit(pool, active, free):
+            job = pool.take()
+            seq_id = free.pop()
+            active[seq_id] = Sequence(seq_id, job, [1, 2], sampler=mock.Mock())
+            return active[seq_id]
+
+        for patcher in (mock.patch.object(BatchSlot, 'load'),
+                        mock.patch.object(BatchSlot, '_step', lambda slot, *args: step(admit, *args))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        pool.start()
+        self.assertTrue(pool.wait_ready(5))
+        return pool, slot
+
+    def test_failed_step_fails_jobs_in_flight_and_serving_continues(self):
+        def step(admit, pool, active, free):
+            seq = admit(pool, active, free)
+            if seq.job.prompt == 'bad':
+                raise RuntimeError('llama_decode returned -1')
+            seq.job.put('Rest.')
+            del active[seq.seq_id]
+            free.append(seq.seq_id)
+            pool.complete(seq.job)
+
+        with self.assertLogs('chat.modules.batching', 'ERROR'):
+            pool, slot = self.start_pool(step)
+            with self.assertRaisesMessage(RuntimeError, 'llama_decode returned -1'):
+                list(pool.submit('bad', {}).stream(timeout=5))
+        self.assertEqual(''.join(pool.submit('good', {}).stream(timeout=5)), 'Rest.')
+        slot.ctx.kv_cache_clear.assert_called_once()
+        self.assertTrue(pool.is_ready())
+
+    def test_pool_is_not_ready_once_the_slot_stops(self):
+        def step(admit, pool, active, free):
+            admit(pool, active, free)
+            raise RuntimeError('llama_decode returned -1')
+
+        with self.assertLogs('chat.modules', 'ERROR'):
+            pool, slot = self.start_pool(step)
+            slot.ctx.kv_cache_clear.side_effect = RuntimeError('context lost')
+            with self.assertRaisesMessage(RuntimeError, 'llama_decode returned -1'):
+                list(pool.submit('first', {}).stream(timeout=5))
+            # Queued jobs fail instead of waiting for a slot that is gone
+            with self.assertRaisesMessage(RuntimeError, 'context lost'):
+                list(pool.submit('second', {}).stream(timeout=5))
+        self.assertFalse(pool.is_ready())
+
+
+class InferenceJobTests(SimpleTestCase):
+    @override_settings(INFERENCE_STREAM_TIMEOUT=0.05)
+    def test_stream_gives_up_on_a_silent_job(self):
+        job = InferenceJob('What is a fever?', {})
+        job.put('Rest')
+        chunks = job.stream()
+        self.assertEqual(next(chunks), 'Rest')
+        with self.assertRaises(InferenceTimeout):
+            next(chunks)
+        self.assertTrue(job.cancelled.is_set())
+
+
+@override_settings(CHAT_BACKEND='fake', INFERENCE_FAKE_TOKEN_SECONDS=0)
+class InferencePoolForkTests(SimpleTestCase):
+    @mock.patch('chat.modules.inference._pool', None)
+    def test_forked_child_gets_its_own_started_pool(self):
+        parent = get_inference_pool().start()
+        self.assertIs(get_inference_pool(), parent)
+        with mock.patch('chat.modules.inference.os.getpid', return_value=os.getpid() + 1):
+            child = get_inference_pool()
+            self.assertIsNot(child, parent)
+            self.assertTrue(child.started())
+            self.assertIs(get_inference_pool(), child)
+            job = child.submit('What is a fever?', {'max_tokens': 3})
+            self.assertEqual(''.join(job.stream(timeout=5)), 'Thank you for')
+
+
+class CompletionsStub(BaseHTTPRequestHandler):
+    """OpenAI-style streaming /completions endpoint replaying `events`"""
+    events = []
+    requests = []
+
+    def do_POST(self):
+        self.requests.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for event in self.events:
+            self.wfile.write(b'data: ' + (event if isinstance(event, bytes) else json.dumps(event).encode()) + b'\n\n')
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpSlotTests(SimpleTestCase):
+    def setUp(self):
+        server = HTTPServer(('127.0.0.1', 0), CompletionsStub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        CompletionsStub.requests = []
+        self.slot = HttpSlot(0, f'http://127.0.0.1:{server.server_port}/v1', 'local', api_key='key')
+
+    def run_job(self, events):
+        CompletionsStub.events = events
+        job = InferenceJob('Patient question: What is a fever?', {'max_tokens': 16, 'stop': ['Q:']})
+        self.slot.run(job)
+        return job
+
+    def test_streams_text_and_uses_reported_token_counts(self):
+        job = self.run_job([
+            {'choices': [{'text': 'Rest and '}]},
+            {'choices': [{'text': 'fluids.'}]},
+            {'choices': [], 'usage': {'prompt_tokens': 9, 'completion_tokens': 5}},
+        ])
+        job.finish()
+        self.assertEqual(''.join(job.stream(timeout=1)), 'Rest and fluids.')
+        self.assertEqual((job.prompt_tokens, job.tokens), (9, 5))
+        request = CompletionsStub.requests[0]
+        self.assertEqual(request['stream_options'], {'include_usage': True})
+        self.assertEqual((request['max_tokens'], request['stop']), (16, ['Q:']))
+
+    def test_counts_chunks_without_usage(self):
+        job = self.run_job([{'choices': [{'text': 'Rest'}]}, {'choices': [{'text': '.'}]}])
+        self.assertEqual(job.tokens, 2)
+
+    def test_malformed_event(self):
+        with self.assertRaisesMessage(RuntimeError, 'malformed event'):
+            self.run_job([b'{"choices": ['])
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        import numpy as np
+
+        self.cache = ResponseCache(embeddings=True)
+        # Every prompt embeds to the same vector, so any two questions are "similar"
+        embed = mock.patch.object(ResponseCache, '_embed', return_value=np.ones(4, dtype=np.float32) / 2)
+        embed.start()
+        self.addCleanup(embed.stop)
+        self.cache.put('What is CKD?', 'Chronic kidney disease.', 3.0, owner='user:1')
+
+    def test_exact_match_is_shared(self):
+        self.assertEqual(self.cache.get('what is ckd', owner='user:2'), 'Chronic kidney disease.')
+        self.assertEqual(self.cache.get('What is CKD'), 'Chronic kidney disease.')
+
+    def test_similar_match_only_for_the_same_user(self):
+        self.assertEqual(self.cache.get('What does CKD mean?', owner='user:1'), 'Chronic kidney disease.')
+        self.assertIsNone(self.cache.get('What does CKD mean?', owner='user:2'))
+        self.assertIsNone(self.cache.get('What does CKD mean?'))
+
+
+class SanitizerTests(SimpleTestCase):
+    PIECES = [
+        "Medical assistant:", " Medical assistant response: ", "medical", " assis", "tant", ":", "<b>", "</b>",
+        "<", ">", "[link](http://example.com)", "[", "]", "(", ")", "**bold**", "*", "**", "\n", "\n\n\n", " ",
+        "Q:", "A:", "Patient question:", "Assistant:", "Response:", "Rest", "and fluids.", "2 * 3", "FAQ",
+    ]
+
+    def test_cleans_answer(self):
+        text = (
+            "Medical assistant: Chronic kidney disease (CKD) <b>early</b> signs include **fatigue**, "
+            "*swelling* and [changes](http://example.com) in urination.\n\n\n\nSee a doctor.\n\nQ:"
+        )
+        self.assertEqual(
+            sanitize(text),
+            "Chronic kidney disease (CKD) early signs include fatigue, swelling and changes in urination.\n\n"
+            "See a doctor.",
+        )
+        self.assertEqual(sanitize("  Assistant: Drink water."), "Drink water.")
+        self.assertEqual(sanitize("blood sugar < 100 is low."), "blood sugar < 100 is low.")
+
+    def test_stream_matches_whole_text(self):
+        generator = random.Random(1)
+        for _ in range(2000):
+            text = ''.join(generator.choice(self.PIECES) for _ in range(generator.randint(0, 20)))
+            sanitizer = StreamSanitizer()
+            streamed = []
+            start = 0
+            while start < len(text):
+                end = start + generator.randint(1, 6)
+                streamed.append(sanitizer.feed(text[start:end]))
+                start = end
+            streamed.append(sanitizer.close())
+            self.assertEqual(''.join(streamed), sanitize(text), repr(text))
+
+    def test_holds_back_only_a_possible_marker(self):
+        sanitizer = StreamSanitizer()
+        self.assertEqual(sanitizer.feed("Hello. Medical assis"), "Hello.")
+        self.assertEqual(sanitizer.feed("tant: Drink") + sanitizer.feed(" water") + sanitizer.close(),
+                         " Drink water")
+
+
+class SequenceTests(SimpleTestCase):
+    def sequence(self, stop):
+        job = InferenceJob('prompt', {'max_tokens': 8, 'stop': stop})
+        return Sequence(0, job, [1, 2, 3], sampler=None)
+
+    def test_holds_back_a_possible_stop_string(self):
+        seq = self.sequence(['Patient question:'])
+        self.assertEqual(seq.feed(b'Rest well. Pati'), ('Rest well. ', False))
+        self.assertEqual(seq.feed(b'ence helps.'), ('Patience helps.', False))
+
+    def test_ends_at_a_stop_string(self):
+        seq = self.sequence(['Q:'])
+        self.assertEqual(seq.feed(b'Drink water.\nQ'), ('Drink water.\n', False))
+        self.assertEqual(seq.feed(b': next'), ('', True))
+
+    def test_joins_split_utf8(self):
+        seq = self.sequence([])
+        text = 'fi\u00e8vre'.encode('utf-8')
+        self.assertEqual(seq.feed(text[:3]), ('fi', False))
+        self.assertEqual(seq.feed(text[3:]), ('\u00e8vre', False))
@@ -6,6 +6,9 @@ app_name = 'chat'
 urlpatterns = [
     path('', views.chat, name='chat'),
     path('stream/', views.chat_stream, name='chat_stream'),
+    path('stream-async/', views.chat_stream_async, name='chat_stream_async'),
     path('new-session/', views.new_session, name='new_session'),
     path('delete-session/<uuid:session_id>/', views.delete_session, name='delete_session'),
+    path('ready/', views.model_ready, name='model_ready'),
+    path('metrics/', views.inference_metrics, name='inference_metrics'),
 ]
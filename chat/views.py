@@ -1,15 +1,76 @@
 # views.py
 
 from django.shortcuts import render, get_object_or_404
-from django.http import JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
+from asgiref.sync import sync_to_async
 from .models import Conversation, ChatSession
-from .modules.ai import AsklamaStream
+from .modules.ai import (
+    AsklamaStream, AsklamaStreamAsync, cached_response, is_model_ready, model_status,
+    submit_prompt,
+)
+from .modules.context import build_history
+from .modules.response_cache import replay_chunks
+from .modules.inference import InferenceBusy, get_inference_pool
+from .modules.metrics import get_inference_metrics, request_trace
+from .modules.streaming import iterate
 from main.utils.audit_log import log_phi_access
+import asyncio
 import json
+import logging
+import threading
 import uuid
 
+logger = logging.getLogger(__name__)
+
+def get_user_key(request):
+    """Identity used for per-user fairness in the inference queue"""
+    if request.user.is_authenticated:
+        return f"user:{request.user.id}"
+    if request.session.session_key:
+        return f"session:{request.session.session_key}"
+    return f"ip:{request.META.get('REMOTE_ADDR')}"
+
+async def aget_user_key(request, user):
+    """get_user_key() for async views, with the user already resolved"""
+    if user.is_authenticated:
+        return f"user:{user.id}"
+    session_key = await sync_to_async(lambda: request.session.session_key)()
+    if session_key:
+        return f"session:{session_key}"
+    return f"ip:{request.META.get('REMOTE_ADDR')}"
+
+def find_chat_session(session_id, user, current_session_id=None):
+    """
+    The chat session with this id if the user may continue it, else None.
+    Anonymous users may only continue the session recorded in their own
+    Django session (current_session_id), since its history goes into the
+    prompt.
+    """
+    if not session_id:
+        return None
+    try:
+        chat_session = ChatSession.objects.get(id=session_id)
+    except (ChatSession.DoesNotExist, ValidationError):
+        return None
+    # Ensure user can only access their own sessions
+    if user.is_authenticated:
+        if chat_session.user_id != user.id:
+            return None
+    elif chat_session.user_id is not None or str(chat_session.id) != current_session_id:
+        return None
+    return chat_session
+
+def busy_response(error):
+    """503 with Retry-After for a saturated inference queue"""
+    response = JsonResponse({'error': str(error), 'retry_after': error.retry_after}, status=503)
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
 def chat(request):
     error_message = ''
     
@@ -46,7 +107,7 @@ def chat(request):
     # Get conversations for current session
     conversations = []
     if current_session:
-        conversations = current_session.conversations.all().order_by('created_at')
+        conversations = current_session.conversations.order_by('created_at').decrypted('prompt', 'response')
     
     # Get all sessions for the sidebar
     if request.user.is_authenticated:
@@ -62,6 +123,8 @@ def chat(request):
                 pass
     
     return render(request, 'chat/chat.html', {
+        # The async endpoint only streams unbuffered when served over ASGI
+        'stream_url': reverse('chat:chat_stream_async' if getattr(settings, 'CHAT_STREAM_ASYNC', False) else 'chat:chat_stream'),
         'error_message': error_message,
         'current_session': current_session,
         'conversations': conversations,
@@ -77,44 +140,62 @@ def chat_stream(request):
     if not prompt:
         return JsonResponse({'error': 'Please enter a valid prompt.'}, status=400)
     
+    # Follow-up questions carry the session's recent turns. A new session's
+    # id is chosen now so its first answer can already be kept for reuse.
+    found_session = find_chat_session(session_id, request.user, request.session.get('current_chat_session_id'))
+    history = build_history(found_session)
+    context_key = str(found_session.id if found_session else uuid.uuid4())
+    
+    # A repeated question is replayed from the response cache; otherwise
+    # queue the generation before streaming starts so a saturated pool
+    # answers with a fast 503 instead of tying up this thread
+    job = None
+    cancel_event = threading.Event()
+    user_key = get_user_key(request)
+    cached = cached_response(prompt, user_key) if not history else None
+    if cached is None:
+        try:
+            job = submit_prompt(prompt, 2000, user_key=user_key, cancel_event=cancel_event,
+                                history=history, context_key=context_key)
+        except InferenceBusy as e:
+            return busy_response(e)
+    
     def generate():
         """Generator function for streaming responses"""
         full_response = ""
+        chunks = None
         try:
             # Get or create session
-            if session_id:
-                try:
-                    chat_session = ChatSession.objects.get(id=session_id)
-                    # Ensure user can only access their own sessions
-                    if request.user.is_authenticated and chat_session.user != request.user:
-                        chat_session = None
-                except ChatSession.DoesNotExist:
-                    chat_session = None
-            else:
-                chat_session = None
-            
+            chat_session = found_session
             if not chat_session:
                 # Create new session
                 chat_session = ChatSession.objects.create(
+                    id=context_key,
                     user=request.user if request.user.is_authenticated else None,
                     title=prompt[:50] + "..." if len(prompt) > 50 else prompt
                 )
                 if not request.user.is_authenticated:
                     request.session['current_chat_session_id'] = str(chat_session.id)
             
-            # Stream the AI response
-            for chunk in AsklamaStream(prompt, 2000):
+            # Stream the AI response (or replay the cached one the same way)
+            chunks = replay_chunks(cached) if cached is not None else AsklamaStream(prompt, 2000, job=job, cancel_event=cancel_event, history=history)
+            for chunk in chunks:
                 if chunk:
                     full_response += chunk
                     # Send chunk as JSON
                     yield f"data: {json.dumps({'chunk': chunk, 'done': False, 'session_id': str(chat_session.id)})}\n\n"
             
+            # A cancelled answer is incomplete: keep neither it nor an audit entry
+            if cancel_event.is_set():
+                return
+            
             # Save the conversation after streaming is complete
             if full_response.strip():
                 conversation = Conversation.objects.create(
                     session=chat_session,
                     prompt=prompt, 
-                    response=full_response.strip()
+                    response=full_response.strip(),
+                    inference_trace=request_trace(job),
                 )
                 
                 # Update session title if it's the first message
@@ -129,7 +210,8 @@ def chat_stream(request):
                     resource_type='conversation',
                     resource_id=str(conversation.id),
                     request=request,
-                    details={'prompt_length': len(prompt), 'response_length': len(full_response), 'session_id': str(chat_session.id)}
+                    details={'prompt_length': len(prompt), 'response_length': len(full_response), 'session_id': str(chat_session.id),
+                             'cached_response': cached is not None}
                 )
                 
                 # Send final message
@@ -137,10 +219,112 @@ def chat_stream(request):
             else:
                 yield f"data: {json.dumps({'error': 'No response generated. Please try again.', 'done': True})}\n\n"
                 
+        except GeneratorExit:
+            # The server closes the stream when the client disconnects:
+            # stop the generation at its next token
+            cancel_event.set()
+            raise
         except Exception as e:
-            print(f"Error during AI streaming: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error during AI streaming: %s", e)
+            yield f"data: {json.dumps({'error': 'An error occurred while processing your request. Please try again.', 'done': True})}\n\n"
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+    
+    response = StreamingHttpResponse(generate(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@require_http_methods(["POST"])
+async def chat_stream_async(request):
+    """
+    chat_stream for ASGI deployments: the same SSE events, produced by an
+    async generator that awaits the inference worker and uses the async
+    ORM, so an open stream does not pin a thread.
+
+    When the client disconnects Django cancels the generator; the job is
+    cancelled with it and nothing is saved or audited.
+    """
+    prompt = request.POST.get('prompt', '').strip()
+    session_id = request.POST.get('session_id', '').strip()
+    
+    if not prompt:
+        return JsonResponse({'error': 'Please enter a valid prompt.'}, status=400)
+    
+    user = await request.auser()
+    current_session_id = await request.session.aget('current_chat_session_id')
+    found_session = await sync_to_async(find_chat_session)(session_id, user, current_session_id)
+    history = await sync_to_async(build_history)(found_session)
+    context_key = str(found_session.id if found_session else uuid.uuid4())
+    job = None
+    cancel_event = threading.Event()
+    user_key = await aget_user_key(request, user)
+    # The semantic lookup embeds the prompt, so keep it off the loop
+    cached = None
+    if not history:
+        cached = await sync_to_async(cached_response, thread_sensitive=False)(prompt, user_key)
+    if cached is None:
+        try:
+            job = submit_prompt(prompt, 2000, user_key=user_key, cancel_event=cancel_event,
+                                history=history, context_key=context_key)
+        except InferenceBusy as e:
+            return busy_response(e)
+    
+    async def generate():
+        full_response = ""
+        try:
+            chat_session = found_session
+            if not chat_session:
+                chat_session = await ChatSession.objects.acreate(
+                    id=context_key,
+                    user=user if user.is_authenticated else None,
+                    title=prompt[:50] + "..." if len(prompt) > 50 else prompt
+                )
+                if not user.is_authenticated:
+                    await request.session.aset('current_chat_session_id', str(chat_session.id))
+            
+            chunks = iterate(replay_chunks(cached)) if cached is not None else AsklamaStreamAsync(prompt, 2000, job=job, cancel_event=cancel_event, history=history)
+            async for chunk in chunks:
+                if chunk:
+                    full_response += chunk
+                    yield f"data: {json.dumps({'chunk': chunk, 'done': False, 'session_id': str(chat_session.id)})}\n\n"
+            
+            if cancel_event.is_set():
+                return
+            
+            if full_response.strip():
+                conversation = await Conversation.objects.acreate(
+                    session=chat_session,
+                    prompt=prompt,
+                    response=full_response.strip(),
+                    inference_trace=request_trace(job),
+                )
+                
+                if await chat_session.conversations.acount() == 1:
+                    chat_session.title = prompt[:50] + "..." if len(prompt) > 50 else prompt
+                    await chat_session.asave()
+                
+                await sync_to_async(log_phi_access)(
+                    user=user if user.is_authenticated else None,
+                    action='create',
+                    resource_type='conversation',
+                    resource_id=str(conversation.id),
+                    request=request,
+                    details={'prompt_length': len(prompt), 'response_length': len(full_response), 'session_id': str(chat_session.id),
+                             'cached_response': cached is not None}
+                )
+                
+                yield f"data: {json.dumps({'chunk': '', 'done': True, 'conversation_id': conversation.id, 'session_id': str(chat_session.id)})}\n\n"
+            else:
+                yield f"data: {json.dumps({'error': 'No response generated. Please try again.', 'done': True})}\n\n"
+        
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client disconnected: stop generating, save nothing
+            cancel_event.set()
+            raise
+        except Exception as e:
+            logger.exception("Error during AI streaming: %s", e)
             yield f"data: {json.dumps({'error': 'An error occurred while processing your request. Please try again.', 'done': True})}\n\n"
     
     response = StreamingHttpResponse(generate(), content_type='text/event-stream')
@@ -170,3 +354,36 @@ def delete_session(request, session_id):
         return JsonResponse({'success': True})
     except ChatSession.DoesNotExist:
         return JsonResponse({'error': 'Session not found'}, status=404)
+
+@require_http_methods(["GET"])
+def model_ready(request):
+    """
+    Readiness probe: 200 once the chat model is loaded and warmed up, 503
+    before. Model and queue details are only included for can_read_metrics().
+    """
+    ready = is_model_ready()
+    body = {'ready': ready}
+    if can_read_metrics(request):
+        body.update(model_status())
+    return JsonResponse(body, status=200 if ready else 503)
+
+def can_read_metrics(request):
+    """Staff users, or a scraper sending CHAT_METRICS_TOKEN as a bearer token"""
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    token = getattr(settings, 'CHAT_METRICS_TOKEN', None)
+    return bool(token) and request.headers.get('Authorization') == f"Bearer {token}"
+
+def inference_metrics(request):
+    """
+    Latency and token histograms of recent LLM calls plus the inference
+    queue's state, as JSON or with ?format=prometheus as Prometheus text
+    """
+    if not can_read_metrics(request):
+        return JsonResponse({'error': 'Forbidden'}, status=403)
+    metrics = get_inference_metrics()
+    pool = get_inference_pool().metrics()
+    if request.GET.get('format') == 'prometheus':
+        gauges = {name: pool[name] for name in ('queue_depth', 'running', 'capacity')}
+        return HttpResponse(metrics.prometheus(gauges), content_type='text/plain; version=0.0.4')
+    return JsonResponse(dict(metrics.snapshot(), pool=pool))
@@ -1,10 +1,19 @@
 from django.contrib import admin
-from .models import DoctorProfile, PatientProfile, Appointment, Contact, Report, AuditLog
+from .models import DoctorProfile, PatientProfile, Appointment, Contact, Report, AuditLog, AuditAccessSummary
 
 @admin.register(DoctorProfile)
 class DoctorProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'specialization', 'office_location')
     readonly_fields = ('phone_number',)  # Encrypted field - read-only in admin
+    search_fields = ('user__username', 'specialization')
+    
+    def get_search_results(self, request, queryset, search_term):
+        # Exact phone number match through the blind index
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            # Match within the incoming queryset to keep the changelist's filters
+            results |= queryset.match(phone_number=search_term)
+        return results, may_have_duplicates
     
     def get_readonly_fields(self, request, obj=None):
         # Make encrypted fields read-only to prevent accidental exposure
@@ -14,6 +23,15 @@ class DoctorProfileAdmin(admin.ModelAdmin):
 class PatientProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'age', 'gender')
     readonly_fields = ('medical_history', 'contact_number')  # Encrypted fields
+    search_fields = ('user__username',)
+    
+    def get_search_results(self, request, queryset, search_term):
+        # Exact contact number match through the blind index
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if search_term:
+            # Match within the incoming queryset to keep the changelist's filters
+            results |= queryset.match(contact_number=search_term)
+        return results, may_have_duplicates
     
     def get_readonly_fields(self, request, obj=None):
         # Make encrypted fields read-only to prevent accidental exposure
@@ -53,3 +71,16 @@ class AuditLogAdmin(admin.ModelAdmin):
     
     def has_change_permission(self, request, obj=None):
         return False  # Prevent modification of audit logs
+
+@admin.register(AuditAccessSummary)
+class AuditAccessSummaryAdmin(admin.ModelAdmin):
+    list_display = ('patient', 'accessor', 'resource_type', 'day', 'access_count', 'last_access')
+    list_filter = ('resource_type', 'day')
+    search_fields = ('patient__username', 'accessor__username')
+    date_hierarchy = 'day'
+
+    def has_add_permission(self, request):
+        return False  # Maintained by the audit log writer
+
+    def has_change_permission(self, request, obj=None):
+        return False
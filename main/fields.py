@@ -1,24 +1,98 @@
 """
 Custom encrypted fields for Django models
 """
+import re
 from django.db import models
+from django.db.models import ExpressionWrapper, F
+from django.db.models.query_utils import DeferredAttribute
 from django.core.exceptions import ValidationError
-from main.utils.encryption import encrypt_data, decrypt_data
+from main.utils.encryption import encrypt_data, decrypt_data, decrypt_many, is_ciphertext, is_encrypted, blind_index
 
-class EncryptedTextField(models.TextField):
+class EncryptedValue:
     """
-    Encrypted text field for storing sensitive data
-    Automatically encrypts on save and decrypts on retrieval
+    Ciphertext loaded from the database that has not been decrypted yet.
+    Used by lazy encrypted fields in place of the plaintext.
+    """
+    __slots__ = ('ciphertext',)
+
+    def __init__(self, ciphertext):
+        self.ciphertext = ciphertext
+
+    def __repr__(self):
+        return '<EncryptedValue>'
+
+
+def decrypted_or_placeholder(ciphertext, plaintext):
+    """
+    The plaintext, or an EncryptedValue when decryption failed and handed
+    the envelope back unchanged, so saving the instance stores the original
+    ciphertext instead of encrypting it a second time
+    """
+    if plaintext == ciphertext and is_encrypted(ciphertext):
+        return EncryptedValue(ciphertext)
+    return plaintext
+
+
+class LazyDecryptDescriptor(DeferredAttribute):
+    """
+    Attribute descriptor for lazy encrypted fields.
+    Decrypts on first read and memoizes the plaintext on the instance.
+    """
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if isinstance(value, EncryptedValue):
+            value = decrypted_or_placeholder(value.ciphertext, decrypt_data(value.ciphertext))
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        # Defining __set__ makes this a data descriptor, so __get__ runs even
+        # once the value is in the instance __dict__
+        instance.__dict__[self.field.attname] = value
+
+
+class EncryptedFieldMixin:
+    """
+    Shared behaviour for encrypted model fields.
+
+    With lazy=True, rows are loaded with the ciphertext untouched and the
+    value is only decrypted when the attribute is first read. Unread values
+    are written back as-is on save, without a decrypt/encrypt round trip.
     """
+    def __init__(self, *args, lazy=False, **kwargs):
+        self.lazy = lazy
+        if lazy:
+            self.descriptor_class = LazyDecryptDescriptor
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.lazy:
+            kwargs['lazy'] = True
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        if self.lazy:
+            # getattr() would decrypt an unread EncryptedValue, and
+            # get_prep_value() would then encrypt it again
+            return model_instance.__dict__[self.attname]
+        return super().pre_save(model_instance, add)
+
     def from_db_value(self, value, expression, connection):
         """Decrypt when reading from database"""
         if value is None:
             return value
+        if self.lazy:
+            return EncryptedValue(value)
         # decrypt_data handles legacy unencrypted data gracefully
-        return decrypt_data(value)
+        return decrypted_or_placeholder(value, decrypt_data(value))
     
     def to_python(self, value):
         """Convert to Python string"""
+        if isinstance(value, EncryptedValue):
+            return decrypt_data(value.ciphertext)
         if isinstance(value, str) or value is None:
             return value
         return str(value)
@@ -27,52 +101,144 @@ class EncryptedTextField(models.TextField):
         """Encrypt before saving to database"""
         if value is None:
             return value
+        if isinstance(value, EncryptedValue):
+            return value.ciphertext  # Never decrypted, store unchanged
         if isinstance(value, str) and value.strip():
-            # Check if already encrypted - if decryption works and returns different value, it's encrypted
-            try:
-                decrypted = decrypt_data(value)
-                # If decryption returns same value, it wasn't encrypted
-                if decrypted != value:
-                    return value  # Already encrypted, don't encrypt again
-            except:
-                pass
+            if is_ciphertext(value):
+                return value  # Already encrypted, don't encrypt again
+            # Includes text that only looks like an envelope
             return encrypt_data(value)
         return value
 
-class EncryptedCharField(models.CharField):
+class EncryptedTextField(EncryptedFieldMixin, models.TextField):
+    """
+    Encrypted text field for storing sensitive data
+    Automatically encrypts on save and decrypts on retrieval
+    """
+
+class EncryptedCharField(EncryptedFieldMixin, models.CharField):
     """
     Encrypted char field for storing sensitive data
     Automatically encrypts on save and decrypts on retrieval
     """
-    def from_db_value(self, value, expression, connection):
-        """Decrypt when reading from database"""
-        if value is None:
-            return value
-        # decrypt_data handles legacy unencrypted data gracefully
-        return decrypt_data(value)
-    
-    def to_python(self, value):
-        """Convert to Python string"""
-        if isinstance(value, str) or value is None:
-            return value
-        return str(value)
-    
-    def get_prep_value(self, value):
-        """Encrypt before saving to database"""
-        if value is None:
-            return value
-        if isinstance(value, str) and value.strip():
-            # Check if already encrypted (starts with base64-like pattern)
-            # If it looks encrypted, don't encrypt again
-            try:
-                # Try to decrypt it - if it works, it's already encrypted
-                from main.utils.encryption import decrypt_data
-                decrypted = decrypt_data(value)
-                # If decryption returns same value, it wasn't encrypted
-                if decrypted != value:
-                    return value  # Already encrypted
-            except:
-                pass
-            return encrypt_data(value)
+
+
+def normalize_text(value):
+    """Case- and whitespace-insensitive form used for text blind indexes"""
+    return ' '.join(value.split()).casefold()
+
+def normalize_phone(value):
+    """Keep only digits (and a leading +) so formatting does not matter"""
+    value = value.strip()
+    digits = re.sub(r'\D', '', value)
+    return '+' + digits if value.startswith('+') else digits
+
+BLIND_INDEX_NORMALIZERS = {
+    'text': normalize_text,
+    'phone': normalize_phone,
+}
+
+class BlindIndexField(models.CharField):
+    """
+    Indexed HMAC companion column for an encrypted field.
+    Recomputed from the source field on every save, so exact-match lookups
+    become index seeks instead of decrypting the table.
+
+    QuerySet.update() bypasses save(); rows changed that way need their
+    index recomputed by hand.
+    """
+    # Defaults that differ from CharField's, with CharField's own value
+    DEFAULTS = {
+        'max_length': (64, None),
+        'editable': (False, True),
+        'blank': (True, False),
+        'null': (True, False),
+        'db_index': (True, False),
+    }
+
+    def __init__(self, *args, source=None, normalizer='text', **kwargs):
+        self.source = source
+        self.normalizer = normalizer
+        for key, (default, _) in self.DEFAULTS.items():
+            kwargs.setdefault(key, default)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        if self.normalizer != 'text':
+            kwargs['normalizer'] = self.normalizer
+        for key, (default, char_default) in self.DEFAULTS.items():
+            # CharField.deconstruct() omits its own defaults
+            value = kwargs.pop(key, char_default)
+            if value != default:
+                kwargs[key] = value
+        return name, path, args, kwargs
+
+    def compute_index(self, value):
+        """Blind index of a plaintext value of the source field"""
+        if not value:
+            return None
+        return blind_index(BLIND_INDEX_NORMALIZERS[self.normalizer](value), context=self.source)
+
+    def pre_save(self, model_instance, add):
+        source = getattr(model_instance, self.source)
+        if isinstance(source, EncryptedValue):
+            # Not decryptable with the configured keys; keep the stored index
+            return getattr(model_instance, self.attname)
+        value = self.compute_index(source)
+        setattr(model_instance, self.attname, value)
         return value
 
+
+class EncryptedQuerySet(models.QuerySet):
+    """
+    QuerySet with a bulk decryption path for encrypted columns
+    """
+    def decrypted(self, *field_names, max_workers=None):
+        """
+        Evaluate the queryset and decrypt encrypted columns in one pass.
+
+        The raw ciphertext is selected instead of going through
+        from_db_value row by row, then each column is decrypted with a single
+        decrypt_many() call. Defaults to every encrypted field on the model.
+
+        Returns:
+            List of model instances with plaintext values set
+        """
+        if not field_names:
+            field_names = [
+                field.name for field in self.model._meta.concrete_fields
+                if isinstance(field, EncryptedFieldMixin)
+            ]
+        raw_names = {name: f'_raw_{name}' for name in field_names}
+        queryset = self.defer(*field_names).annotate(**{
+            raw_name: ExpressionWrapper(F(name), output_field=models.TextField())
+            for name, raw_name in raw_names.items()
+        })
+        instances = list(queryset)
+
+        for name, raw_name in raw_names.items():
+            ciphertexts = [getattr(instance, raw_name) for instance in instances]
+            plaintexts = decrypt_many(ciphertexts, max_workers=max_workers)
+            for instance, ciphertext, plaintext in zip(instances, ciphertexts, plaintexts):
+                # Setting a deferred attribute stores it without another query
+                setattr(instance, name, decrypted_or_placeholder(ciphertext, plaintext))
+                delattr(instance, raw_name)
+        return instances
+
+    def match(self, **lookups):
+        """
+        Exact-match filter on encrypted fields through their blind index,
+        e.g. PatientProfile.objects.match(contact_number='+1 555 0100').
+        """
+        indexes = {
+            field.source: field for field in self.model._meta.concrete_fields
+            if isinstance(field, BlindIndexField)
+        }
+        filters = {}
+        for name, value in lookups.items():
+            if name not in indexes:
+                raise ValueError(f"{self.model.__name__}.{name} has no blind index")
+            filters[indexes[name].attname] = indexes[name].compute_index(value)
+        return self.filter(**filters)
@@ -0,0 +1,71 @@
+"""
+Move cold months of AuditLog into compressed, checksummed archive segments.
+
+Months older than the last --hot-months (AUDIT_LOG_HOT_MONTHS) are written to
+AUDIT_ARCHIVE_DIR and then deleted from the live table, which keeps the admin's
+date_hierarchy and filters fast. Archived entries stay searchable through
+main.utils.audit_archive.query_audit_logs().
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from main.utils.audit_archive import (
+    DEFAULT_HOT_MONTHS, archivable_months, archive_cutoff, archive_month,
+    finish_pending_purges, get_archive_dir, verify_archive,
+)
+from main.utils.audit_writer import flush_audit_log
+
+
+class Command(BaseCommand):
+    help = "Archive audit log months older than the hot window into compressed segment files"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hot-months', type=int,
+                            default=getattr(settings, 'AUDIT_LOG_HOT_MONTHS', DEFAULT_HOT_MONTHS),
+                            help='Number of recent months (including the current one) kept in the database')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='List the months that would be archived without writing anything')
+        parser.add_argument('--verify', action='store_true',
+                            help='Only check every archived segment against its recorded checksum')
+
+    def handle(self, *args, **options):
+        archive_dir = get_archive_dir()
+
+        if options['verify']:
+            problems = verify_archive(archive_dir)
+            for name, problem in problems:
+                self.stderr.write(f"{name}: {problem}")
+            if problems:
+                raise CommandError(f"{len(problems)} archive segment(s) failed verification")
+            self.stdout.write(self.style.SUCCESS("All archive segments verified"))
+            return
+
+        if options['hot_months'] < 1:
+            raise CommandError("--hot-months must be at least 1")
+
+        cutoff = archive_cutoff(timezone.now(), options['hot_months'])
+        months = archivable_months(cutoff)
+        if options['dry_run']:
+            for label, _, _ in months:
+                self.stdout.write(f"Would archive {label}")
+            self.stdout.write(f"{len(months)} month(s) before {cutoff:%Y-%m-%d}")
+            return
+
+        flush_audit_log()
+        recovered = finish_pending_purges(archive_dir, batch_size=options['batch_size'])
+        if recovered:
+            self.stdout.write(f"Purged {recovered} rows left over from an interrupted run")
+
+        total_rows = total_bytes = 0
+        for label, start, end in months:
+            entry = archive_month(label, start, end, archive_dir, batch_size=options['batch_size'])
+            if entry is None:
+                continue
+            total_rows += entry['rows']
+            total_bytes += entry['bytes']
+            self.stdout.write(f"{entry['file']}: {entry['rows']} rows, {entry['bytes']} bytes")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {total_rows} rows ({total_bytes} bytes) to {archive_dir}"
+        ))
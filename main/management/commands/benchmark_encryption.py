@@ -0,0 +1,122 @@
+"""
+Microbenchmark for field-level encryption.
+
+Compares the per-field cost of the old code path (PBKDF2 key derivation on
+every call) with the cached cipher used by encrypt_data/decrypt_data, and the
+per-row decrypt path with the bulk decrypt_many() path, and optionally the
+throughput of encrypted vs plain file storage.
+"""
+import os
+import tempfile
+import time
+from cryptography.fernet import Fernet
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+from main.storage import EncryptedFileSystemStorage
+from main.utils.encryption import (
+    encrypt_data, decrypt_data, decrypt_many, encrypt_many,
+    get_encryption_key, get_encryption_stats, parse_envelope, reset_cipher_cache,
+)
+
+SAMPLE_TEXT = (
+    "Patient reports intermittent chest pain for two weeks, worse on exertion. "
+    "History of hypertension, currently on amlodipine 5mg daily."
+)
+
+
+class Command(BaseCommand):
+    help = "Benchmark per-field encrypt/decrypt cost with and without the cipher cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200,
+                            help='Number of fields to decrypt for the cached path')
+        parser.add_argument('--uncached-iterations', type=int, default=10,
+                            help='Number of fields to decrypt for the uncached path (slow)')
+        parser.add_argument('--bulk-sizes', default='1000,10000,100000',
+                            help='Comma-separated column sizes for the per-row vs bulk comparison')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Thread pool size for the threaded bulk run')
+        parser.add_argument('--storage-size-mb', type=int, default=0,
+                            help='Size of the file for the encrypted vs plain storage run (0 to skip)')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        uncached_iterations = options['uncached_iterations']
+
+        token = encrypt_data(SAMPLE_TEXT)
+        _, version, raw_token = parse_envelope(token)
+
+        # Before: every field pays a full key derivation
+        started = time.perf_counter()
+        for _ in range(uncached_iterations):
+            Fernet(get_encryption_key(version)).decrypt(raw_token).decode('utf-8')
+        uncached = (time.perf_counter() - started) / uncached_iterations
+
+        # After: the cipher is derived once and reused
+        reset_cipher_cache()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            decrypt_data(token)
+        cached = (time.perf_counter() - started) / iterations
+
+        stats = get_encryption_stats()
+        self.stdout.write(f"Per-field decrypt, uncached: {uncached * 1e6:10.1f} us ({uncached_iterations} runs)")
+        self.stdout.write(f"Per-field decrypt, cached:   {cached * 1e6:10.1f} us ({iterations} runs)")
+        self.stdout.write(f"Speedup: {uncached / cached:.0f}x")
+        self.stdout.write(
+            f"Key derivations: {stats['derivations']} "
+            f"({stats['derivation_seconds'] * 1000:.1f} ms total)"
+        )
+
+        if options['bulk_sizes']:
+            self.benchmark_bulk(
+                [int(size) for size in options['bulk_sizes'].split(',') if size],
+                options['workers'],
+            )
+
+        if options['storage_size_mb']:
+            self.benchmark_storage(options['storage_size_mb'])
+
+    def benchmark_bulk(self, sizes, workers):
+        """Per-row decrypt_data() loop vs decrypt_many() over whole columns"""
+        self.stdout.write("")
+        self.stdout.write(f"{'rows':>8} {'per-row':>10} {'bulk':>10} {f'bulk x{workers}':>10}  (seconds)")
+        for size in sizes:
+            column = encrypt_many([SAMPLE_TEXT] * size)
+
+            started = time.perf_counter()
+            [decrypt_data(value) for value in column]
+            per_row = time.perf_counter() - started
+
+            started = time.perf_counter()
+            decrypt_many(column)
+            bulk = time.perf_counter() - started
+
+            started = time.perf_counter()
+            decrypt_many(column, max_workers=workers)
+            threaded = time.perf_counter() - started
+
+            self.stdout.write(f"{size:>8} {per_row:>10.3f} {bulk:>10.3f} {threaded:>10.3f}")
+
+    def benchmark_storage(self, size_mb):
+        """Write and read back one file through plain and encrypted storage"""
+        payload = os.urandom(size_mb * 1024 * 1024)
+        self.stdout.write("")
+        self.stdout.write(f"{'storage':>10} {'write':>10} {'read':>10}  (MB/s, {size_mb} MB file)")
+        with tempfile.TemporaryDirectory() as location:
+            for label, storage in (
+                ('plain', FileSystemStorage(location=location)),
+                ('encrypted', EncryptedFileSystemStorage(location=location)),
+            ):
+                started = time.perf_counter()
+                name = storage.save(f'{label}.bin', ContentFile(payload))
+                write = time.perf_counter() - started
+
+                started = time.perf_counter()
+                with storage.open(name) as stored:
+                    while stored.read(1024 * 1024):
+                        pass
+                read = time.perf_counter() - started
+
+                self.stdout.write(f"{label:>10} {size_mb / write:>10.1f} {size_mb / read:>10.1f}")
@@ -0,0 +1,79 @@
+"""
+Re-encode format 1 ciphertext envelopes into the compact format 2.
+
+Format 1 wrapped the Fernet token in a second base64 layer. The token is
+re-wrapped as-is, without decrypting, so this is safe to run in the background
+against a live database; --sleep throttles it between batches.
+"""
+import time
+from django.core.management.base import BaseCommand
+from main.utils.encryption import build_envelope, parse_envelope
+from main.utils.reencryption import iter_encrypted_models, rewrite_model, to_envelope
+
+
+def to_compact(raw):
+    """Return the format 2 form of a stored value, or None if already compact"""
+    if raw.startswith('$mc1$'):
+        _, version, token = parse_envelope(raw)
+        return build_envelope(token, version)
+    return to_envelope(raw)
+
+
+class Command(BaseCommand):
+    help = "Re-encode stored ciphertext into the compact envelope format and report bytes saved"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit load')
+        parser.add_argument('--report', action='store_true',
+                            help='Only report the bytes that would be saved, without writing')
+
+    def handle(self, *args, **options):
+        total_before = total_after = 0
+        for model, fields in iter_encrypted_models():
+            sizes = {'before': 0, 'after': 0}
+
+            def transform(raw):
+                new_raw = to_compact(raw)
+                if new_raw is None or new_raw == raw:
+                    # Left as is, so never retried and counted only here
+                    sizes['before'] += len(raw)
+                    sizes['after'] += len(raw)
+                return new_raw
+
+            def count_write(name, pk, old_raw, new_raw):
+                # A rewrite retried after a conflict is counted once it succeeds
+                sizes['before'] += len(old_raw)
+                sizes['after'] += len(new_raw)
+
+            def pause(last_pk, scanned, rewritten):
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+            scanned, rewritten, skipped = rewrite_model(
+                model, fields, transform,
+                batch_size=options['batch_size'],
+                dry_run=options['report'],
+                on_batch=pause,
+                on_write=count_write,
+            )
+            saved = sizes['before'] - sizes['after']
+            total_before += sizes['before']
+            total_after += sizes['after']
+            self.stdout.write(
+                f"{model._meta.db_table}: {scanned} rows, {rewritten} values "
+                f"{'to re-encode' if options['report'] else 're-encoded'}, "
+                f"{sizes['before']} -> {sizes['after']} bytes ({saved} saved)"
+            )
+            if skipped:
+                self.stderr.write(self.style.WARNING(
+                    f"{model._meta.db_table}: {skipped} values kept changing and were left as they are"
+                ))
+
+        if total_before:
+            saved = total_before - total_after
+            self.stdout.write(
+                f"Total: {total_before} -> {total_after} bytes, "
+                f"{saved} saved ({saved / total_before:.1%})"
+            )
@@ -0,0 +1,34 @@
+"""
+Rewrite stored encrypted values into the versioned ciphertext envelope.
+
+Legacy values are either bare base64 Fernet tokens (wrapped without
+re-encryption) or plain text written before the fields were encrypted
+(encrypted now). Values already in the envelope are left alone.
+"""
+from django.core.management.base import BaseCommand
+from main.utils.reencryption import iter_encrypted_models, rewrite_model, to_envelope
+
+
+class Command(BaseCommand):
+    help = "Rewrite encrypted columns into the versioned ciphertext envelope, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Count values that would be rewritten without writing')
+
+    def handle(self, *args, **options):
+        for model, fields in iter_encrypted_models():
+            scanned, rewritten, skipped = rewrite_model(
+                model, fields, to_envelope,
+                batch_size=options['batch_size'],
+                dry_run=options['dry_run'],
+            )
+            self.stdout.write(
+                f"{model._meta.label}: {scanned} rows scanned, {rewritten} values "
+                f"{'to rewrite' if options['dry_run'] else 'rewritten'} ({', '.join(fields)})"
+            )
+            if skipped:
+                self.stderr.write(self.style.WARNING(
+                    f"{model._meta.label}: {skipped} values kept changing and were left as they are; run again"
+                ))
@@ -0,0 +1,196 @@
+"""
+Re-encrypt every encrypted column and every file in encrypted storage under
+the current key version.
+
+Rotation procedure:
+  1. Add the current key to ENCRYPTION_OLD_KEYS under its version.
+  2. Set the new ENCRYPTION_KEY and bump ENCRYPTION_KEY_VERSION.
+  3. Deploy, then run this command. Rows stay readable throughout, because
+     reads resolve old versions through ENCRYPTION_OLD_KEYS.
+  4. The command exits with an error while any value or file is left on an
+     old key version. Once it completes without one, the old key can be
+     removed from ENCRYPTION_OLD_KEYS.
+
+Rows are processed in keyset-paginated batches with one short transaction
+per batch, and progress is checkpointed to a JSON file after every batch, so
+an interrupted run resumes where it stopped.
+"""
+import json
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from main.utils.encryption import (
+    build_envelope, ENVELOPE_FORMAT, get_key_version, get_multi_cipher, is_encrypted, parse_envelope,
+)
+from main.utils.reencryption import (
+    iter_encrypted_file_fields, iter_encrypted_models, reencrypt_files, rewrite_model, to_envelope,
+)
+
+
+class Command(BaseCommand):
+    help = "Re-encrypt encrypted columns and stored files under the current ENCRYPTION_KEY_VERSION (resumable)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit load on a live database')
+        parser.add_argument('--checkpoint', default=os.path.join(settings.BASE_DIR, 'key_rotation_checkpoint.json'),
+                            help='Checkpoint file used to resume an interrupted rotation')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore an existing checkpoint and start from the beginning')
+        parser.add_argument('--models', nargs='*',
+                            help='Only rotate these models (app_label.ModelName)')
+
+    def handle(self, *args, **options):
+        target_version = get_key_version()
+        checkpoint_path = options['checkpoint']
+        checkpoint = self.load_checkpoint(checkpoint_path, target_version, options['restart'])
+
+        if getattr(settings, 'BLIND_INDEX_KEY', None) == getattr(settings, 'ENCRYPTION_KEY', None):
+            self.stderr.write(self.style.WARNING(
+                "BLIND_INDEX_KEY follows ENCRYPTION_KEY; set it explicitly to the previous value "
+                "or blind indexes will stop matching after rotation."
+            ))
+
+        multi_cipher = get_multi_cipher()
+        failures = []
+
+        def rotate(raw):
+            if not is_encrypted(raw):
+                return to_envelope(raw)
+            envelope_format, version, token = parse_envelope(raw)
+            if version == target_version and envelope_format == ENVELOPE_FORMAT:
+                return None
+            try:
+                return build_envelope(multi_cipher.rotate(token), target_version)
+            except Exception as e:
+                failures.append(type(e).__name__)
+                return None
+
+        file_fields = [(model, field, f"{model._meta.label}.{field.name} files")
+                       for model, field in iter_encrypted_file_fields()]
+        labels = [model._meta.label for model, _ in iter_encrypted_models()] + [label for *_, label in file_fields]
+        handled = []
+        skipped_total = 0
+        file_failures = 0
+        for model, fields in iter_encrypted_models():
+            label = model._meta.label
+            if options['models'] and label not in options['models']:
+                continue
+            handled.append(label)
+            state = checkpoint['models'].setdefault(label, {'last_pk': None, 'done': False})
+            if state['done']:
+                self.stdout.write(f"{label}: already rotated, skipping")
+                continue
+
+            started = time.monotonic()
+
+            def on_batch(last_pk, scanned, rewritten):
+                state['last_pk'] = last_pk
+                self.save_checkpoint(checkpoint_path, checkpoint)
+                elapsed = time.monotonic() - started
+                rate = scanned / elapsed if elapsed else 0
+                self.stdout.write(
+                    f"{label}: {scanned} rows scanned, {rewritten} values re-encrypted, "
+                    f"last pk {last_pk}, {rate:.0f} rows/s"
+                )
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+            scanned, rewritten, skipped = rewrite_model(
+                model, fields, rotate,
+                batch_size=options['batch_size'],
+                start_after=state['last_pk'],
+                on_batch=on_batch,
+            )
+            if skipped:
+                # Scan the whole model again on the next run
+                skipped_total += skipped
+                state.update(last_pk=None, done=False)
+                self.save_checkpoint(checkpoint_path, checkpoint)
+                self.stdout.write(self.style.WARNING(
+                    f"{label}: {scanned} rows, {rewritten} values, "
+                    f"{skipped} values left because they kept changing"
+                ))
+                continue
+            state['done'] = True
+            self.save_checkpoint(checkpoint_path, checkpoint)
+            self.stdout.write(self.style.SUCCESS(f"{label}: done ({scanned} rows, {rewritten} values)"))
+
+        for model, field, label in file_fields:
+            if options['models'] and model._meta.label not in options['models']:
+                continue
+            handled.append(label)
+            state = checkpoint['models'].setdefault(label, {'last_pk': None, 'done': False})
+            if state['done']:
+                self.stdout.write(f"{label}: already rotated, skipping")
+                continue
+
+            def on_file_batch(last_pk, scanned, rewritten):
+                state['last_pk'] = last_pk
+                self.save_checkpoint(checkpoint_path, checkpoint)
+                self.stdout.write(f"{label}: {scanned} rows scanned, {rewritten} files re-encrypted, last pk {last_pk}")
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+            scanned, rewritten, failed = reencrypt_files(
+                model, field,
+                batch_size=options['batch_size'],
+                start_after=state['last_pk'],
+                on_batch=on_file_batch,
+            )
+            if failed:
+                file_failures += failed
+                state.update(last_pk=None, done=False)
+                self.save_checkpoint(checkpoint_path, checkpoint)
+                self.stdout.write(self.style.WARNING(
+                    f"{label}: {scanned} rows, {rewritten} files, {failed} files could not be re-encrypted"
+                ))
+                continue
+            state['done'] = True
+            self.save_checkpoint(checkpoint_path, checkpoint)
+            self.stdout.write(self.style.SUCCESS(f"{label}: done ({scanned} rows, {rewritten} files)"))
+
+        if failures:
+            self.stderr.write(self.style.ERROR(
+                f"{len(failures)} values could not be decrypted with any configured key and were left unchanged"
+            ))
+        if skipped_total:
+            self.stderr.write(self.style.ERROR(
+                f"{skipped_total} values were being changed throughout and were left unchanged; run the command again"
+            ))
+        if file_failures:
+            self.stderr.write(self.style.ERROR(
+                f"{file_failures} files could not be read with any configured key and were left unchanged"
+            ))
+        if failures or skipped_total or file_failures:
+            raise CommandError(
+                "Data is still encrypted under old key versions; keep them in ENCRYPTION_OLD_KEYS "
+                "until this command completes without errors"
+            )
+        if all(checkpoint['models'].get(label, {}).get('done') for label in labels):
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+            self.stdout.write(self.style.SUCCESS(f"All encrypted columns and files are on key version {target_version}"))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"{', '.join(handled) or 'No models'} on key version {target_version}; "
+                f"other models still need rotating"
+            ))
+
+    def load_checkpoint(self, path, target_version, restart):
+        if not restart and os.path.exists(path):
+            with open(path) as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('target_version') == target_version:
+                self.stdout.write(f"Resuming rotation to key version {target_version} from {path}")
+                return checkpoint
+        return {'target_version': target_version, 'models': {}}
+
+    def save_checkpoint(self, path, checkpoint):
+        # Write-then-rename so a crash never leaves a truncated checkpoint
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, path)
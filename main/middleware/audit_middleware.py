@@ -2,66 +2,43 @@
 Middleware for automatic audit logging of PHI access
 """
 from main.utils.audit_log import log_phi_access
+from main.utils.audit_policy import compile_audit_policy, resolve_resource_id
 
 class PHIAuditMiddleware:
     """
-    Middleware to automatically log access to Protected Health Information
+    Middleware to automatically log access to Protected Health Information.
+
+    Which views are audited is declared in main.utils.audit_policy; the policy
+    is compiled once here and looked up by resolved view name per request.
     """
     def __init__(self, get_response):
         self.get_response = get_response
+        self.policy = compile_audit_policy()
 
     def __call__(self, request):
         # Process request
         response = self.get_response(request)
-        
-        # Log PHI access for specific views
-        if request.user.is_authenticated:
-            # Check if this is a view that accesses PHI
-            path = request.path
-            
-            # Patient profile access
-            if '/patient/dashboard/' in path or '/patient/' in path:
-                log_phi_access(
-                    user=request.user,
-                    action='access',
-                    resource_type='patient_profile',
-                    resource_id=str(request.user.id),
-                    request=request,
-                    details={'path': path, 'method': request.method}
-                )
-            
-            # Doctor profile access
-            elif '/doctor/dashboard/' in path or '/doctor/' in path:
-                log_phi_access(
-                    user=request.user,
-                    action='access',
-                    resource_type='patient_profile',
-                    resource_id=str(request.user.id),
-                    request=request,
-                    details={'path': path, 'method': request.method}
-                )
-            
-            # Appointment access
-            elif '/appointment/' in path or '/book-appointment/' in path:
-                log_phi_access(
-                    user=request.user,
-                    action='access',
-                    resource_type='appointment',
-                    resource_id='multiple',
-                    request=request,
-                    details={'path': path, 'method': request.method}
-                )
-            
-            # Medical reports/scans
-            elif '/scans/' in path:
-                log_phi_access(
-                    user=request.user,
-                    action='access',
-                    resource_type='scan',
-                    resource_id='multiple',
-                    request=request,
-                    details={'path': path, 'method': request.method}
-                )
-        
-        return response
 
+        # The view already wrote its own, more specific entry
+        if getattr(request, '_phi_audit_logged', False):
+            return response
+
+        match = request.resolver_match
+        if match is None or not request.user.is_authenticated:
+            return response
+
+        rule = self.policy.get(match.view_name)
+        if rule is not None:
+            details = {'path': request.path, 'method': request.method, 'view': match.view_name}
+            if rule.patient == 'user':
+                details['patient_ids'] = [request.user.id]
+            log_phi_access(
+                user=request.user,
+                action=rule.action,
+                resource_type=rule.resource_type,
+                resource_id=resolve_resource_id(rule, request),
+                request=request,
+                details=details
+            )
+
+        return response
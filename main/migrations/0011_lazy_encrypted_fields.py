@@ -0,0 +1,30 @@
+# Generated by Django 5.2 on 2026-10-17 10:12
+
+import main.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_alter_appointment_medical_history_and_more'),
+        ('main', '0010_alter_review_rating'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='appointment',
+            name='medical_history',
+            field=main.fields.EncryptedTextField(blank=True, help_text='Encrypted medical history for appointment', lazy=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='appointment',
+            name='notes',
+            field=main.fields.EncryptedTextField(blank=True, help_text='Encrypted appointment notes', lazy=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='patientprofile',
+            name='medical_history',
+            field=main.fields.EncryptedTextField(blank=True, help_text='Encrypted medical history', lazy=True),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2 on 2026-10-17 11:40
+
+import main.fields
+from django.db import migrations
+
+
+def populate_blind_indexes(apps, schema_editor):
+    """Compute blind indexes for rows saved before the columns existed"""
+    for model_name, index_name in (('DoctorProfile', 'phone_number_index'),
+                                   ('PatientProfile', 'contact_number_index')):
+        Model = apps.get_model('main', model_name)
+        field = Model._meta.get_field(index_name)
+        batch = []
+        for obj in Model.objects.iterator(chunk_size=500):
+            setattr(obj, index_name, field.compute_index(getattr(obj, field.source)))
+            batch.append(obj)
+            if len(batch) >= 500:
+                Model.objects.bulk_update(batch, [index_name])
+                batch = []
+        if batch:
+            Model.objects.bulk_update(batch, [index_name])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_lazy_encrypted_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='doctorprofile',
+            name='phone_number_index',
+            field=main.fields.BlindIndexField(normalizer='phone', source='phone_number'),
+        ),
+        migrations.AddField(
+            model_name='patientprofile',
+            name='contact_number_index',
+            field=main.fields.BlindIndexField(normalizer='phone', source='contact_number'),
+        ),
+        migrations.RunPython(populate_blind_indexes, migrations.RunPython.noop),
+    ]
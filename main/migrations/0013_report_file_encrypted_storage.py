@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-17 13:05
+
+import main.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_blind_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='report',
+            name='file',
+            field=models.FileField(help_text='Encrypted file storage', storage=main.storage.get_encrypted_storage, upload_to='patient_reports/'),
+        ),
+    ]
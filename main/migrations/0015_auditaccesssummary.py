@@ -0,0 +1,46 @@
+# Generated by Django 5.2 on 2026-10-17 12:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_alter_auditlog_timestamp'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditAccessSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_type', models.CharField(choices=[('patient_profile', 'Patient Profile'), ('appointment', 'Appointment'), ('medical_history', 'Medical History'), ('report', 'Medical Report'), ('scan', 'Medical Scan'), ('conversation', 'Chat Conversation')], max_length=50)),
+                ('day', models.DateField()),
+                ('access_count', models.PositiveIntegerField(default=0)),
+                ('first_access', models.DateTimeField()),
+                ('last_access', models.DateTimeField()),
+                ('accessor', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='accessed_summaries', to=settings.AUTH_USER_MODEL)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='access_summaries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Audit Access Summary',
+                'verbose_name_plural': 'Audit Access Summaries',
+                'ordering': ['-day'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='auditaccesssummary',
+            index=models.Index(fields=['patient', 'day'], name='main_audita_patient_a8ef6a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditaccesssummary',
+            index=models.Index(fields=['accessor', 'day'], name='main_audita_accesso_450571_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='auditaccesssummary',
+            constraint=models.UniqueConstraint(fields=('patient', 'accessor', 'resource_type', 'day'), name='unique_access_summary_per_day'),
+        ),
+    ]
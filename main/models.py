@@ -2,16 +2,21 @@ from django.contrib.auth.models import User
 from django.db import models
 from django.core.validators import MinValueValidator, MaxValueValidator
 from datetime import timedelta
-from main.fields import EncryptedTextField, EncryptedCharField
+from django.utils import timezone
+from main.fields import EncryptedTextField, EncryptedCharField, EncryptedQuerySet, BlindIndexField
+from main.storage import get_encrypted_storage
 
 class DoctorProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, unique=True)
     specialization = models.CharField(max_length=255)
     office_location = models.CharField(max_length=255)
     phone_number = EncryptedCharField(max_length=15, blank=True, null=True, help_text="Encrypted phone number")
+    phone_number_index = BlindIndexField(source='phone_number', normalizer='phone')
     consultation_fee = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     profile_picture = models.ImageField(upload_to='doctor_profiles/', blank=True, null=True)
 
+    objects = EncryptedQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.user.username} - {self.specialization}"
 
@@ -25,15 +30,18 @@ class PatientProfile(models.Model):
         validators=[MinValueValidator(0), MaxValueValidator(120)]
     )
     # Encrypted fields for HIPAA compliance
-    medical_history = EncryptedTextField(blank=True, help_text="Encrypted medical history")
+    medical_history = EncryptedTextField(blank=True, lazy=True, help_text="Encrypted medical history")
     gender = models.CharField(
         max_length=10,
         choices=[('male', 'Male'), ('female', 'Female'), ('other', 'Other')],
         blank=True, null=True
     )
     contact_number = EncryptedCharField(max_length=15, blank=True, null=True, help_text="Encrypted contact number")
+    contact_number_index = BlindIndexField(source='contact_number', normalizer='phone')
     profile_picture = models.ImageField(upload_to='patient_profiles/', blank=True, null=True)
 
+    objects = EncryptedQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.user.username} - {self.age} years old"
 
@@ -69,11 +77,13 @@ class Appointment(models.Model):
         choices=APPOINTMENT_STATUS_CHOICES, 
         default='pending'
     )
-    medical_history = EncryptedTextField(blank=True, null=True, help_text="Encrypted medical history for appointment")
-    notes = EncryptedTextField(blank=True, null=True, help_text="Encrypted appointment notes")
+    medical_history = EncryptedTextField(blank=True, null=True, lazy=True, help_text="Encrypted medical history for appointment")
+    notes = EncryptedTextField(blank=True, null=True, lazy=True, help_text="Encrypted appointment notes")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = EncryptedQuerySet.as_manager()
+
     class Meta:
         ordering = ['-appointment_date', '-appointment_time']
         unique_together = [['doctor', 'appointment_date', 'appointment_time']]
@@ -90,6 +100,8 @@ class Contact(models.Model):
     submitted_at = models.DateTimeField(auto_now_add=True)
     is_resolved = models.BooleanField(default=False)
 
+    objects = EncryptedQuerySet.as_manager()
+
     def __str__(self):
         return f"Message from {self.name} ({self.email})"
 
@@ -108,9 +120,11 @@ class Report(models.Model):
         on_delete=models.CASCADE,
         related_name='reports'
     )
-    file = models.FileField(upload_to='patient_reports/', help_text="Encrypted file storage")
+    file = models.FileField(upload_to='patient_reports/', storage=get_encrypted_storage, help_text="Encrypted file storage")
     uploaded_at = models.DateTimeField(auto_now_add=True)
-    # Note: File encryption should be handled at storage level in production
+
+    def __str__(self):
+        return f"Report for Appointment #{self.appointment.id}"
 
 
 class AuditLog(models.Model):
@@ -143,7 +157,8 @@ class AuditLog(models.Model):
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     user_agent = models.TextField(blank=True)
     details = models.JSONField(default=dict, blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the access happens, not when the buffered writer inserts the row
+    timestamp = models.DateTimeField(default=timezone.now)
     
     class Meta:
         ordering = ['-timestamp']
@@ -158,5 +173,33 @@ class AuditLog(models.Model):
     def __str__(self):
         return f"{self.user} - {self.action} - {self.resource_type} - {self.timestamp}"
 
+
+class AuditAccessSummary(models.Model):
+    """
+    Daily rollup of AuditLog: how often each user touched each patient's
+    records. Maintained by the audit writer as entries are inserted, so
+    "who accessed patient X" never has to scan the raw log.
+    """
+    patient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='access_summaries')
+    accessor = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='accessed_summaries')
+    resource_type = models.CharField(max_length=50, choices=AuditLog.RESOURCE_TYPE_CHOICES)
+    day = models.DateField()
+    access_count = models.PositiveIntegerField(default=0)
+    first_access = models.DateTimeField()
+    last_access = models.DateTimeField()
+
+    class Meta:
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'accessor', 'resource_type', 'day'],
+                                    name='unique_access_summary_per_day'),
+        ]
+        indexes = [
+            models.Index(fields=['patient', 'day']),
+            models.Index(fields=['accessor', 'day']),
+        ]
+        verbose_name = 'Audit Access Summary'
+        verbose_name_plural = 'Audit Access Summaries'
+
     def __str__(self):
-        return f"Report for Appointment #{self.appointment.id}"
+        return f"{self.accessor} -> {self.patient} ({self.resource_type}, {self.day}): {self.access_count}"
@@ -0,0 +1,233 @@
+"""
+Encrypted-at-rest file storage for uploaded medical files (reports, scans)
+
+Files are encrypted with AES-256-GCM in fixed-size chunks as they are written,
+and decrypted chunk by chunk as they are read, so large imaging files never
+have to fit in memory. Every chunk is authenticated on its own, which also
+allows random-access reads of a byte range.
+
+On-disk layout:
+    header:  b'MCF1' | key version (u32) | chunk size (u32) | nonce prefix (8 bytes)
+    chunks:  AES-GCM(chunk) + 16-byte tag, one per chunk_size bytes of plaintext
+
+Each chunk's nonce is the nonce prefix followed by the chunk index. The
+associated data binds the header, the chunk index and a "final chunk" flag,
+so chunks cannot be reordered, swapped between files or truncated away.
+
+The file key is derived from the field encryption key of the version in the
+header, so after a key rotation stored files must be rewritten too;
+rotate_encryption_keys does that with reencrypt().
+"""
+import io
+import os
+import struct
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+from main.utils.encryption import get_file_key, get_key_version
+
+MAGIC = b'MCF1'
+HEADER = struct.Struct('>4sII8s')
+TAG_SIZE = 16
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def _chunk_aad(header, index, final):
+    return header + struct.pack('>Q?', index, final)
+
+
+class EncryptingFile(File):
+    """
+    Wraps an uploaded file so that chunks() yields the encrypted stream.
+    The plaintext is read chunk_size bytes at a time.
+    """
+    def __init__(self, file, chunk_size):
+        super().__init__(file, getattr(file, 'name', None))
+        self.encryption_chunk_size = chunk_size
+
+    def chunks(self, chunk_size=None):
+        version = get_key_version()
+        aesgcm = AESGCM(get_file_key(version))
+        header = HEADER.pack(MAGIC, version, self.encryption_chunk_size, os.urandom(8))
+        nonce_prefix = header[-8:]
+        yield header
+
+        self.file.seek(0)
+        index = 0
+        chunk = self.file.read(self.encryption_chunk_size)
+        while True:
+            # Read one chunk ahead to know whether this one is the last
+            next_chunk = self.file.read(self.encryption_chunk_size) if chunk else b''
+            final = not next_chunk
+            nonce = nonce_prefix + struct.pack('>I', index)
+            yield aesgcm.encrypt(nonce, chunk, _chunk_aad(header, index, final))
+            if final:
+                return
+            chunk = next_chunk
+            index += 1
+
+
+class DecryptingReader(io.RawIOBase):
+    """
+    Seekable read-only stream over an encrypted file.
+    Only the chunk containing the current position is held in memory.
+    """
+    def __init__(self, raw, header):
+        self.raw = raw
+        self.header = header
+        _, version, self.chunk_size, self.nonce_prefix = HEADER.unpack(header)
+        self.aesgcm = AESGCM(get_file_key(version))
+        self.raw_size = os.fstat(raw.fileno()).st_size
+        self.size = plaintext_size(self.raw_size, self.chunk_size)
+        self.position = 0
+        self._chunk_index = None
+        self._chunk = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return self.position
+
+    def _load_chunk(self, index):
+        if index != self._chunk_index:
+            stored_chunk_size = self.chunk_size + TAG_SIZE
+            offset = HEADER.size + index * stored_chunk_size
+            self.raw.seek(offset)
+            data = self.raw.read(stored_chunk_size)
+            final = offset + len(data) >= self.raw_size
+            nonce = self.nonce_prefix + struct.pack('>I', index)
+            self._chunk = self.aesgcm.decrypt(nonce, data, _chunk_aad(self.header, index, final))
+            self._chunk_index = index
+        return self._chunk
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        index, offset = divmod(self.position, self.chunk_size)
+        data = self._load_chunk(index)[offset:offset + len(buffer)]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        parts = []
+        while size > 0:
+            buffer = bytearray(min(size, self.chunk_size))
+            n = self.readinto(buffer)
+            if not n:
+                break
+            parts.append(bytes(buffer[:n]))
+            size -= n
+        return b''.join(parts)
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+def plaintext_size(raw_size, chunk_size):
+    """Plaintext length of an encrypted file of raw_size bytes"""
+    body = raw_size - HEADER.size
+    full_chunks, remainder = divmod(body, chunk_size + TAG_SIZE)
+    return full_chunks * chunk_size + max(remainder - TAG_SIZE, 0)
+
+
+@deconstructible
+class EncryptedFileSystemStorage(FileSystemStorage):
+    """
+    FileSystemStorage that encrypts file contents at rest.
+    Files written before encryption was enabled are still read as plain files.
+    """
+    def __init__(self, *args, chunk_size=None, **kwargs):
+        self.chunk_size = chunk_size or getattr(settings, 'ENCRYPTED_STORAGE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+        super().__init__(*args, **kwargs)
+
+    def _save(self, name, content):
+        return super()._save(name, EncryptingFile(content, self.chunk_size))
+
+    def _open(self, name, mode='rb'):
+        if 'w' in mode or 'a' in mode or '+' in mode:
+            raise ValueError("Encrypted storage files can only be opened for reading")
+        raw = open(self.path(name), 'rb')
+        header = raw.read(HEADER.size)
+        if len(header) < HEADER.size or not header.startswith(MAGIC):
+            # Legacy plaintext file
+            raw.seek(0)
+            return File(raw, name)
+        return File(io.BufferedReader(DecryptingReader(raw, header), buffer_size=self.chunk_size), name)
+
+    def size(self, name):
+        with open(self.path(name), 'rb') as raw:
+            header = raw.read(HEADER.size)
+            if len(header) < HEADER.size or not header.startswith(MAGIC):
+                return super().size(name)
+            chunk_size = HEADER.unpack(header)[2]
+        return plaintext_size(os.path.getsize(self.path(name)), chunk_size)
+
+    def key_version(self, name):
+        """Key version a stored file is encrypted under, or None for a plain file"""
+        with open(self.path(name), 'rb') as raw:
+            header = raw.read(HEADER.size)
+        if len(header) < HEADER.size or not header.startswith(MAGIC):
+            return None
+        return HEADER.unpack(header)[1]
+
+    def reencrypt(self, name):
+        """
+        Rewrite a stored file under the current key version. The new file is
+        written next to the old one and renamed over it, so readers see one
+        version or the other in full.
+
+        Returns:
+            True if the file was rewritten, False if it already was current
+        """
+        if self.key_version(name) == get_key_version():
+            return False
+        path = self.path(name)
+        tmp_path = f"{path}.rekey"
+        try:
+            with self.open(name) as source, open(tmp_path, 'wb') as target:
+                for chunk in EncryptingFile(source, self.chunk_size).chunks():
+                    target.write(chunk)
+                target.flush()
+                os.fsync(target.fileno())
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return True
+
+    def read_range(self, name, start, length):
+        """Read length bytes of plaintext starting at start, e.g. for previews"""
+        with self.open(name) as f:
+            f.seek(start)
+            return f.read(length)
+
+
+encrypted_storage = EncryptedFileSystemStorage()
+
+
+def get_encrypted_storage():
+    """Storage callable for FileField(storage=...), resolved at runtime"""
+    return encrypted_storage
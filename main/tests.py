@@ -1,3 +1,399 @@
-from django.test import TestCase
+import base64
+import datetime
+import io
+import json
+import os
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+
+from main.fields import EncryptedValue
+from main.models import Appointment, AuditLog, DoctorProfile, PatientProfile, Report
+from main.utils.audit_archive import (
+    ArchiveIntegrityError, archive_month, load_index, month_start, next_month, query_audit_logs, read_segment,
+)
+from main.utils.audit_writer import AuditLogWriter, build_event, replay_journal
+from main.utils.encryption import decrypt_data, decrypt_many, encrypt_data, get_cipher, parse_envelope
+from main.utils.reencryption import rewrite_model, write_raw_values
+
+
+def temporary_directory(test):
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    return directory.name
+
+
+def stored_value(instance, field_name):
+    """The column as it is in the database, bypassing the field's decryption"""
+    field = instance._meta.get_field(field_name)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT {field.column} FROM {instance._meta.db_table} WHERE id = %s', [instance.pk]
+        )
+        return cursor.fetchone()[0]
+
+
+class LazyEncryptedFieldTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('patient', password='x')
+        self.patient = PatientProfile.objects.create(user=user, age=40, medical_history='Asthma since 2010')
+
+    def test_loaded_value_is_decrypted_on_first_read(self):
+        patient = PatientProfile.objects.get(pk=self.patient.pk)
+        self.assertIsInstance(patient.__dict__['medical_history'], EncryptedValue)
+        self.assertEqual(patient.medical_history, 'Asthma since 2010')
+        self.assertEqual(patient.__dict__['medical_history'], 'Asthma since 2010')
+
+    def test_save_keeps_unread_ciphertext(self):
+        before = stored_value(self.patient, 'medical_history')
+        patient = PatientProfile.objects.get(pk=self.patient.pk)
+        patient.age = 41
+        with mock.patch('main.fields.decrypt_data') as decrypt:
+            patient.save()
+        decrypt.assert_not_called()
+        self.assertEqual(stored_value(patient, 'medical_history'), before)
+
+    def test_save_encrypts_changed_value(self):
+        patient = PatientProfile.objects.get(pk=self.patient.pk)
+        patient.medical_history = 'Asthma, penicillin allergy'
+        patient.save()
+        self.assertNotIn('penicillin', stored_value(patient, 'medical_history'))
+        self.assertEqual(
+            PatientProfile.objects.get(pk=patient.pk).medical_history, 'Asthma, penicillin allergy'
+        )
+
+
+    def test_text_that_only_looks_encrypted_is_encrypted(self):
+        patient = PatientProfile.objects.get(pk=self.patient.pk)
+        patient.medical_history = '$mc2$1$see attached notes'
+        patient.save()
+        self.assertNotEqual(stored_value(patient, 'medical_history'), '$mc2$1$see attached notes')
+        self.assertEqual(
+            PatientProfile.objects.get(pk=patient.pk).medical_history, '$mc2$1$see attached notes'
+        )
+
+    def test_value_without_a_configured_key_is_saved_unchanged(self):
+        self.patient.contact_number = '+1 555 0100'
+        self.patient.save()
+        before = {name: stored_value(self.patient, name) for name in ('medical_history', 'contact_number')}
+        index = self.patient.contact_number_index
+        with self.settings(ENCRYPTION_KEY='unrelated-key'), self.assertLogs('main.utils.encryption', 'WARNING'):
+            patient = PatientProfile.objects.get(pk=self.patient.pk)
+            self.assertIsInstance(patient.medical_history, EncryptedValue)
+            patient.age = 41
+            patient.save()
+        for name, value in before.items():
+            self.assertEqual(stored_value(patient, name), value)
+        self.assertEqual(PatientProfile.objects.get(pk=patient.pk).contact_number_index, index)
+
+
+class RawRewriteTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('patient', password='x')
+        self.patient = PatientProfile.objects.create(user=user, age=40, medical_history='Asthma')
+
+    def test_write_keeps_value_changed_since_read(self):
+        read = stored_value(self.patient, 'medical_history')
+        self.patient.medical_history = 'Asthma, updated by the doctor'
+        self.patient.save()
+        current = stored_value(self.patient, 'medical_history')
+
+        conflicts = write_raw_values(PatientProfile, {'medical_history': {self.patient.pk: (read, 'stale')}})
+
+        self.assertEqual(conflicts, {'medical_history': [self.patient.pk]})
+        self.assertEqual(stored_value(self.patient, 'medical_history'), current)
+
+    def test_rewrite_transforms_value_changed_during_batch_again(self):
+        patient = self.patient
+        seen = []
+
+        def transform(raw):
+            if not seen:
+                # The application saves the row between the read and the write
+                patient.medical_history = 'Changed mid-batch'
+                patient.save()
+            seen.append(raw)
+            return raw.upper()
+
+        scanned, rewritten, skipped = rewrite_model(PatientProfile, ['medical_history'], transform)
+
+        self.assertEqual((scanned, rewritten, skipped), (1, 1, 0))
+        self.assertEqual(len(seen), 2)
+        self.assertEqual(stored_value(patient, 'medical_history'), seen[1].upper())
+
+
+class CompactEncryptedValuesTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('patient', password='x')
+        self.patient = PatientProfile.objects.create(user=user, age=40)
+
+    def store_format_1(self, text):
+        _, version, token = parse_envelope(encrypt_data(text))
+        raw = f'$mc1${version}$' + base64.b64encode(token).decode()
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE main_patientprofile SET medical_history = %s WHERE id = %s', [raw, self.patient.pk])
+        return raw
+
+    def test_counts_a_retried_value_once(self):
+        self.store_format_1('Asthma')
+        write = write_raw_values
+        calls = []
+
+        def write_after_concurrent_save(model, updates):
+            if not calls:
+                # The application saves the row between the read and the write
+                calls.append(self.store_format_1('Asthma and eczema'))
+            return write(model, updates)
+
+        out = io.StringIO()
+        with mock.patch('main.utils.reencryption.write_raw_values', side_effect=write_after_concurrent_save):
+            call_command('compact_encrypted_values', stdout=out, stderr=io.StringIO())
+
+        before, after = len(calls[0]), len(stored_value(self.patient, 'medical_history'))
+        self.assertIn(
+            f"main_patientprofile: 1 rows, 1 values re-encoded, {before} -> {after} bytes ({before - after} saved)",
+            out.getvalue(),
+        )
+        self.assertEqual(PatientProfile.objects.get(pk=self.patient.pk).medical_history, 'Asthma and eczema')
+
+
+@override_settings(ENCRYPTION_KEY='old-key', ENCRYPTION_KEY_VERSION=1, ENCRYPTION_OLD_KEYS={},
+                   BLIND_INDEX_KEY='index-key')
+class RotateEncryptionKeysTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('patient', password='x')
+        self.patient = PatientProfile.objects.create(
+            user=user, age=40, medical_history='Asthma', contact_number='+1 555 0100',
+        )
+        self.checkpoint = os.path.join(temporary_directory(self), 'checkpoint.json')
+
+    def rotate(self, *args):
+        out = io.StringIO()
+        call_command('rotate_encryption_keys', *args, checkpoint=self.checkpoint, stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def test_rotates_values_written_with_old_key(self):
+        with self.settings(ENCRYPTION_KEY='new-key', ENCRYPTION_KEY_VERSION=2, ENCRYPTION_OLD_KEYS={1: 'old-key'}):
+            output = self.rotate()
+            self.assertIn('All encrypted columns and files are on key version 2', output)
+            self.assertFalse(os.path.exists(self.checkpoint))
+            for name in ('medical_history', 'contact_number'):
+                self.assertEqual(parse_envelope(stored_value(self.patient, name))[1], 2)
+
+        # Readable with the old key retired
+        with self.settings(ENCRYPTION_KEY='new-key', ENCRYPTION_KEY_VERSION=2):
+            patient = PatientProfile.objects.get(pk=self.patient.pk)
+            self.assertEqual(patient.medical_history, 'Asthma')
+            self.assertEqual(PatientProfile.objects.match(contact_number='+15550100').get(), patient)
+
+    def test_partial_run_keeps_checkpoint(self):
+        with self.settings(ENCRYPTION_KEY='new-key', ENCRYPTION_KEY_VERSION=2, ENCRYPTION_OLD_KEYS={1: 'old-key'}):
+            output = self.rotate('--models', 'main.PatientProfile')
+            self.assertIn('main.PatientProfile on key version 2; other models still need rotating', output)
+            self.assertTrue(os.path.exists(self.checkpoint))
+
+            output = self.rotate()
+            self.assertIn('main.PatientProfile: already rotated, skipping', output)
+            self.assertIn('All encrypted columns and files are on key version 2', output)
+            self.assertFalse(os.path.exists(self.checkpoint))
+
+    def create_report(self, content):
+        media = self.settings(MEDIA_ROOT=temporary_directory(self))
+        media.enable()
+        self.addCleanup(media.disable)
+        doctor = DoctorProfile.objects.create(
+            user=User.objects.create_user('doctor', password='x'), specialization='GP', office_location='A1',
+        )
+        appointment = Appointment.objects.create(
+            patient=self.patient.user, doctor=doctor,
+            appointment_date=datetime.date(2026, 1, 5), appointment_time=datetime.time(9),
+        )
+        report = Report(appointment=appointment)
+        report.file.save('report.txt', ContentFile(content))
+        return report
+
+    def test_rotates_stored_files(self):
+        report = self.create_report(b'Blood panel: normal' * 5000)
+        with self.settings(ENCRYPTION_KEY='new-key', ENCRYPTION_KEY_VERSION=2, ENCRYPTION_OLD_KEYS={1: 'old-key'}):
+            output = self.rotate()
+            self.assertIn('main.Report.file files: done (1 rows, 1 files)', output)
+            self.assertEqual(report.file.storage.key_version(report.file.name), 2)
+
+        with self.settings(ENCRYPTION_KEY='new-key', ENCRYPTION_KEY_VERSION=2):
+            with report.file.storage.open(report.file.name) as f:
+                self.assertEqual(f.read(), b'Blood panel: normal' * 5000)
+
+    def test_fails_while_files_are_on_an_unknown_key(self):
+        report = self.create_report(b'X-ray: no fracture')
+        with self.settings(ENCRYPTION_KEY='new-key', ENCRYPTION_KEY_VERSION=2, ENCRYPTION_OLD_KEYS={1: 'old-key'}):
+            self.rotate()
+        # Version 2 is not configured any more
+        with self.settings(ENCRYPTION_KEY='newer-key', ENCRYPTION_KEY_VERSION=3, ENCRYPTION_OLD_KEYS={1: 'old-key'}):
+            with self.assertLogs('main.utils.reencryption', 'ERROR'):
+                with self.assertRaisesMessage(CommandError, 'still encrypted under old key versions'):
+                    self.rotate()
+            self.assertEqual(report.file.storage.key_version(report.file.name), 2)
+            self.assertTrue(os.path.exists(self.checkpoint))
+
+    def test_nothing_to_rotate(self):
+        output = self.rotate()
+        self.assertIn('All encrypted columns and files are on key version 1', output)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+
+class BlindIndexAdminSearchTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('patient', password='x')
+        self.patient = PatientProfile.objects.create(user=user, age=40, contact_number='+1 555 0100')
+        self.model_admin = admin.site._registry[PatientProfile]
+        self.request = RequestFactory().get('/admin/main/patientprofile/')
+
+    def search(self, queryset, term):
+        results, _ = self.model_admin.get_search_results(self.request, queryset, term)
+        return list(results)
+
+    def test_finds_exact_contact_number(self):
+        self.assertEqual(self.search(PatientProfile.objects.all(), '+1 (555) 0100'), [self.patient])
+
+    def test_keeps_changelist_filters(self):
+        self.assertEqual(self.search(PatientProfile.objects.filter(age__gt=60), '+1 555 0100'), [])
+
+
+@override_settings(ENCRYPTION_KEY='envelope-key', ENCRYPTION_KEY_VERSION=3, ENCRYPTION_OLD_KEYS={})
+class EnvelopeTests(TestCase):
+    def test_round_trip(self):
+        stored = encrypt_data('Type 2 diabetes')
+        self.assertTrue(stored.startswith('$mc2$3$'))
+        self.assertEqual(parse_envelope(stored)[:2], (2, 3))
+        self.assertEqual(decrypt_data(stored), 'Type 2 diabetes')
+
+    def test_reads_legacy_formats(self):
+        token = get_cipher().encrypt('Penicillin allergy'.encode())
+        format_1 = '$mc1$3$' + base64.b64encode(token).decode()
+        bare_token = base64.b64encode(token).decode()
+        self.assertEqual(decrypt_data(format_1), 'Penicillin allergy')
+        self.assertEqual(decrypt_data(bare_token), 'Penicillin allergy')
+        self.assertEqual(decrypt_data('written before encryption'), 'written before encryption')
+
+    def test_reads_old_key_versions(self):
+        stored = encrypt_data('Hypertension')
+        with self.settings(ENCRYPTION_KEY='next-key', ENCRYPTION_KEY_VERSION=4, ENCRYPTION_OLD_KEYS={3: 'envelope-key'}):
+            self.assertEqual(decrypt_data(stored), 'Hypertension')
+            self.assertEqual(decrypt_many([stored, None, encrypt_data('Gout')]), ['Hypertension', None, 'Gout'])
+
+
+class AuditJournalTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('doctor', password='x')
+        self.journal = temporary_directory(self)
+
+    def write_segment(self, pid, lines, token=None):
+        name = f'audit-{pid}-{token}-000001.jsonl' if token else f'audit-{pid}-000001.jsonl'
+        path = os.path.join(self.journal, name)
+        with open(path, 'w', encoding='utf-8') as segment:
+            segment.write(''.join(line + '\n' for line in lines))
+        return path
+
+    def test_replays_segments_of_dead_processes(self):
+        events = [build_event(self.user, 'view', 'PatientProfile', i) for i in (1, 2)]
+        # A crash can leave a torn last line
+        path = self.write_segment(2 ** 22 + 1, [json.dumps(event) for event in events] + ['{"user_id": '])
+        with mock.patch('main.utils.audit_writer._pid_alive', return_value=False):
+            self.assertEqual(replay_journal(self.journal), 2)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(
+            sorted(AuditLog.objects.values_list('user__username', 'action', 'resource_id')),
+            [('doctor', 'view', '1'), ('doctor', 'view', '2')],
+        )
+
+    def test_skips_segments_of_live_processes(self):
+        path = self.write_segment(os.getppid(), [json.dumps(build_event(self.user, 'view', 'PatientProfile', 1))])
+        self.assertEqual(replay_journal(self.journal), 0)
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(AuditLog.objects.exists())
+
+    def test_writer_journals_until_flushed(self):
+        writer = AuditLogWriter(batch_size=1000, flush_interval=3600, journal_dir=self.journal).start()
+        self.addCleanup(writer.stop)
+        writer.submit(build_event(self.user, 'update', 'Appointment', 7))
+        segments = os.listdir(self.journal)
+        self.assertEqual(len(segments), 1)
+        with open(os.path.join(self.journal, segments[0]), encoding='utf-8') as segment:
+            self.assertEqual(json.loads(segment.readline())['resource_id'], '7')
+        self.assertFalse(AuditLog.objects.exists())
+
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(AuditLog.objects.get().action, 'update')
+        self.assertNotIn(segments[0], os.listdir(self.journal))
+
+    def test_replays_segments_of_earlier_process_with_same_pid(self):
+        path = self.write_segment(os.getpid(), [json.dumps(build_event(self.user, 'view', 'PatientProfile', 1))],
+                                  token='0badf00d')
+        writer = AuditLogWriter(journal_dir=self.journal).start()
+        self.addCleanup(writer.stop)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(AuditLog.objects.get().resource_id, '1')
+
+        # The running writer's own segment is left alone
+        writer.submit(build_event(self.user, 'view', 'PatientProfile', 2))
+        self.assertEqual(replay_journal(self.journal, token=writer.token), 0)
+        self.assertEqual(AuditLog.objects.count(), 1)
+
+    def test_deleted_user_is_written_without_the_user(self):
+        event = build_event(self.user, 'view', 'PatientProfile', 1)
+        user_id = self.user.pk
+        self.user.delete()
+        self.write_segment(2 ** 22 + 1, [json.dumps(event)])
+        with mock.patch('main.utils.audit_writer._pid_alive', return_value=False):
+            self.assertEqual(replay_journal(self.journal), 1)
+        entry = AuditLog.objects.get()
+        self.assertIsNone(entry.user_id)
+        self.assertEqual(entry.details, {'deleted_user_id': user_id})
+
+    def test_rejected_events_are_quarantined(self):
+        writer = AuditLogWriter(batch_size=1000, flush_interval=3600, journal_dir=self.journal).start()
+        self.addCleanup(writer.stop)
+        writer.submit(build_event(self.user, 'view', 'PatientProfile', 1))
+        writer.submit({**build_event(self.user, 'view', 'PatientProfile', 2), 'timestamp': 'not a time'})
+        with self.assertLogs('main.utils.audit_writer', 'ERROR'):
+            self.assertEqual(writer.flush(), 1)
+        self.assertEqual(AuditLog.objects.get().resource_id, '1')
+        self.assertEqual(writer.pending(), 0)
+
+        quarantined = [name for name in os.listdir(self.journal) if name.startswith('quarantine-')]
+        self.assertEqual(quarantined, [f'quarantine-{writer.pid}-{writer.token}.jsonl'])
+        with open(os.path.join(self.journal, quarantined[0]), encoding='utf-8') as quarantine:
+            self.assertEqual(json.loads(quarantine.readline())['resource_id'], '2')
+
+
+class AuditArchiveTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('doctor', password='x')
+        self.archive = temporary_directory(self)
+        self.start = month_start(2025, 1)
+        for day in range(1, 6):
+            AuditLog.objects.create(user=self.user, action='view', resource_type='appointment',
+                                    resource_id=str(day), timestamp=self.start.replace(day=day))
+        self.kept = AuditLog.objects.create(user=self.user, action='view', resource_type='appointment',
+                                            resource_id='6', timestamp=next_month(self.start))
+
+    def test_archives_month_in_batches(self):
+        entry = archive_month('2025-01', self.start, next_month(self.start), self.archive, batch_size=2)
+
+        self.assertEqual((entry['rows'], entry['purged']), (5, True))
+        self.assertEqual(list(AuditLog.objects.all()), [self.kept])
+        self.assertEqual([row['resource_id'] for row in read_segment(entry, self.archive)], ['1', '2', '3', '4', '5'])
+        self.assertEqual(len(query_audit_logs(user=self.user, archive_dir=self.archive)), 6)
+
+    def test_rejects_altered_segment(self):
+        entry = archive_month('2025-01', self.start, next_month(self.start), self.archive)
+        with open(os.path.join(self.archive, entry['file']), 'ab') as segment:
+            segment.write(b'\0')
+        with self.assertRaises(ArchiveIntegrityError):
+            next(read_segment(load_index(self.archive)['segments'][0], self.archive))
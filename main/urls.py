@@ -21,6 +21,7 @@ urlpatterns = [
     # Appointment-related
     path('appointment/', views.appointment, name='appointment'),  # Possibly a static info page
     path('book-appointment/', views.book_appointment, name='book_appointment'),  # Dynamic booking
+    path('reports/<int:report_id>/', views.download_report, name='download_report'),  # Decrypted report download
 
     # Dashboards
     path('doctor/dashboard/', views.doctor_dashboard, name='doctor_dashboard'),
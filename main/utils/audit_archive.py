@@ -0,0 +1,349 @@
+"""
+Monthly archival of audit log entries to compressed segment files.
+
+The AuditLog table only keeps recent ("hot") months. Older months are moved
+into gzip-compressed JSON-lines segments under AUDIT_ARCHIVE_DIR:
+
+    <AUDIT_ARCHIVE_DIR>/2026-01/segment-0001.jsonl.gz
+    <AUDIT_ARCHIVE_DIR>/index.json
+
+Segments are append-only: once written, a segment is never modified, and rows
+that show up for an already archived month go into the next segment. The index
+records each segment's SHA-256, row count, id and time range, and the distinct
+users and resource types it holds, so queries can skip segments that cannot
+match and reads can verify the data has not been altered.
+
+query_audit_logs() searches the live table and the archive together.
+"""
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+INDEX_NAME = 'index.json'
+DEFAULT_HOT_MONTHS = 3
+ARCHIVE_FIELDS = ('id', 'user_id', 'action', 'resource_type', 'resource_id',
+                  'ip_address', 'user_agent', 'details', 'timestamp')
+
+
+class ArchiveIntegrityError(ValueError):
+    """A segment's contents do not match the checksum recorded in the index"""
+
+
+def get_archive_dir():
+    return str(getattr(settings, 'AUDIT_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'audit_archive')))
+
+
+def month_start(year, month):
+    return datetime(year, month, 1, tzinfo=dt_timezone.utc)
+
+
+def next_month(start):
+    if start.month == 12:
+        return month_start(start.year + 1, 1)
+    return month_start(start.year, start.month + 1)
+
+
+def archive_cutoff(now, hot_months):
+    """Start of the oldest month that stays in the live table"""
+    year, month = now.year, now.month - hot_months + 1
+    while month < 1:
+        year, month = year - 1, month + 12
+    return month_start(year, month)
+
+
+# ---------------------------------------------------------------------------
+# Index
+# ---------------------------------------------------------------------------
+
+def load_index(archive_dir=None):
+    path = os.path.join(archive_dir or get_archive_dir(), INDEX_NAME)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'format': 1, 'segments': []}
+
+
+def save_index(index, archive_dir=None):
+    archive_dir = archive_dir or get_archive_dir()
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, INDEX_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# ---------------------------------------------------------------------------
+# Segments
+# ---------------------------------------------------------------------------
+
+def _serialize(row):
+    record = dict(row)
+    record['timestamp'] = row['timestamp'].isoformat()
+    return json.dumps(record, separators=(',', ':'), sort_keys=True).encode('utf-8') + b'\n'
+
+
+def write_segment(archive_dir, month, rows):
+    """
+    Write rows (dicts with ARCHIVE_FIELDS) to the month's next segment.
+
+    Returns:
+        Index entry for the new segment
+    """
+    month_dir = os.path.join(archive_dir, month)
+    os.makedirs(month_dir, exist_ok=True)
+    existing = sorted(name for name in os.listdir(month_dir) if name.endswith('.jsonl.gz'))
+    sequence = int(existing[-1].split('-')[1].split('.')[0]) + 1 if existing else 1
+    name = f'{month}/segment-{sequence:04d}.jsonl.gz'
+    path = os.path.join(archive_dir, name)
+
+    digest = hashlib.sha256()
+    entry = {
+        'file': name, 'month': month, 'rows': 0,
+        'min_id': None, 'max_id': None, 'min_ts': None, 'max_ts': None,
+        'user_ids': set(), 'resource_types': set(),
+        'purged': False,
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as gz:
+            for row in rows:
+                gz.write(_serialize(row))
+                entry['rows'] += 1
+                entry['min_id'] = row['id'] if entry['min_id'] is None else min(entry['min_id'], row['id'])
+                entry['max_id'] = row['id'] if entry['max_id'] is None else max(entry['max_id'], row['id'])
+                ts = _utc_iso(row['timestamp'])
+                entry['min_ts'] = ts if entry['min_ts'] is None else min(entry['min_ts'], ts)
+                entry['max_ts'] = ts if entry['max_ts'] is None else max(entry['max_ts'], ts)
+                entry['user_ids'].add(row['user_id'])
+                entry['resource_types'].add(row['resource_type'])
+        raw.flush()
+        os.fsync(raw.fileno())
+    with open(tmp_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    os.replace(tmp_path, path)
+
+    entry['sha256'] = digest.hexdigest()
+    entry['bytes'] = os.path.getsize(path)
+    entry['user_ids'] = sorted(entry['user_ids'], key=lambda uid: (uid is None, uid or 0))
+    entry['resource_types'] = sorted(entry['resource_types'])
+    return entry
+
+
+def read_segment(entry, archive_dir=None, verify=True):
+    """
+    Yield the rows of one segment, checking its SHA-256 first. The file is
+    hashed and then decompressed a line at a time, so memory use does not
+    grow with the segment.
+    """
+    path = os.path.join(archive_dir or get_archive_dir(), entry['file'])
+    with open(path, 'rb') as f:
+        if verify:
+            digest = hashlib.sha256()
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+            if digest.hexdigest() != entry['sha256']:
+                raise ArchiveIntegrityError(f"Checksum mismatch for audit segment {entry['file']}")
+            f.seek(0)
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=f, mode='rb'), encoding='utf-8') as lines:
+            for line in lines:
+                record = json.loads(line)
+                record['timestamp'] = parse_datetime(record['timestamp'])
+                yield record
+
+
+def verify_archive(archive_dir=None):
+    """
+    Returns:
+        List of (segment file, problem) for segments that fail verification
+    """
+    archive_dir = archive_dir or get_archive_dir()
+    problems = []
+    for entry in load_index(archive_dir)['segments']:
+        try:
+            count = sum(1 for _ in read_segment(entry, archive_dir))
+        except FileNotFoundError:
+            problems.append((entry['file'], 'missing'))
+        except (ArchiveIntegrityError, OSError, ValueError) as e:
+            problems.append((entry['file'], str(e)))
+        else:
+            if count != entry['rows']:
+                problems.append((entry['file'], f"{count} rows, index says {entry['rows']}"))
+    return problems
+
+
+# ---------------------------------------------------------------------------
+# Archiving
+# ---------------------------------------------------------------------------
+
+def _purge_rows(ids, batch_size):
+    """Delete live rows by id, taking batch_size ids at a time from an iterable"""
+    from main.models import AuditLog
+
+    deleted = 0
+    ids = iter(ids)
+    while True:
+        batch = list(itertools.islice(ids, batch_size))
+        if not batch:
+            return deleted
+        with transaction.atomic():
+            deleted += AuditLog.objects.filter(pk__in=batch).delete()[0]
+
+
+def finish_pending_purges(archive_dir=None, batch_size=1000):
+    """
+    Delete live rows for segments that were written but not purged, e.g.
+    because the previous run was interrupted between the two steps.
+    """
+    archive_dir = archive_dir or get_archive_dir()
+    index = load_index(archive_dir)
+    purged = 0
+    for entry in index['segments']:
+        if not entry['purged']:
+            purged += _purge_rows((row['id'] for row in read_segment(entry, archive_dir)), batch_size)
+            entry['purged'] = True
+            save_index(index, archive_dir)
+    return purged
+
+
+def archivable_months(cutoff):
+    """(month label, start, end) for every month with live rows before cutoff"""
+    from main.models import AuditLog
+
+    oldest = AuditLog.objects.filter(timestamp__lt=cutoff).order_by('timestamp').values_list('timestamp', flat=True).first()
+    months = []
+    if oldest is None:
+        return months
+    start = month_start(oldest.year, oldest.month)
+    while start < cutoff:
+        end = next_month(start)
+        months.append((start.strftime('%Y-%m'), start, end))
+        start = end
+    return months
+
+
+def archive_month(label, start, end, archive_dir=None, batch_size=1000):
+    """
+    Move one month of live rows into a new segment.
+
+    Returns:
+        Index entry of the new segment, or None if the month had no rows
+    """
+    from main.models import AuditLog
+
+    archive_dir = archive_dir or get_archive_dir()
+    queryset = AuditLog.objects.filter(timestamp__gte=start, timestamp__lt=end).order_by('id')
+    if not queryset.exists():
+        return None
+
+    def rows():
+        # Keyset pagination, so only one batch is held at a time
+        last_id = None
+        while True:
+            page = queryset if last_id is None else queryset.filter(id__gt=last_id)
+            batch = list(page.values(*ARCHIVE_FIELDS)[:batch_size])
+            if not batch:
+                return
+            yield from batch
+            last_id = batch[-1]['id']
+
+    entry = write_segment(archive_dir, label, rows())
+    index = load_index(archive_dir)
+    index['segments'].append(entry)
+    save_index(index, archive_dir)
+
+    # Only rows that made it into the segment are removed; their ids are
+    # streamed back from it
+    _purge_rows((row['id'] for row in read_segment(entry, archive_dir)), batch_size)
+    entry['purged'] = True
+    save_index(index, archive_dir)
+    return entry
+
+
+# ---------------------------------------------------------------------------
+# Querying
+# ---------------------------------------------------------------------------
+
+def _utc_iso(value):
+    return value.astimezone(dt_timezone.utc).isoformat()
+
+
+def _segment_may_match(entry, user_id, resource_type, start, end):
+    if user_id is not None and user_id not in entry['user_ids']:
+        return False
+    if resource_type is not None and resource_type not in entry['resource_types']:
+        return False
+    if start is not None and entry['max_ts'] < _utc_iso(start):
+        return False
+    if end is not None and entry['min_ts'] >= _utc_iso(end):
+        return False
+    return True
+
+
+def query_audit_logs(user=None, resource_type=None, resource_id=None, action=None,
+                     start=None, end=None, limit=None, archive_dir=None, verify=True):
+    """
+    Audit entries from the live table and the archive, newest first.
+
+    Args:
+        user: User or user id
+        resource_type / resource_id / action: exact matches
+        start, end: timestamp range [start, end)
+        limit: maximum number of entries returned
+
+    Returns:
+        List of dicts with ARCHIVE_FIELDS plus 'archived'
+    """
+    from main.models import AuditLog
+
+    user_id = getattr(user, 'pk', user)
+    filters = {}
+    if user_id is not None:
+        filters['user_id'] = user_id
+    if resource_type is not None:
+        filters['resource_type'] = resource_type
+    if resource_id is not None:
+        filters['resource_id'] = str(resource_id)
+    if action is not None:
+        filters['action'] = action
+    if start is not None:
+        filters['timestamp__gte'] = start
+    if end is not None:
+        filters['timestamp__lt'] = end
+
+    live = AuditLog.objects.filter(**filters).order_by('-timestamp', '-id').values(*ARCHIVE_FIELDS)
+    if limit is not None:
+        live = live[:limit]
+    results = {row['id']: dict(row, archived=False) for row in live}
+
+    archive_dir = archive_dir or get_archive_dir()
+    for entry in load_index(archive_dir)['segments']:
+        if not _segment_may_match(entry, user_id, resource_type, start, end):
+            continue
+        for record in read_segment(entry, archive_dir, verify=verify):
+            if record['id'] in results:
+                # Segment written but live row not purged yet
+                continue
+            if (user_id is not None and record['user_id'] != user_id
+                    or resource_type is not None and record['resource_type'] != resource_type
+                    or resource_id is not None and record['resource_id'] != str(resource_id)
+                    or action is not None and record['action'] != action
+                    or start is not None and record['timestamp'] < start
+                    or end is not None and record['timestamp'] >= end):
+                continue
+            record['archived'] = True
+            results[record['id']] = record
+
+    ordered = sorted(results.values(), key=lambda row: (row['timestamp'], row['id']), reverse=True)
+    return ordered[:limit] if limit is not None else ordered
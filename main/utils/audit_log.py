@@ -4,7 +4,9 @@ Tracks all access to Protected Health Information (PHI)
 """
 import json
 from datetime import datetime
+from django.conf import settings
 from django.contrib.auth.models import User
+from main.utils.audit_writer import build_event, get_audit_writer, write_events
 
 # Import AuditLog from models to avoid circular import
 def get_audit_log_model():
@@ -23,6 +25,9 @@ def log_phi_access(user, action, resource_type, resource_id, request=None, detai
         resource_id: ID of the resource
         request: Django request object (for IP and user agent)
         details: Additional details as dictionary
+
+    With AUDIT_LOG_ASYNC enabled the entry is journaled and queued for the
+    background writer instead of being inserted inside the request.
     """
     try:
         ip_address = None
@@ -31,17 +36,15 @@ def log_phi_access(user, action, resource_type, resource_id, request=None, detai
         if request:
             ip_address = get_client_ip(request)
             user_agent = request.META.get('HTTP_USER_AGENT', '')[:500]  # Limit length
+            # Tells PHIAuditMiddleware not to write a second, generic entry
+            request._phi_audit_logged = True
         
-        AuditLog = get_audit_log_model()
-        AuditLog.objects.create(
-            user=user,
-            action=action,
-            resource_type=resource_type,
-            resource_id=str(resource_id),
-            ip_address=ip_address,
-            user_agent=user_agent,
-            details=details or {}
-        )
+        event = build_event(user, action, resource_type, resource_id,
+                            ip_address=ip_address, user_agent=user_agent, details=details)
+        if getattr(settings, 'AUDIT_LOG_ASYNC', False):
+            get_audit_writer().submit(event)
+        else:
+            write_events([event])
     except Exception as e:
         # Log error but don't break the application
         print(f"Audit logging error: {e}")
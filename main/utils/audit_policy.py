@@ -0,0 +1,77 @@
+"""
+Declarative audit policy for PHIAuditMiddleware.
+
+Maps resolved URL names (resolver_match.view_name, including the namespace
+for included apps, e.g. 'scans:upload_scan') to the audit entry the
+middleware writes for that view. Views that call log_phi_access() themselves
+are still listed so coverage is visible in one place; the middleware skips
+requests that were already logged.
+
+Each rule is a dict with:
+    action:        AuditLog action
+    resource_type: AuditLog resource type
+    resource_id:   'user' for the requesting user's id, the name of a URL
+                   kwarg to take the id from, or omitted for 'multiple'
+    patient:       'user' when the records belong to the requesting user;
+                   recorded as details['patient_ids'] for the access summaries
+
+settings.AUDIT_POLICY is merged over the defaults; map a view name to None
+to stop auditing it.
+"""
+from collections import namedtuple
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+AuditRule = namedtuple('AuditRule', ['action', 'resource_type', 'resource_id', 'patient'])
+
+DEFAULT_AUDIT_POLICY = {
+    # Dashboards
+    'patient_dashboard': {'action': 'access', 'resource_type': 'patient_profile', 'resource_id': 'user', 'patient': 'user'},
+    'doctor_dashboard': {'action': 'access', 'resource_type': 'patient_profile', 'resource_id': 'user'},
+
+    # Appointments
+    'appointment': {'action': 'access', 'resource_type': 'appointment'},
+    'book_appointment': {'action': 'access', 'resource_type': 'appointment'},
+    'doctor_confirm_appointment': {'action': 'update', 'resource_type': 'appointment', 'resource_id': 'appointment_id'},
+    'patient_confirm_appointment': {'action': 'update', 'resource_type': 'appointment', 'resource_id': 'appointment_id'},
+
+    # Reports and scans
+    'download_report': {'action': 'view', 'resource_type': 'report', 'resource_id': 'report_id'},
+    'scans:upload_scan': {'action': 'access', 'resource_type': 'scan', 'patient': 'user'},
+    'scans:scan_image': {'action': 'view', 'resource_type': 'scan', 'resource_id': 'scan_id'},
+}
+
+
+def compile_audit_policy(overrides=None):
+    """
+    Merge overrides into the defaults and validate them.
+
+    Returns:
+        Dict of view name -> AuditRule, for a single lookup per request
+    """
+    policy = dict(DEFAULT_AUDIT_POLICY)
+    policy.update(overrides if overrides is not None else getattr(settings, 'AUDIT_POLICY', {}))
+
+    compiled = {}
+    for view_name, rule in policy.items():
+        if rule is None:
+            continue
+        try:
+            compiled[view_name] = AuditRule(
+                action=rule['action'],
+                resource_type=rule['resource_type'],
+                resource_id=rule.get('resource_id'),
+                patient=rule.get('patient'),
+            )
+        except KeyError as e:
+            raise ImproperlyConfigured(f"AUDIT_POLICY entry {view_name!r} is missing {e.args[0]!r}")
+    return compiled
+
+
+def resolve_resource_id(rule, request):
+    """Resource id for an audit entry written under the given rule"""
+    if rule.resource_id is None:
+        return 'multiple'
+    if rule.resource_id == 'user':
+        return str(request.user.id)
+    return str(request.resolver_match.kwargs.get(rule.resource_id, 'unknown'))
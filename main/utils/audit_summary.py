@@ -0,0 +1,191 @@
+"""
+Per-patient access summaries built from audit log entries.
+
+update_access_summaries() runs in the same transaction as the audit writer's
+insert and folds each batch into AuditAccessSummary rows (one per patient,
+accessing user, resource type and day). Compliance questions such as "who
+accessed patient X in the last 90 days" are then answered from at most a few
+hundred summary rows instead of the raw log.
+
+An entry is attributed to a patient through details['patient_ids'] when the
+view recorded it, otherwise by looking up the appointment, report or scan it
+names.
+"""
+from collections import defaultdict
+from datetime import timedelta, timezone as dt_timezone
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Max, Min, Sum
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+# resource_type -> (app label, model name, path to the patient's user id)
+PATIENT_RESOLVERS = {
+    'appointment': ('main', 'Appointment', 'patient_id'),
+    'report': ('main', 'Report', 'appointment__patient_id'),
+    'scan': ('scans', 'Scan', 'patient_id'),
+}
+
+
+def _resolve_patients(entries):
+    """Map (resource_type, resource_id) to a patient user id with one query per type"""
+    wanted = defaultdict(set)
+    for entry in entries:
+        if entry.resource_type in PATIENT_RESOLVERS and not entry.details.get('patient_ids') \
+                and str(entry.resource_id).isdigit():
+            wanted[entry.resource_type].add(int(entry.resource_id))
+
+    resolved = {}
+    for resource_type, ids in wanted.items():
+        app_label, model_name, patient_path = PATIENT_RESOLVERS[resource_type]
+        try:
+            model = apps.get_model(app_label, model_name)
+        except LookupError:
+            continue
+        for pk, patient_id in model.objects.filter(pk__in=ids).values_list('pk', patient_path):
+            resolved[(resource_type, str(pk))] = patient_id
+    return resolved
+
+
+def patient_ids_for(entry, resolved):
+    """Patient user ids an audit entry touched"""
+    patient_ids = entry.details.get('patient_ids') if isinstance(entry.details, dict) else None
+    if patient_ids:
+        return set(patient_ids)
+    patient_id = resolved.get((entry.resource_type, str(entry.resource_id)))
+    return {patient_id} if patient_id is not None else set()
+
+
+def update_access_summaries(entries):
+    """
+    Fold a batch of AuditLog entries into the daily summaries.
+
+    Entries without an authenticated user or an identifiable patient are
+    skipped. Increments are applied with F() expressions, so concurrent
+    writers in other processes do not lose counts.
+    """
+    from main.models import AuditAccessSummary
+
+    entries = [entry for entry in entries if entry.user_id is not None]
+    if not entries:
+        return 0
+
+    resolved = _resolve_patients(entries)
+    rollup = {}
+    for entry in entries:
+        day = entry.timestamp.astimezone(dt_timezone.utc).date()
+        for patient_id in patient_ids_for(entry, resolved):
+            key = (patient_id, entry.user_id, entry.resource_type, day)
+            count, first, last = rollup.get(key, (0, entry.timestamp, entry.timestamp))
+            rollup[key] = (count + 1, min(first, entry.timestamp), max(last, entry.timestamp))
+    if not rollup:
+        return 0
+
+    # A deleted user must not fail the foreign key and with it the audit insert
+    user_ids = {key[0] for key in rollup} | {key[1] for key in rollup}
+    existing = set(User.objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+    rollup = {key: value for key, value in rollup.items() if key[0] in existing and key[1] in existing}
+
+    with transaction.atomic():
+        # Make sure every row exists, then increment it in place
+        AuditAccessSummary.objects.bulk_create(
+            [
+                AuditAccessSummary(patient_id=patient_id, accessor_id=accessor_id, resource_type=resource_type,
+                                   day=day, access_count=0, first_access=first, last_access=last)
+                for (patient_id, accessor_id, resource_type, day), (_, first, last) in rollup.items()
+            ],
+            ignore_conflicts=True,
+        )
+        for (patient_id, accessor_id, resource_type, day), (count, first, last) in rollup.items():
+            AuditAccessSummary.objects.filter(
+                patient_id=patient_id, accessor_id=accessor_id, resource_type=resource_type, day=day,
+            ).update(
+                access_count=F('access_count') + count,
+                first_access=Least(F('first_access'), first),
+                last_access=Greatest(F('last_access'), last),
+            )
+    return len(rollup)
+
+
+def rebuild_access_summaries(batch_size=5000, include_archive=True):
+    """
+    Recompute all summaries from the live table and, optionally, the archive.
+
+    Returns:
+        Number of audit entries processed
+    """
+    from main.models import AuditAccessSummary, AuditLog
+    from main.utils.audit_archive import get_archive_dir, load_index, read_segment
+
+    AuditAccessSummary.objects.all().delete()
+    processed = 0
+
+    if include_archive:
+        archive_dir = get_archive_dir()
+        for segment in load_index(archive_dir)['segments']:
+            batch = []
+            for record in read_segment(segment, archive_dir):
+                batch.append(AuditLog(**record))
+                if len(batch) >= batch_size:
+                    processed += len(batch)
+                    update_access_summaries(batch)
+                    batch = []
+            processed += len(batch)
+            update_access_summaries(batch)
+
+    last_pk = 0
+    while True:
+        batch = list(AuditLog.objects.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not batch:
+            break
+        update_access_summaries(batch)
+        processed += len(batch)
+        last_pk = batch[-1].pk
+    return processed
+
+
+def _window(days, since):
+    if since is None:
+        since = timezone.now() - timedelta(days=days)
+    return since.astimezone(dt_timezone.utc).date()
+
+
+def who_accessed(patient, days=90, since=None):
+    """
+    Users who accessed a patient's records, most active first.
+
+    Returns:
+        List of dicts: accessor_id, accessor__username, accesses,
+        first_access, last_access
+    """
+    from main.models import AuditAccessSummary
+
+    patient_id = getattr(patient, 'pk', patient)
+    return list(
+        AuditAccessSummary.objects
+        .filter(patient_id=patient_id, day__gte=_window(days, since))
+        .values('accessor_id', 'accessor__username')
+        .annotate(accesses=Sum('access_count'), first_access=Min('first_access'), last_access=Max('last_access'))
+        .order_by('-accesses', 'accessor_id')
+    )
+
+
+def patients_accessed_by(user, days=90, since=None):
+    """
+    Patients whose records a user accessed, most accessed first.
+
+    Returns:
+        List of dicts: patient_id, patient__username, accesses,
+        first_access, last_access
+    """
+    from main.models import AuditAccessSummary
+
+    user_id = getattr(user, 'pk', user)
+    return list(
+        AuditAccessSummary.objects
+        .filter(accessor_id=user_id, day__gte=_window(days, since))
+        .values('patient_id', 'patient__username')
+        .annotate(accesses=Sum('access_count'), first_access=Min('first_access'), last_access=Max('last_access'))
+        .order_by('-accesses', 'patient_id')
+    )
@@ -0,0 +1,365 @@
+"""
+Buffered background writer for audit log entries.
+
+log_phi_access() hands events to the writer instead of inserting them inside
+the request. A daemon thread flushes the buffer with bulk_create() once it
+holds AUDIT_LOG_BATCH_SIZE events or AUDIT_LOG_FLUSH_INTERVAL seconds have
+passed, and once more at interpreter exit.
+
+Every event is also appended to a journal segment on disk before submit()
+returns. A segment is deleted only after the events it holds are committed,
+so events buffered in a process that crashes are replayed into the database
+the next time a writer starts. Delivery is at-least-once: a crash between the
+commit and the segment delete replays that batch again.
+
+Segments are named audit-<pid>-<token>-<seq>.jsonl, where the token is drawn
+once per writer, so a restarted worker that reuses a PID never mistakes the
+segments of its predecessor for its own.
+
+Events that can never be inserted (malformed, or rejected by a constraint)
+are moved to a quarantine-*.jsonl file in the journal directory instead of
+blocking the batches behind them. Entries of users deleted since the event
+was recorded are written without the user; the id is kept in details.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from django.db import DataError, IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 2.0
+SEGMENT_PATTERN = 'audit-*.jsonl'
+# Errors that retrying the same events will not fix. Anything else, such as
+# the database being unreachable, is retried.
+PERMANENT_ERRORS = (IntegrityError, DataError, KeyError, TypeError, ValueError)
+
+
+def build_event(user, action, resource_type, resource_id, ip_address=None, user_agent='', details=None):
+    """Serializable form of one audit entry, as stored in the journal"""
+    return {
+        'user_id': user.pk if user is not None else None,
+        'action': action,
+        'resource_type': resource_type,
+        'resource_id': str(resource_id),
+        'ip_address': ip_address,
+        'user_agent': user_agent,
+        'details': details or {},
+        'timestamp': timezone.now().isoformat(),
+    }
+
+
+def write_events(events):
+    """
+    Insert a batch of journal events as AuditLog rows and fold them into the
+    access summaries in the same transaction.
+    """
+    from django.contrib.auth.models import User
+    from main.models import AuditLog
+    from main.utils.audit_summary import update_access_summaries
+
+    # A user deleted after the event was recorded must not fail the foreign key
+    user_ids = {event['user_id'] for event in events if event['user_id'] is not None}
+    existing = set(User.objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+
+    rows = []
+    for event in events:
+        user_id, details = event['user_id'], event['details']
+        if user_id is not None and user_id not in existing:
+            user_id, details = None, {**details, 'deleted_user_id': event['user_id']}
+        rows.append(AuditLog(
+            user_id=user_id,
+            action=event['action'],
+            resource_type=event['resource_type'],
+            resource_id=event['resource_id'],
+            ip_address=event['ip_address'],
+            user_agent=event['user_agent'],
+            details=details,
+            timestamp=parse_datetime(event['timestamp']),
+        ))
+    with transaction.atomic():
+        AuditLog.objects.bulk_create(rows, batch_size=500)
+        update_access_summaries(rows)
+    return rows
+
+
+def quarantine_events(journal_dir, events, name):
+    """Append events that cannot be inserted to journal_dir/quarantine-<name>.jsonl"""
+    if not journal_dir:
+        logger.error("Dropping %d audit events that cannot be written; no journal to quarantine them in",
+                     len(events))
+        return None
+    path = os.path.join(journal_dir, f'quarantine-{name}.jsonl')
+    with open(path, 'a', encoding='utf-8') as quarantine:
+        quarantine.write(''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in events))
+    logger.error("Moved %d audit events that cannot be written to %s", len(events), path)
+    return path
+
+
+def write_or_quarantine(events, journal_dir, name):
+    """
+    write_events() for a batch that may hold events which can never be
+    inserted. If the batch fails with one of PERMANENT_ERRORS, its events are
+    written one at a time and those that still fail are quarantined. Other
+    errors propagate so the caller can retry the whole batch.
+
+    Returns:
+        Number of events written
+    """
+    try:
+        write_events(events)
+        return len(events)
+    except PERMANENT_ERRORS:
+        logger.warning("Audit batch of %d events was rejected; writing the events one at a time", len(events))
+
+    rejected = []
+    for event in events:
+        try:
+            write_events([event])
+        except PERMANENT_ERRORS:
+            rejected.append(event)
+    if rejected:
+        quarantine_events(journal_dir, rejected, name)
+    return len(events) - len(rejected)
+
+
+def _segment_owner(path):
+    """(pid, token) from a segment name; token is None for names from before tokens were added"""
+    parts = os.path.basename(path)[:-len('.jsonl')].split('-')
+    try:
+        if len(parts) == 4:
+            return int(parts[1]), parts[2]
+        if len(parts) == 3:
+            return int(parts[1]), None
+    except ValueError:
+        pass
+    return None, None
+
+
+def read_segment(path):
+    """Events in a journal segment. A torn last line from a crash is skipped."""
+    events = []
+    with open(path, 'r', encoding='utf-8') as segment:
+        for line in segment:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                logger.warning("Skipping unreadable audit journal line in %s", path)
+    return events
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def replay_journal(journal_dir, include_live=False, token=None):
+    """
+    Write events left behind by writers that are gone to the database.
+
+    Segments of other processes that are still running are skipped unless
+    include_live is set. Segments with this process's PID are replayed unless
+    they belong to the writer with the given token: they were left by an
+    earlier process that had the same PID. Without a token all of this
+    process's segments are skipped.
+
+    Returns:
+        Number of events replayed
+    """
+    replayed = 0
+    for path in sorted(glob.glob(os.path.join(journal_dir, SEGMENT_PATTERN))):
+        pid, segment_token = _segment_owner(path)
+        if pid is None:
+            continue
+        if pid == os.getpid():
+            if token is None or segment_token == token:
+                continue
+        elif not include_live and _pid_alive(pid):
+            continue
+        events = read_segment(path)
+        if events:
+            name = os.path.basename(path)[len('audit-'):-len('.jsonl')]
+            replayed += write_or_quarantine(events, journal_dir, name)
+        os.remove(path)
+    if replayed:
+        logger.info("Replayed %d audit events from %s", replayed, journal_dir)
+    return replayed
+
+
+class AuditLogWriter:
+    """
+    In-memory queue of audit events flushed to the database by a daemon thread.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 journal_dir=None, fsync=False):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self.pid = os.getpid()
+        # Tells this writer's segments apart from those of an earlier process with the same PID
+        self.token = secrets.token_hex(4)
+
+        self._buffer = deque()
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+
+        self._segment = None
+        self._segment_seq = 0
+        # Closed segments whose events have not been committed yet
+        self._pending_segments = []
+
+        self.flushed = 0
+        self.failed_flushes = 0
+
+    def start(self):
+        if self.journal_dir:
+            os.makedirs(self.journal_dir, exist_ok=True)
+            try:
+                replay_journal(self.journal_dir, token=self.token)
+            except Exception:
+                logger.exception("Audit journal replay failed; segments kept for the next start")
+            self._open_segment()
+        self._thread = threading.Thread(target=self._run, name='audit-log-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def submit(self, event):
+        """Queue one event (see build_event). Returns once it is journaled."""
+        if self._stopping:
+            # Late events during interpreter shutdown are written directly
+            write_events([event])
+            return
+        with self._condition:
+            if self._segment is not None:
+                self._segment.write(json.dumps(event, separators=(',', ':')) + '\n')
+                self._segment.flush()
+                if self.fsync:
+                    os.fsync(self._segment.fileno())
+            self._buffer.append(event)
+            if len(self._buffer) >= self.batch_size:
+                self._condition.notify()
+
+    def flush(self):
+        """Write everything buffered so far. Safe to call from any thread."""
+        with self._flush_lock:
+            with self._condition:
+                if not self._buffer:
+                    return 0
+                events = list(self._buffer)
+                self._buffer.clear()
+                if self._segment is not None:
+                    self._pending_segments.append(self._segment.name)
+                    self._segment.close()
+                    self._open_segment()
+
+            try:
+                written = write_or_quarantine(events, self.journal_dir, f'{self.pid}-{self.token}')
+            except Exception:
+                # Put the batch back in order; its segments stay on disk
+                self.failed_flushes += 1
+                logger.exception("Audit log flush of %d events failed; will retry", len(events))
+                with self._condition:
+                    self._buffer.extendleft(reversed(events))
+                return 0
+
+            for path in self._pending_segments:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._pending_segments.clear()
+            self.flushed += written
+            return written
+
+    def stop(self):
+        """Flush what is left and stop the background thread"""
+        with self._condition:
+            if self._stopping:
+                return
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        with self._condition:
+            if self._segment is not None:
+                path = self._segment.name
+                self._segment.close()
+                self._segment = None
+                if not self._buffer and os.path.getsize(path) == 0:
+                    os.remove(path)
+
+    def pending(self):
+        return len(self._buffer)
+
+    def _open_segment(self):
+        self._segment_seq += 1
+        path = os.path.join(self.journal_dir, f'audit-{self.pid}-{self.token}-{self._segment_seq:06d}.jsonl')
+        self._segment = open(path, 'a', encoding='utf-8')
+
+    def _run(self):
+        while True:
+            deadline = time.monotonic() + self.flush_interval
+            with self._condition:
+                while not self._stopping and len(self._buffer) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                stopping = self._stopping
+            if stopping:
+                return
+            self.flush()
+            close_old_connections()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_audit_writer():
+    """
+    Process-wide writer, started on first use. A forked child gets its own
+    writer since the parent's thread does not survive the fork.
+    """
+    global _writer
+    writer = _writer
+    if writer is not None and writer.pid == os.getpid():
+        return writer
+    with _writer_lock:
+        if _writer is None or _writer.pid != os.getpid():
+            journal_dir = getattr(settings, 'AUDIT_LOG_JOURNAL', None)
+            _writer = AuditLogWriter(
+                batch_size=getattr(settings, 'AUDIT_LOG_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+                flush_interval=getattr(settings, 'AUDIT_LOG_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+                journal_dir=str(journal_dir) if journal_dir else None,
+                fsync=getattr(settings, 'AUDIT_LOG_JOURNAL_FSYNC', False),
+            ).start()
+        return _writer
+
+
+def flush_audit_log():
+    """Flush the current process's writer, if one is running"""
+    if _writer is not None and _writer.pid == os.getpid():
+        return _writer.flush()
+    return 0
@@ -4,10 +4,35 @@ Uses Fernet (symmetric encryption) for encrypting sensitive patient data
 """
 import os
 import base64
-from cryptography.fernet import Fernet
+import binascii
+import hmac
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import Fernet, MultiFernet
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+# Process-wide cache of Fernet instances, keyed by key version.
+# PBKDF2 derivation is deliberately slow (100k iterations), so it must run
+# once per key version per process - never once per encrypted field.
+_cipher_cache = {}
+_cipher_lock = threading.Lock()
+_blind_index_key = None
+_stats = {
+    'derivations': 0,
+    'derivation_seconds': 0.0,
+    'cipher_cache_hits': 0,
+    'cipher_cache_misses': 0,
+}
 
 def derive_key_from_password(password: str, salt: bytes = None) -> bytes:
     """
@@ -33,11 +58,26 @@ def derive_key_from_password(password: str, salt: bytes = None) -> bytes:
     return key
 
 # Generate or retrieve encryption key
-def get_encryption_key():
+def get_encryption_key(version=None):
     """
     Get or generate encryption key from settings or environment variable.
     In production, this should be stored in environment variables.
+
+    Keys of previous versions are looked up in ENCRYPTION_OLD_KEYS
+    ({version: key}), so data written before a rotation stays readable.
     """
+    if version is not None and version != get_key_version():
+        old_keys = getattr(settings, 'ENCRYPTION_OLD_KEYS', None) or {}
+        key = old_keys.get(version)
+        if not key:
+            raise ImproperlyConfigured(
+                f"No key configured for encryption key version {version}; "
+                f"add it to ENCRYPTION_OLD_KEYS"
+            )
+        if isinstance(key, str) and len(key) < 44:
+            return derive_key_from_password(key)
+        return key.encode() if isinstance(key, str) else key
+
     key = getattr(settings, 'ENCRYPTION_KEY', None)
     
     if not key:
@@ -65,10 +105,134 @@ def get_encryption_key():
     
     return key
 
-def get_cipher():
-    """Get Fernet cipher instance for encryption/decryption"""
-    key = get_encryption_key()
-    return Fernet(key)
+def get_key_version():
+    """Version number of the active encryption key (ENCRYPTION_KEY_VERSION)."""
+    return int(getattr(settings, 'ENCRYPTION_KEY_VERSION', 1))
+
+def get_cipher(version=None):
+    """
+    Get the cached Fernet cipher instance for encryption/decryption.
+
+    The key is derived on first use of each key version and reused for the
+    lifetime of the process.
+    """
+    if version is None:
+        version = get_key_version()
+
+    cipher = _cipher_cache.get(version)
+    if cipher is not None:
+        _stats['cipher_cache_hits'] += 1
+        return cipher
+
+    with _cipher_lock:
+        # Another thread may have derived the key while we were waiting
+        cipher = _cipher_cache.get(version)
+        if cipher is None:
+            _stats['cipher_cache_misses'] += 1
+            started = time.perf_counter()
+            cipher = Fernet(get_encryption_key(version))
+            elapsed = time.perf_counter() - started
+            _stats['derivations'] += 1
+            _stats['derivation_seconds'] += elapsed
+            logger.info("Derived encryption key version %s in %.1f ms", version, elapsed * 1000)
+            _cipher_cache[version] = cipher
+    return cipher
+
+def get_multi_cipher():
+    """
+    MultiFernet over the current key and every key in ENCRYPTION_OLD_KEYS,
+    newest first. Decrypts tokens made with any configured key, and its
+    rotate() re-encrypts them under the current key.
+    """
+    cipher = _cipher_cache.get('multi')
+    if cipher is None:
+        old_versions = sorted(getattr(settings, 'ENCRYPTION_OLD_KEYS', None) or {}, reverse=True)
+        cipher = MultiFernet([get_cipher()] + [get_cipher(version) for version in old_versions])
+        _cipher_cache['multi'] = cipher
+    return cipher
+
+def get_file_key(version=None):
+    """
+    32-byte AES-GCM key for encrypted file storage, derived with HKDF from the
+    field encryption key of the given version and cached like the ciphers.
+    """
+    if version is None:
+        version = get_key_version()
+    key = _cipher_cache.get(('file', version))
+    if key is None:
+        key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'medconnect-file-storage',
+        ).derive(base64.urlsafe_b64decode(get_encryption_key(version)))
+        _cipher_cache[('file', version)] = key
+    return key
+
+def reset_cipher_cache():
+    """Drop cached ciphers so the next call re-derives keys from settings."""
+    with _cipher_lock:
+        _cipher_cache.clear()
+
+def get_encryption_stats():
+    """Snapshot of key derivation and cipher cache counters."""
+    return dict(_stats, cached_versions=sorted(v for v in _cipher_cache if isinstance(v, int)))
+
+@receiver(setting_changed)
+def _reset_cipher_cache_on_setting_change(setting, **kwargs):
+    """Keep the cache coherent with override_settings() in tests."""
+    global _blind_index_key
+    if setting.startswith('ENCRYPTION_KEY') or setting == 'ENCRYPTION_OLD_KEYS':
+        reset_cipher_cache()
+    if setting in ('BLIND_INDEX_KEY', 'ENCRYPTION_KEY'):
+        _blind_index_key = None
+
+# Stored ciphertext envelope: "$mc<format>$<key version>$<payload>".
+# The prefix makes "is this value already encrypted?" a constant-time check,
+# and the key version selects the right cipher without trial decryption.
+# Format 1 stored base64(Fernet token); format 2 stores the token itself,
+# which is already urlsafe base64, and is about 25% smaller.
+ENVELOPE_FORMAT = 2
+ENVELOPE_PREFIXES = ('$mc2$', '$mc1$')
+
+def is_encrypted(value):
+    """Return True if value is a ciphertext envelope produced by encrypt_data."""
+    return isinstance(value, str) and value.startswith(ENVELOPE_PREFIXES)
+
+def is_ciphertext(value):
+    """
+    Return True if value is an envelope that one of the configured keys
+    decrypts. Unlike is_encrypted() this does not trust the prefix alone.
+    """
+    if not is_encrypted(value):
+        return False
+    try:
+        _, version, token = parse_envelope(value)
+        get_cipher(version).decrypt(token)
+    except Exception:
+        return False
+    return True
+
+def build_envelope(token, version=None):
+    """Wrap a Fernet token in the versioned storage envelope."""
+    if version is None:
+        version = get_key_version()
+    return f"$mc{ENVELOPE_FORMAT}${version}${token.decode('ascii')}"
+
+def parse_envelope(value):
+    """
+    Split a stored envelope into its parts.
+
+    Returns:
+        Tuple of (format, key_version, Fernet token bytes)
+    """
+    _, magic, version, payload = value.split('$', 3)
+    envelope_format = int(magic[2:])
+    if envelope_format == 1:
+        token = binascii.a2b_base64(payload)
+    else:
+        token = payload.encode('ascii')
+    return envelope_format, int(version), token
 
 def encrypt_data(data):
     """
@@ -78,7 +242,7 @@ def encrypt_data(data):
         data: String or bytes to encrypt
         
     Returns:
-        Encrypted string (base64 encoded)
+        Encrypted string in the versioned storage envelope
     """
     if not data:
         return None
@@ -90,49 +254,102 @@ def encrypt_data(data):
             data = data.encode('utf-8')
         
         encrypted = cipher.encrypt(data)
-        # Return base64 encoded string for database storage
-        return base64.b64encode(encrypted).decode('utf-8')
+        return build_envelope(encrypted)
     except Exception as e:
         # Log error in production
         print(f"Encryption error: {e}")
         raise
 
+def _decrypt_value(value, cipher):
+    """
+    Decrypt one stored value. cipher is the current-version cipher; other
+    versions are resolved from the envelope.
+    """
+    if is_encrypted(value):
+        try:
+            _, version, token = parse_envelope(value)
+            if version != get_key_version():
+                cipher = get_cipher(version)
+            return cipher.decrypt(token).decode('utf-8')
+        except Exception as e:
+            # An envelope that does not decrypt means a wrong or missing key
+            logger.warning("Could not decrypt stored value: %s", type(e).__name__)
+            return value
+
+    # Legacy format: bare base64 Fernet token, or unencrypted plain text.
+    # Without a key version, any configured key may have produced the token.
+    try:
+        decoded = base64.b64decode(value.encode('utf-8'), validate=True)
+        return get_multi_cipher().decrypt(decoded).decode('utf-8')
+    except Exception:
+        # Not encrypted - likely legacy unencrypted data
+        # Silently return original data (no error logging for legacy data)
+        return value
+
 def decrypt_data(encrypted_data):
     """
     Decrypt sensitive data.
     Handles both encrypted and legacy unencrypted data gracefully.
     
     Args:
-        encrypted_data: Base64 encoded encrypted string or plain text
+        encrypted_data: Envelope, legacy base64 encoded token or plain text
         
     Returns:
         Decrypted string or original string if decryption fails (legacy data)
     """
     if not encrypted_data:
         return None
-    
-    # Check if data looks like encrypted data (base64 encoded Fernet token)
-    # Fernet tokens are always base64-encoded and have a specific structure
-    try:
-        # Try to decode as base64 first
-        try:
-            decoded = base64.b64decode(encrypted_data.encode('utf-8'), validate=True)
-            # If it's valid base64, try to decrypt
-            cipher = get_cipher()
-            decrypted = cipher.decrypt(decoded)
-            return decrypted.decode('utf-8')
-        except (ValueError, TypeError):
-            # Not valid base64 - likely legacy unencrypted data
-            # Silently return original data (no error logging for legacy data)
-            return encrypted_data
-        except Exception:
-            # Decryption failed - likely legacy unencrypted data
-            # Silently return original data (no error logging for legacy data)
-            return encrypted_data
-    except Exception:
-        # Any other error - return original data (legacy unencrypted)
-        # Silently return original data (no error logging for legacy data)
-        return encrypted_data
+    return _decrypt_value(encrypted_data, get_cipher())
+
+def _decrypt_chunk(cipher, values):
+    """Decrypt a list of stored values with an already-resolved cipher."""
+    return [_decrypt_value(value, cipher) if value else None for value in values]
+
+def decrypt_many(values, max_workers=None, chunk_size=1000):
+    """
+    Decrypt a whole column of stored values in one pass.
+
+    Resolves the cipher once for the batch and returns plaintexts in input
+    order, with the same legacy-data fallback as decrypt_data(). When
+    max_workers is set, chunks are decrypted on a thread pool.
+
+    Args:
+        values: Iterable of stored (encrypted or legacy plain) strings
+        max_workers: Optional thread pool size for large batches
+        chunk_size: Number of values handed to each worker task
+
+    Returns:
+        List of decrypted strings (None for empty values)
+    """
+    values = list(values)
+    cipher = get_cipher()
+    if not max_workers or len(values) <= chunk_size:
+        return _decrypt_chunk(cipher, values)
+
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for chunk_result in executor.map(lambda chunk: _decrypt_chunk(cipher, chunk), chunks):
+            results.extend(chunk_result)
+    return results
+
+def encrypt_many(values):
+    """
+    Encrypt a sequence of values with a single cipher lookup.
+
+    Returns:
+        List of encrypted strings (None for empty values)
+    """
+    cipher = get_cipher()
+    results = []
+    for value in values:
+        if not value:
+            results.append(None)
+            continue
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        results.append(build_envelope(cipher.encrypt(value)))
+    return results
 
 def hash_sensitive_data(data):
     """
@@ -148,3 +365,33 @@ def hash_sensitive_data(data):
     
     return sha256(data).hexdigest()
 
+def get_blind_index_key():
+    """
+    HMAC key for blind indexes, derived once per process from BLIND_INDEX_KEY.
+    Kept separate from the encryption key so that rotating ENCRYPTION_KEY does
+    not invalidate every index.
+    """
+    global _blind_index_key
+    if _blind_index_key is None:
+        secret = getattr(settings, 'BLIND_INDEX_KEY', None) or getattr(settings, 'ENCRYPTION_KEY', 'medconnect')
+        _blind_index_key = base64.urlsafe_b64decode(
+            derive_key_from_password(secret, salt=b'medconnect_blind_index_2024')
+        )
+    return _blind_index_key
+
+def blind_index(data, context=''):
+    """
+    Keyed HMAC-SHA256 of a normalized value, for exact-match lookups on
+    encrypted columns. Unlike hash_sensitive_data, the digest cannot be
+    brute-forced without the key. context separates the digest space of
+    different columns.
+
+    Returns:
+        Hex digest string, or None for empty values
+    """
+    if not data:
+        return None
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    message = context.encode('utf-8') + b'\x00' + data
+    return hmac.new(get_blind_index_key(), message, 'sha256').hexdigest()
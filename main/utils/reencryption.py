@@ -0,0 +1,259 @@
+"""
+Batch rewriting of encrypted columns.
+
+Used by the management commands that migrate stored ciphertext between
+formats or keys. Rows are read with their raw (still encrypted) column values
+and written back with UPDATE ... CASE statements, so neither the field's
+from_db_value nor get_prep_value runs and nothing is encrypted twice. Each
+value is only replaced if the row still holds what was read, so the
+commands are safe to run against a live database.
+
+Files kept in EncryptedFileSystemStorage are encrypted under a key derived
+from the same key versions; reencrypt_files() rewrites them for a rotation.
+"""
+import base64
+import logging
+import operator
+from functools import reduce
+from cryptography.fernet import InvalidToken
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Case, ExpressionWrapper, F, Q, TextField, Value, When
+from django.db.models.lookups import Exact
+from main.utils.encryption import build_envelope, encrypt_data, get_cipher, get_multi_cipher, is_encrypted
+
+logger = logging.getLogger(__name__)
+
+
+def get_encrypted_fields(model):
+    """Names of the encrypted fields declared on a model"""
+    from main.fields import EncryptedFieldMixin
+    return [
+        field.name for field in model._meta.concrete_fields
+        if isinstance(field, EncryptedFieldMixin)
+    ]
+
+
+def iter_encrypted_models():
+    """Yield (model, encrypted field names) for every installed model with encrypted fields"""
+    for model in apps.get_models():
+        if model._meta.proxy:
+            continue
+        fields = get_encrypted_fields(model)
+        if fields:
+            yield model, fields
+
+
+def iter_encrypted_file_fields():
+    """Yield (model, field) for every installed FileField stored with EncryptedFileSystemStorage"""
+    from django.db.models import FileField
+    from main.storage import EncryptedFileSystemStorage
+    for model in apps.get_models():
+        if model._meta.proxy:
+            continue
+        for field in model._meta.concrete_fields:
+            if isinstance(field, FileField) and isinstance(field.storage, EncryptedFileSystemStorage):
+                yield model, field
+
+
+# Tries at rewriting a value the application keeps changing
+MAX_WRITE_ATTEMPTS = 3
+
+
+def iter_raw_batches(model, fields, batch_size=500, start_after=None):
+    """
+    Keyset-paginate a model by primary key, yielding lists of
+    (pk, {field: raw stored value}) tuples. Memory use is bounded by
+    batch_size regardless of table size.
+    """
+    queryset = model._default_manager.order_by('pk').values_list(
+        'pk',
+        *[ExpressionWrapper(F(name), output_field=TextField()) for name in fields],
+    )
+    last_pk = start_after
+    while True:
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(page[:batch_size])
+        if not rows:
+            return
+        yield [(row[0], dict(zip(fields, row[1:]))) for row in rows]
+        last_pk = rows[-1][0]
+
+
+def read_raw_values(model, name, pks):
+    """{pk: raw stored value} of one column for the given primary keys"""
+    return dict(model._default_manager.filter(pk__in=list(pks)).values_list(
+        'pk', ExpressionWrapper(F(name), output_field=TextField()),
+    ))
+
+
+def write_raw_values(model, updates):
+    """
+    Store raw column values without passing them through the field.
+
+    A value is only replaced while the column still holds the raw value it
+    was computed from, so a write by the application after the batch was
+    read is never overwritten with a transformed copy of the older data.
+
+    Args:
+        model: Model class
+        updates: Dict of {field name: {pk: (raw value read, new raw value)}}
+
+    Returns:
+        Dict of {field name: [pk, ...]} left unchanged because the column no
+        longer held the value that was read
+    """
+    manager = model._default_manager
+    conflicts = {}
+    with transaction.atomic(using=manager.db):
+        for name, values in updates.items():
+            if not values:
+                continue
+            stored = ExpressionWrapper(F(name), output_field=TextField())
+            unchanged = {
+                pk: Q(Exact(stored, Value(old, output_field=TextField())), pk=pk)
+                for pk, (old, _) in values.items()
+            }
+            updated = manager.filter(reduce(operator.or_, unchanged.values())).update(**{
+                name: Case(
+                    *[When(unchanged[pk], then=Value(new, output_field=TextField()))
+                      for pk, (_, new) in values.items()],
+                    default=F(name),
+                    output_field=TextField(),
+                )
+            })
+            if updated < len(values):
+                current = read_raw_values(model, name, values)
+                conflicts[name] = [pk for pk, (_, new) in values.items() if current.get(pk) != new]
+    return conflicts
+
+
+def _changes(raw_values, transform):
+    """{field name: {pk: (raw, new raw)}} for the values transform changes"""
+    updates = {}
+    for name, values in raw_values.items():
+        updates[name] = {}
+        for pk, raw in values.items():
+            if not raw:
+                continue
+            new_raw = transform(raw)
+            if new_raw is not None and new_raw != raw:
+                updates[name][pk] = (raw, new_raw)
+    return updates
+
+
+def _count(values_by_name):
+    return sum(len(values) for values in values_by_name.values())
+
+
+def _report_writes(updates, conflicts, on_write):
+    if on_write is None:
+        return
+    for name, values in updates.items():
+        failed = set(conflicts.get(name, ()))
+        for pk, (old_raw, new_raw) in values.items():
+            if pk not in failed:
+                on_write(name, pk, old_raw, new_raw)
+
+
+def rewrite_model(model, fields, transform, batch_size=500, start_after=None, dry_run=False, on_batch=None,
+                  on_write=None):
+    """
+    Apply transform(raw_value) to every non-empty encrypted value of a model.
+
+    transform returns the new raw value, or None to leave the value as is.
+    on_batch(last_pk, scanned, rewritten) is called after each batch is
+    committed, which lets callers checkpoint and report progress.
+    on_write(name, pk, old_raw, new_raw) is called once for every value
+    actually rewritten (or, with dry_run, that would be).
+
+    Values the application changes between the read and the write are read
+    again and transformed anew, up to MAX_WRITE_ATTEMPTS times; values still
+    changing after that are left as they are and counted as skipped.
+
+    Returns:
+        Tuple of (rows scanned, values rewritten, values skipped)
+    """
+    scanned = rewritten = skipped = 0
+    for batch in iter_raw_batches(model, fields, batch_size, start_after):
+        updates = _changes(
+            {name: {pk: raw_values[name] for pk, raw_values in batch} for name in fields}, transform,
+        )
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            if dry_run:
+                rewritten += _count(updates)
+                _report_writes(updates, {}, on_write)
+                break
+            conflicts = write_raw_values(model, updates)
+            rewritten += _count(updates) - _count(conflicts)
+            _report_writes(updates, conflicts, on_write)
+            if not _count(conflicts):
+                break
+            updates = _changes(
+                {name: read_raw_values(model, name, pks) for name, pks in conflicts.items()}, transform,
+            )
+        else:
+            skipped += _count(updates)
+        scanned += len(batch)
+        if on_batch:
+            on_batch(batch[-1][0], scanned, rewritten)
+    return scanned, rewritten, skipped
+
+
+def reencrypt_files(model, field, batch_size=500, start_after=None, on_batch=None):
+    """
+    Rewrite the files a FileField points at under the current key version,
+    keyset-paginated by primary key like rewrite_model().
+
+    Files missing from storage are skipped. Files that cannot be read with
+    any configured key are left as they are and counted as failed.
+    on_batch(last_pk, scanned, rewritten) is called after each batch.
+
+    Returns:
+        Tuple of (rows scanned, files rewritten, files failed)
+    """
+    storage = field.storage
+    queryset = model._default_manager.exclude(**{field.attname: ''}).exclude(**{f'{field.attname}__isnull': True})
+    queryset = queryset.order_by('pk').values_list('pk', field.attname)
+    scanned = rewritten = failed = 0
+    last_pk = start_after
+    while True:
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(page[:batch_size])
+        if not rows:
+            break
+        for pk, name in rows:
+            try:
+                rewritten += storage.reencrypt(name)
+            except FileNotFoundError:
+                logger.warning("%s %s: file %s is missing from storage", model._meta.label, pk, name)
+            except Exception:
+                logger.exception("%s %s: could not re-encrypt %s", model._meta.label, pk, name)
+                failed += 1
+        scanned += len(rows)
+        last_pk = rows[-1][0]
+        if on_batch:
+            on_batch(last_pk, scanned, rewritten)
+    return scanned, rewritten, failed
+
+
+def to_envelope(raw):
+    """Return the enveloped form of a legacy stored value, or None if already enveloped"""
+    if is_encrypted(raw):
+        return None
+    try:
+        token = base64.b64decode(raw.encode('utf-8'), validate=True)
+    except ValueError:
+        # Not base64, so never encrypted - legacy plain text
+        return encrypt_data(raw)
+    try:
+        get_cipher().decrypt(token)
+        return build_envelope(token)
+    except InvalidToken:
+        pass
+    try:
+        # Token made with a previous key: re-encrypt under the current one
+        return build_envelope(get_multi_cipher().rotate(token))
+    except InvalidToken:
+        # Valid base64 but not a token we can read - legacy plain text
+        return encrypt_data(raw)
@@ -2,13 +2,14 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseForbidden
+from django.http import HttpResponseForbidden, FileResponse
 from .forms import DoctorRegistrationForm, PatientRegistrationForm, AppointmentForm
 from .models import Appointment
 from django.db.models import Q
 from django.contrib.auth.models import User
 from .models import DoctorProfile, PatientProfile
 from datetime import datetime, timedelta
+import os
 
 
 # Home view with role-based checks
@@ -58,31 +59,22 @@ def terms(request):
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
-from together import Together
+from chat.modules.ai import Asklama
+from chat.modules.inference import InferenceBusy
+from chat.views import busy_response, get_user_key
 
 @csrf_exempt
 def chatbot(request):
     if request.method == "POST":
-        query = request.POST.get("query", "")
-
-        # Initialize Together client with API key
-        client = Together(api_key="5df0df3224f6530ce8bfded04afcb6e1c1fd61770039faf86034ea91d2d1308d")
-
-        # Together API logic
-        response = client.chat.completions.create(
-            model="meta-llama/Llama-3.3-70B-Instruct-Turbo",
-            messages=[{"role": "user", "content": query}],
-            max_tokens=100,
-            temperature=0.7,
-            top_p=0.7,
-            top_k=50,
-            repetition_penalty=1,
-            stop=["<|eot_id|>", "<|eom_id|>"],
-            safety_model="meta-llama/Meta-Llama-Guard-3-8B",
-        )
+        query = request.POST.get("query", "").strip()
+        if not query:
+            return JsonResponse({"error": "Please enter a valid prompt."}, status=400)
 
-        # Extract response from Together
-        chatbot_response = response.choices[0].message.content
+        # Answer with the configured chat backend (CHAT_BACKEND)
+        try:
+            chatbot_response = Asklama(query, 100, user_key=get_user_key(request))
+        except InferenceBusy as e:
+            return busy_response(e)
 
         # Return JSON response
         return JsonResponse({"response": chatbot_response})
@@ -220,12 +212,17 @@ def doctor_dashboard(request):
             resource_type='patient_profile',
             resource_id='dashboard',
             request=request,
-            details={'dashboard_type': 'doctor', 'appointments_count': appointments.count()}
+            details={
+                'dashboard_type': 'doctor',
+                'appointments_count': appointments.count(),
+                'patient_ids': sorted(set(appointments.values_list('patient_id', flat=True))),
+            }
         )
 
         context = {
             'doctor_profile': doctor_profile,
-            'appointments': appointments,
+            # Decrypt the whole medical_history column in one pass
+            'appointments': appointments.decrypted('medical_history'),
             'pending_appointments': appointments.filter(status='pending').count(),
             'confirmed_appointments': appointments.filter(status='confirmed').count(),
         }
@@ -268,7 +265,11 @@ def patient_dashboard(request):
             resource_type='patient_profile',
             resource_id=str(patient_profile.id),
             request=request,
-            details={'dashboard_type': 'patient', 'appointments_count': appointments.count()}
+            details={
+                'dashboard_type': 'patient',
+                'appointments_count': appointments.count(),
+                'patient_ids': [request.user.id],
+            }
         )
 
         context = {
@@ -354,6 +355,30 @@ def book_appointment(request):
 
 
 
+@login_required
+def download_report(request, report_id):
+    """
+    Stream a decrypted report to the appointment's patient or doctor.
+    Reports are encrypted at rest, so they cannot be served from MEDIA_URL.
+    """
+    from main.utils.audit_log import log_phi_access
+
+    report = get_object_or_404(Report.objects.select_related('appointment__doctor'), id=report_id)
+    appointment = report.appointment
+    if request.user.id not in (appointment.patient_id, appointment.doctor.user_id):
+        return HttpResponseForbidden("You don't have permission to access this report.")
+
+    log_phi_access(
+        user=request.user,
+        action='view',
+        resource_type='report',
+        resource_id=str(report.id),
+        request=request,
+        details={'appointment_id': appointment.id, 'patient_ids': [appointment.patient_id]}
+    )
+    return FileResponse(report.file.open('rb'), filename=os.path.basename(report.file.name))
+
+
 @login_required
 def doctor_confirm_appointment(request, appointment_id):
     doctor_profile = get_object_or_404(DoctorProfile, user=request.user)
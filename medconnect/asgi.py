@@ -24,3 +24,10 @@ application = ProtocolTypeRouter({
         ])
     ),
 })
+
+# Load and warm up the chat model in the background while the server starts
+# (see CHAT_MODEL_PRELOAD)
+from chat.modules.ai import should_preload, start_model_warmup  # noqa: E402
+
+if should_preload():
+    start_model_warmup()
@@ -140,6 +140,127 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # In production, you can set a custom password via environment variable:
 # export MEDCONNECT_ENCRYPTION_KEY="your-secure-password-here"
 ENCRYPTION_KEY = os.environ.get('MEDCONNECT_ENCRYPTION_KEY', 'medconnect')
+# Version of ENCRYPTION_KEY. Derived ciphers are cached per version for the
+# lifetime of the process, so bump this whenever the key changes.
+ENCRYPTION_KEY_VERSION = int(os.environ.get('MEDCONNECT_ENCRYPTION_KEY_VERSION', '1'))
+# Keys of previous versions, kept so data written before a rotation stays
+# readable until `manage.py rotate_encryption_keys` has re-encrypted it:
+# export MEDCONNECT_ENCRYPTION_OLD_KEYS="1:old-password,2:another-old-password"
+ENCRYPTION_OLD_KEYS = {
+    int(version): key
+    for version, _, key in (
+        item.partition(':') for item in os.environ.get('MEDCONNECT_ENCRYPTION_OLD_KEYS', '').split(',') if item
+    )
+}
+
+# Key for blind indexes (HMAC digests used to look up encrypted columns by
+# exact value). Must stay stable across ENCRYPTION_KEY rotations, otherwise
+# every index has to be rebuilt.
+BLIND_INDEX_KEY = os.environ.get('MEDCONNECT_BLIND_INDEX_KEY', ENCRYPTION_KEY)
+
+# Plaintext bytes per AES-GCM chunk for encrypted report/scan uploads. Only
+# affects newly written files; the chunk size is stored in each file header.
+ENCRYPTED_STORAGE_CHUNK_SIZE = 64 * 1024
+
+# Audit logging. With AUDIT_LOG_ASYNC, log_phi_access() queues entries for a
+# background thread that inserts them in batches of AUDIT_LOG_BATCH_SIZE or
+# every AUDIT_LOG_FLUSH_INTERVAL seconds. Queued entries are journaled to
+# AUDIT_LOG_JOURNAL first and replayed on the next start after a crash.
+# AUDIT_LOG_JOURNAL_FSYNC also survives power loss, at the cost of an fsync
+# per entry.
+AUDIT_LOG_ASYNC = True
+AUDIT_LOG_BATCH_SIZE = 100
+AUDIT_LOG_FLUSH_INTERVAL = 2.0
+AUDIT_LOG_JOURNAL = BASE_DIR / 'audit_journal'
+AUDIT_LOG_JOURNAL_FSYNC = False
+# Extra or overridden PHIAuditMiddleware rules keyed by URL name; see
+# main.utils.audit_policy for the defaults and the rule format.
+AUDIT_POLICY = {}
+# archive_audit_logs keeps the last AUDIT_LOG_HOT_MONTHS months in the database
+# and moves older ones to compressed, checksummed segments in AUDIT_ARCHIVE_DIR.
+AUDIT_LOG_HOT_MONTHS = 3
+AUDIT_ARCHIVE_DIR = BASE_DIR / 'audit_archive'
+
+# Local Llama model. LLAMA_MODEL_PATH overrides the default search in models/.
+# With CHAT_MODEL_PRELOAD each server worker loads and warms up the model at
+# startup (in the background, from the WSGI/ASGI application); otherwise on the
+# first chat request. /chat/ready/ returns 503 until it is ready so load
+# balancers can hold chat traffic back.
+LLAMA_MODEL_PATH = os.environ.get('MEDCONNECT_LLAMA_MODEL_PATH') or None
+LLAMA_N_CTX = 2048
+LLAMA_N_GPU_LAYERS = -1
+LLAMA_N_THREADS = None  # all CPU threads
+CHAT_MODEL_PRELOAD = os.environ.get('MEDCONNECT_CHAT_MODEL_PRELOAD', '1') == '1'
+
+# Chat model backend. 'llama' runs the local model above; 'openai' streams
+# from an OpenAI-compatible completions server (llama.cpp's llama-server,
+# vLLM, Together's https://api.together.xyz/v1, ...) at CHAT_OPENAI_BASE_URL
+# over up to CHAT_OPENAI_CONNECTIONS requests at once; 'fake' streams a
+# canned answer every INFERENCE_FAKE_TOKEN_SECONDS (no model, for CI).
+CHAT_BACKEND = os.environ.get('MEDCONNECT_CHAT_BACKEND', 'llama')
+CHAT_OPENAI_BASE_URL = os.environ.get('MEDCONNECT_CHAT_OPENAI_BASE_URL', 'http://127.0.0.1:8080/v1')
+CHAT_OPENAI_API_KEY = os.environ.get('MEDCONNECT_CHAT_OPENAI_API_KEY') or None
+CHAT_OPENAI_MODEL = os.environ.get('MEDCONNECT_CHAT_OPENAI_MODEL', 'local')
+CHAT_OPENAI_CONNECTIONS = 4
+CHAT_OPENAI_TIMEOUT = 60
+INFERENCE_FAKE_TOKEN_SECONDS = 0.02
+
+# Inference pool for the local model. INFERENCE_MODE 'thread' runs
+# INFERENCE_WORKERS model instances in each web worker process; 'process'
+# runs them in dedicated child processes; 'batch' decodes up to
+# INFERENCE_BATCH_SEQUENCES concurrent generations per worker in one step,
+# sharing INFERENCE_BATCH_CTX KV cache cells. Whatever the backend, at most
+# INFERENCE_QUEUE_SIZE requests wait (INFERENCE_MAX_PER_USER per user);
+# beyond that chat answers 503 with Retry-After.
+INFERENCE_MODE = 'batch'
+INFERENCE_WORKERS = 1
+INFERENCE_BATCH_SEQUENCES = 8
+INFERENCE_BATCH_CTX = 8192
+# Evaluate the fixed medical preamble once per worker and start every
+# generation from its KV cache instead of re-reading it for each prompt.
+INFERENCE_PREFIX_CACHE = True
+INFERENCE_QUEUE_SIZE = 16
+INFERENCE_MAX_PER_USER = 2
+# A reader gives up on (and cancels) a job that produces no output for this
+# many seconds, time spent in the queue included.
+INFERENCE_STREAM_TIMEOUT = 300
+
+# Opt-in cache of chatbot answers to repeated general questions, replayed
+# instead of generated. Keyed by the normalized prompt; with
+# CHAT_RESPONSE_CACHE_EMBEDDINGS also by semantic similarity using the chat
+# model in embedding mode, among the asking user's own earlier questions
+# only. Hit rate and latency saved show in /chat/ready/ for readers of
+# /chat/metrics/.
+CHAT_RESPONSE_CACHE = os.environ.get('MEDCONNECT_CHAT_RESPONSE_CACHE', '0') == '1'
+CHAT_RESPONSE_CACHE_SIZE = 256
+CHAT_RESPONSE_CACHE_TTL = 24 * 60 * 60
+CHAT_RESPONSE_CACHE_MAX_BYTES = 4 * 1024 * 1024
+CHAT_RESPONSE_CACHE_EMBEDDINGS = False
+CHAT_RESPONSE_CACHE_SIMILARITY = 0.92
+
+# The chat WebSocket sends generated text in frames of at most
+# CHAT_WS_FRAME_CHARS characters, flushed CHAT_WS_FRAME_INTERVAL seconds
+# after their first token.
+CHAT_WS_FRAME_INTERVAL = 0.05
+CHAT_WS_FRAME_CHARS = 512
+
+# Follow-up questions see earlier turns of their chat session: the most
+# recent CHAT_HISTORY_TURNS exchanges that fit in CHAT_HISTORY_TOKENS
+# tokens of the model's context (0 turns off history).
+CHAT_HISTORY_TOKENS = 1024
+CHAT_HISTORY_TURNS = 10
+
+# Inference timings and token counts. /chat/metrics/ serves histograms of
+# the last CHAT_METRICS_WINDOW seconds to staff users and to scrapers sending
+# "Authorization: Bearer <CHAT_METRICS_TOKEN>". With CHAT_INFERENCE_TRACE each
+# saved chat answer also keeps its own record in Conversation.inference_trace.
+CHAT_METRICS_WINDOW = 15 * 60
+CHAT_METRICS_TOKEN = os.environ.get('MEDCONNECT_CHAT_METRICS_TOKEN') or None
+CHAT_INFERENCE_TRACE = True
+
+# Point the chat page at the async SSE endpoint. Only worth it under an ASGI
+# server: WSGI collects an async stream completely before sending it.
+CHAT_STREAM_ASYNC = os.environ.get('MEDCONNECT_CHAT_STREAM_ASYNC', '0') == '1'
 
 # Together AI API Key
 # Get your API key from: https://api.together.ai/settings/api-keys
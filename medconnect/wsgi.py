@@ -14,3 +14,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'medconnect.settings')
 
 application = get_wsgi_application()
+
+# Load and warm up the chat model in the background while the server starts
+# (see CHAT_MODEL_PRELOAD)
+from chat.modules.ai import should_preload, start_model_warmup  # noqa: E402
+
+if should_preload():
+    start_model_warmup()
@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-17 13:05
+
+import main.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scans', '0002_alter_scan_options_scan_patient_scan_scan_type'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='scan',
+            name='image',
+            field=models.ImageField(storage=main.storage.get_encrypted_storage, upload_to='scans/'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from main.storage import get_encrypted_storage
 
 class Scan(models.Model):
     SCAN_TYPE_CHOICES = [
@@ -18,7 +19,7 @@ class Scan(models.Model):
         default='CKD',
         help_text='Select the type of medical scan'
     )
-    image = models.ImageField(upload_to='scans/')
+    image = models.ImageField(upload_to='scans/', storage=get_encrypted_storage)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     patient = models.ForeignKey(
         'auth.User',
@@ -5,4 +5,5 @@ app_name = 'scans'  # Ensure this is set if you're using a namespace in the main
 
 urlpatterns = [
     path('upload/', views.upload_scan, name='upload_scan'),  # Ensure this is present
+    path('image/<int:scan_id>/', views.scan_image, name='scan_image'),
 ]
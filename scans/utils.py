@@ -11,7 +11,7 @@ def analyze_image(image_path, scan_type='CKD'):
     Analyze medical scan image based on scan type.
     
     Args:
-        image_path: Path to the image file
+        image_path: Path to the image file, or a file-like object (io.BytesIO)
         scan_type: Type of scan (CKD, XRAY, MRI, etc.)
     
     Returns:
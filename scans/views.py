@@ -1,7 +1,12 @@
-from django.shortcuts import render
+import io
+import os
+from django.shortcuts import render, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.http import FileResponse
+from django.urls import reverse
 from .forms import ScanForm
+from .models import Scan
 from .utils import analyze_image
 
 @login_required
@@ -13,10 +18,13 @@ def upload_scan(request):
             new_scan.patient = request.user
             new_scan.save()
             try:
-                results = analyze_image(new_scan.image.path, scan_type=new_scan.scan_type)
+                # The stored image is encrypted, so analyze the decrypted bytes
+                with new_scan.image.open('rb') as image_file:
+                    image_data = io.BytesIO(image_file.read())
+                results = analyze_image(image_data, scan_type=new_scan.scan_type)
                 return render(request, 'results.html', {
                     'results': results,
-                    'image_url': new_scan.image.url,
+                    'image_url': reverse('scans:scan_image', args=[new_scan.id]),
                     'scan_type': new_scan.get_scan_type_display(),
                     'scan': new_scan
                 })
@@ -25,3 +33,9 @@ def upload_scan(request):
     else:
         form = ScanForm()
     return render(request, 'upload.html', {'form': form})
+
+@login_required
+def scan_image(request, scan_id):
+    """Stream a decrypted scan image to its owner"""
+    scan = get_object_or_404(Scan, id=scan_id, patient=request.user)
+    return FileResponse(scan.image.open('rb'), filename=os.path.basename(scan.image.name))